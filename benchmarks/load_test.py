@@ -0,0 +1,247 @@
+"""
+Offline load test for /api/garden_plan.
+
+Starts the stub services (see stub_services.py), launches the API in a subprocess
+pointed at them, and drives /api/garden_plan at a target concurrency using the
+image sets in prompts/test_images as fixtures. Reports throughput, end-to-end and
+per-stage latency percentiles and the API process's peak RSS. With --workers above 1 the
+per-stage latencies are not reported, as each worker keeps its own metrics.
+
+Usage (from the repository root):
+    python -m benchmarks.load_test --requests 40 --concurrency 8
+    python -m benchmarks.load_test --latency chat=lognormal:2,0.6 --error-rate image=0.05 --output before.json
+    python -m benchmarks.load_test --api-env LLM_HEDGING_ENABLED=true --output after.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from benchmarks.stub_services import SERVICES, LatencyModel, ServiceProfile, StubServices, DEFAULT_PROFILES
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+FIXTURES_DIR = REPO_ROOT / "prompts" / "test_images"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+sys.path.insert(0, str(REPO_ROOT / "src"))
+from city_garden.metrics import percentile  # noqa: E402
+
+DEFAULT_PAYLOAD = {
+    "user_preferences": {"growType": "edible", "subType": "herbs", "cycleType": "perennial", "winterType": "outdoors"},
+    "location": {"latitude": 52.52, "longitude": 13.405, "address": "Berlin, Germany", "facing": "SW"},
+}
+
+
+def fixture_sets(fixtures_dir: Path = FIXTURES_DIR, max_images: int = 3) -> List[List[str]]:
+    """Return the image paths (relative to fixtures_dir) of every user*/ set, at most max_images each."""
+    sets = []
+    for user_dir in sorted(fixtures_dir.glob("user*")):
+        images = sorted(p for p in user_dir.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES)
+        if images:
+            sets.append([p.relative_to(fixtures_dir).as_posix() for p in images[:max_images]])
+    return sets
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_api(env: Dict[str, str], port: int, log_path: Optional[Path] = None, workers: int = 1) -> subprocess.Popen:
+    """Launch the API in a subprocess, sending its output to log_path (or discarding it).
+
+    One worker runs uvicorn directly; more workers use the production launcher (run_api.py).
+    """
+    if workers > 1:
+        command = [sys.executable, "run_api.py", "--host", "127.0.0.1", "--port", str(port),
+                   "--workers", str(workers)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port),
+                   "--log-level", "warning"]
+    log = open(log_path, "w") if log_path else subprocess.DEVNULL
+    return subprocess.Popen(command, cwd=REPO_ROOT / "src", env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API process exited with code {process.returncode}")
+        try:
+            requests.get(f"{base_url}/api/metrics", timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise TimeoutError("API did not become ready in time")
+
+
+def peak_rss_bytes(pid: int) -> Optional[int]:
+    """Return the peak resident set size (VmHWM) of a process and its worker processes summed,
+    or None if unavailable (non-Linux)."""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            child_pids = [int(child) for child in children.read().split()]
+        total = 0
+        for process_id in [pid] + child_pids:
+            with open(f"/proc/{process_id}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) * 1024
+        return total
+    except OSError:
+        return None
+
+
+def run_load(base_url: str, payloads: List[Dict[str, Any]], total: int, concurrency: int,
+             timeout: float) -> List[Tuple[float, int]]:
+    """Send `total` requests with at most `concurrency` in flight. Returns (latency, status) per request."""
+    def send(index: int) -> Tuple[float, int]:
+        start = time.monotonic()
+        try:
+            response = requests.post(f"{base_url}/api/garden_plan", json=payloads[index % len(payloads)],
+                                     timeout=timeout)
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        return time.monotonic() - start, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(send, range(total)))
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples) if samples else 0.0,
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "p99": percentile(samples, 99),
+    }
+
+
+def build_report(results: List[Tuple[float, int]], duration: float, concurrency: int,
+                 server_metrics: Optional[Dict[str, Any]], rss: Optional[int], stubs: StubServices,
+                 workers: int = 1) -> Dict[str, Any]:
+    """Build the report. server_metrics is None with several workers: /api/metrics only
+    describes the worker that answered it, so the per-stage latencies and server counters
+    are left out (None) rather than reported for a fraction of the requests."""
+    ok_latencies = [latency for latency, status in results if status == 200]
+    stages = None
+    if server_metrics is not None:
+        stages = {
+            name[len("stage."):-len(".seconds")]: values
+            for name, values in server_metrics.get("histograms", {}).items()
+            if name.startswith("stage.") and name.endswith(".seconds")
+        }
+    return {
+        "requests": len(results),
+        "concurrency": concurrency,
+        "workers": workers,
+        "duration_seconds": duration,
+        "throughput_rps": len(ok_latencies) / duration if duration else 0.0,
+        "status_counts": dict(Counter(str(status) for _, status in results)),
+        "latency_seconds": summarize(ok_latencies),
+        "stages_seconds": stages,
+        "peak_rss_bytes": rss,
+        "stub_calls": {service: {"calls": len(stubs.calls[service]), "errors": stubs.errors[service]}
+                       for service in SERVICES},
+        "server_counters": server_metrics.get("counters", {}) if server_metrics is not None else None,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"\nRequests: {report['requests']} at concurrency {report['concurrency']} "
+          f"in {report['duration_seconds']:.1f}s")
+    print(f"Throughput: {report['throughput_rps']:.2f} successful plans/s")
+    print(f"Status codes: {report['status_counts']}")
+    if report["peak_rss_bytes"] is not None:
+        print(f"Peak RSS (API processes): {report['peak_rss_bytes'] / 2**20:.1f} MiB")
+    print(f"\n{'stage':<28}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    rows = [("end_to_end", report["latency_seconds"])] + sorted((report["stages_seconds"] or {}).items())
+    for name, values in rows:
+        print(f"{name:<28}{values['count']:>8}{values['p50']:>10.3f}{values['p95']:>10.3f}{values['p99']:>10.3f}")
+    if report["stages_seconds"] is None:
+        print(f"(per-stage latencies not reported: /api/metrics covers only one of the {report['workers']} workers)")
+
+
+def parse_assignments(values: List[str], option: str) -> Dict[str, str]:
+    assignments = {}
+    for value in values:
+        key, sep, setting = value.partition("=")
+        if not sep:
+            raise SystemExit(f"{option} expects KEY=VALUE, got '{value}'")
+        assignments[key] = setting
+    return assignments
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Offline load test for /api/garden_plan")
+    parser.add_argument("--requests", type=int, default=40, help="Total number of plans to request")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of requests in flight")
+    parser.add_argument("--latency", action="append", default=[], metavar="SERVICE=SPEC",
+                        help=f"Latency of a stub service ({', '.join(SERVICES)}), e.g. chat=lognormal:1.5,0.5")
+    parser.add_argument("--error-rate", action="append", default=[], metavar="SERVICE=RATE",
+                        help="Fraction of failed calls of a stub service, e.g. image=0.05")
+    parser.add_argument("--image-size", type=int, default=1024, help="Side length of the generated image")
+    parser.add_argument("--api-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment variable for the API process")
+    parser.add_argument("--workers", type=int, default=1, help="Number of API worker processes")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--api-log", type=Path, help="Write the API process output to this file")
+    parser.add_argument("--output", type=Path, help="Write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    profiles = {service: ServiceProfile(profile.latency, profile.error_rate)
+                for service, profile in DEFAULT_PROFILES.items()}
+    for service, spec in parse_assignments(args.latency, "--latency").items():
+        profiles[service].latency = LatencyModel.parse(spec)
+    for service, rate in parse_assignments(args.error_rate, "--error-rate").items():
+        profiles[service].error_rate = float(rate)
+
+    with StubServices(FIXTURES_DIR, profiles, image_size=args.image_size) as stubs:
+        env = {key: value for key, value in os.environ.items() if not key.startswith("LANGCHAIN_")}
+        env.update(stubs.environment())
+        # Measure image generation rather than cache hits unless asked otherwise
+        env.setdefault("GARDEN_IMAGE_CACHE_ENABLED", "false")
+        env.update(parse_assignments(args.api_env, "--api-env"))
+
+        payloads = [{"image_urls": [stubs.fixture_url(path) for path in image_set], **DEFAULT_PAYLOAD}
+                    for image_set in fixture_sets()]
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        api = start_api(env, port, args.api_log, args.workers)
+        try:
+            wait_ready(base_url, api)
+            start = time.monotonic()
+            results = run_load(base_url, payloads, args.requests, args.concurrency, args.timeout)
+            duration = time.monotonic() - start
+            # Per worker: with several workers it would only cover the requests of one of them
+            server_metrics = None
+            if args.workers == 1:
+                server_metrics = requests.get(f"{base_url}/api/metrics", timeout=10).json()
+            rss = peak_rss_bytes(api.pid)
+        finally:
+            api.terminate()
+            api.wait(timeout=30)
+
+        report = build_report(results, duration, args.concurrency, server_metrics, rss, stubs, args.workers)
+
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"\nReport written to {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
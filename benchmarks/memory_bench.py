@@ -0,0 +1,137 @@
+"""
+Memory benchmark for /api/garden_plan.
+
+Runs the API in-process against the stub services (see stub_services.py), sends one
+warm-up plan, then `--concurrency` plans at once and measures the peak of the Python
+heap traced by tracemalloc above the warmed-up baseline. The peak divided by the number
+of in-flight plans is compared with a budget, so memory regressions per request (extra
+copies of the images, the analysis or the report) fail the benchmark.
+
+Usage (from the repository root):
+    python -m benchmarks.memory_bench --concurrency 6
+    python -m benchmarks.memory_bench --budget-mib 10 --output memory.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from benchmarks.load_test import DEFAULT_PAYLOAD, FIXTURES_DIR, REPO_ROOT, fixture_sets, parse_assignments
+from benchmarks.stub_services import DEFAULT_PROFILES, LatencyModel, ServiceProfile, StubServices
+
+# Peak traced bytes allowed per in-flight plan
+DEFAULT_BUDGET_MIB = 8.0
+
+# Plans overlap for most of their duration with these latencies, while the benchmark stays short
+DEFAULT_LATENCIES = {"chat": "constant:0.5", "image": "constant:2.0"}
+
+
+async def run_plans(app, payloads: List[Dict[str, Any]], count: int, timeout: float) -> List[int]:
+    """Send `count` plans to the ASGI app at once. Returns the status codes."""
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://memory-bench", timeout=timeout) as client:
+        responses = await asyncio.gather(*(
+            client.post("/api/garden_plan", json=payloads[index % len(payloads)]) for index in range(count)
+        ))
+    return [response.status_code for response in responses]
+
+
+def input_bytes(payload_paths: List[List[str]], count: int) -> int:
+    """Return the mean size of the input images of a plan, over the plans that are sent."""
+    sizes = [sum((FIXTURES_DIR / path).stat().st_size for path in paths) for paths in payload_paths]
+    return sum(sizes[index % len(sizes)] for index in range(count)) // count
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Peak memory per in-flight /api/garden_plan request")
+    parser.add_argument("--concurrency", type=int, default=6, help="Number of plans in flight at once")
+    parser.add_argument("--budget-mib", type=float, default=DEFAULT_BUDGET_MIB,
+                        help="Maximum peak traced memory per in-flight plan, in MiB")
+    parser.add_argument("--latency", action="append", default=[], metavar="SERVICE=SPEC",
+                        help="Latency of a stub service, e.g. image=constant:2")
+    parser.add_argument("--image-size", type=int, default=1024, help="Side length of the generated image")
+    parser.add_argument("--api-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment variable for the API")
+    parser.add_argument("--frames", type=int, default=1, help="Traceback depth recorded by tracemalloc")
+    parser.add_argument("--top", type=int, default=10, help="Number of top allocation sites to print")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--output", type=Path, help="Write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    profiles = {service: ServiceProfile(profile.latency, profile.error_rate)
+                for service, profile in DEFAULT_PROFILES.items()}
+    latencies = {**DEFAULT_LATENCIES, **parse_assignments(args.latency, "--latency")}
+    for service, spec in latencies.items():
+        profiles[service].latency = LatencyModel.parse(spec)
+
+    with StubServices(FIXTURES_DIR, profiles, image_size=args.image_size) as stubs:
+        # The application reads its configuration at import time
+        os.environ.update(stubs.environment())
+        os.environ.setdefault("GARDEN_IMAGE_CACHE_ENABLED", "false")
+        os.environ.setdefault("GRAPH_CHECKPOINT_ENABLED", "false")
+        os.environ["GARDEN_PLAN_MAX_IN_FLIGHT"] = str(max(args.concurrency, 1))
+        os.environ.update(parse_assignments(args.api_env, "--api-env"))
+        sys.path.insert(0, str(REPO_ROOT / "src"))
+        import api  # noqa: E402
+        # The Azure SDK logs every request and response at INFO
+        logging.getLogger("azure").setLevel(logging.WARNING)
+
+        image_sets = fixture_sets()
+        payloads = [{"image_urls": [stubs.fixture_url(path) for path in image_set], **DEFAULT_PAYLOAD}
+                    for image_set in image_sets]
+
+        tracemalloc.start(args.frames)
+        # Warm up imports, clients and connection pools so they are part of the baseline
+        warm_up = asyncio.run(run_plans(api.app, payloads, 1, args.timeout))
+        api.drain_uploads(args.timeout)
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+        statuses = asyncio.run(run_plans(api.app, payloads, args.concurrency, args.timeout))
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        api.drain_uploads(args.timeout)
+        tracemalloc.stop()
+
+    peak_per_plan = (peak - baseline) / args.concurrency
+    report = {
+        "concurrency": args.concurrency,
+        "status_counts": {str(status): statuses.count(status) for status in sorted(set(warm_up + statuses))},
+        "baseline_bytes": baseline,
+        "peak_bytes": peak,
+        "peak_bytes_per_plan": peak_per_plan,
+        "input_image_bytes_per_plan": input_bytes(image_sets, args.concurrency),
+        "budget_bytes_per_plan": args.budget_mib * 2**20,
+        "image_store": api.image_store.stats(),
+    }
+
+    print(f"\nPlans in flight: {args.concurrency}, status codes: {report['status_counts']}")
+    print(f"Baseline: {baseline / 2**20:.1f} MiB, peak: {peak / 2**20:.1f} MiB")
+    print(f"Peak per in-flight plan: {peak_per_plan / 2**20:.2f} MiB "
+          f"(input images {report['input_image_bytes_per_plan'] / 2**20:.2f} MiB, budget {args.budget_mib:.2f} MiB)")
+    print(f"Image store after the run: {report['image_store']}")
+    if args.top:
+        print("\nLargest allocation sites still alive at the end of the run:")
+        for stat in snapshot.statistics("lineno")[:args.top]:
+            print(f"  {stat.size / 2**20:8.2f} MiB  {stat.traceback}")
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"\nReport written to {args.output}")
+
+    if any(status != 200 for status in statuses):
+        raise SystemExit("Some plans failed, the measurement is not representative")
+    if peak_per_plan > report["budget_bytes_per_plan"]:
+        raise SystemExit(f"Peak memory per in-flight plan {peak_per_plan / 2**20:.2f} MiB "
+                         f"exceeds the budget of {args.budget_mib:.2f} MiB")
+    return report
+
+
+if __name__ == "__main__":
+    main()
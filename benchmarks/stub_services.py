@@ -0,0 +1,304 @@
+"""
+Local stand-ins for the external services used by the garden graph.
+
+A single threaded HTTP server emulates just enough of each API for the SDKs the
+project uses:
+
+- Azure Blob Storage (download and upload of block blobs, path-style URLs)
+- Azure Content Safety (image:analyze and text:analyze)
+- Azure OpenAI chat completions (answers depend on the system prompt)
+- OpenAI image edits (returns a generated PNG)
+
+Each service has its own latency distribution and error rate, so load tests can
+model slow or flaky dependencies without network access.
+"""
+import base64
+import json
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote, urlparse
+
+from PIL import Image
+
+STORAGE_ACCOUNT = "devstoreaccount1"
+# Any base64 string works as an account key for the stub
+STORAGE_ACCOUNT_KEY = base64.b64encode(b"stub-account-key").decode("utf-8")
+FIXTURES_CONTAINER = "fixtures"
+SERVICES = ("blob", "content_safety", "chat", "image")
+
+
+@dataclass
+class LatencyModel:
+    """Latency distribution of a stub service, in seconds.
+
+    Specs look like "constant:0.2", "uniform:0.1,0.5" or "lognormal:1.5,0.4"
+    (median and sigma of the log-normal distribution).
+    """
+    kind: str = "constant"
+    params: Tuple[float, ...] = (0.0,)
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        kind, _, values = spec.partition(":")
+        params = tuple(float(value) for value in values.split(",") if value)
+        expected = {"constant": 1, "uniform": 2, "lognormal": 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f"Invalid latency spec '{spec}'")
+        return cls(kind, params)
+
+    def sample(self) -> float:
+        if self.kind == "constant":
+            return self.params[0]
+        if self.kind == "uniform":
+            return random.uniform(*self.params)
+        median, sigma = self.params
+        return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+
+@dataclass
+class ServiceProfile:
+    """Latency and error behaviour of one stub service."""
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    error_rate: float = 0.0
+
+
+DEFAULT_PROFILES = {
+    "blob": ServiceProfile(LatencyModel.parse("lognormal:0.05,0.3")),
+    "content_safety": ServiceProfile(LatencyModel.parse("lognormal:0.15,0.3")),
+    "chat": ServiceProfile(LatencyModel.parse("lognormal:1.5,0.5")),
+    "image": ServiceProfile(LatencyModel.parse("lognormal:8.0,0.3")),
+}
+
+ANALYSIS_FIELDS = ("sun_exposure", "micro_climate", "hardscape_elements", "plant_inventory",
+                   "environmental_factors", "wind_pattern")
+
+STUB_PLANTS = [
+    {"id": 0, "name": "Basil (Ocimum basilicum)", "description": "Aromatic annual herb.",
+     "care_tips": "Full sun, keep soil moist, pinch flower buds."},
+    {"id": 1, "name": "Thyme (Thymus vulgaris)", "description": "Hardy perennial herb.",
+     "care_tips": "Full sun, well-draining soil, water sparingly."},
+    {"id": 2, "name": "Geranium (Pelargonium)", "description": "Flowering container plant.",
+     "care_tips": "Bright light, water when the top soil is dry."},
+]
+
+
+def make_png(size: int = 1024) -> bytes:
+    """Return a noisy PNG of the given size (noise keeps the payload realistic after compression)."""
+    image = Image.frombytes("RGB", (size, size), random.randbytes(size * size * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def chat_answer(body: Dict) -> str:
+    """Return a plausible answer for a chat completion request, based on its system prompt."""
+    messages = body.get("messages", [])
+    system_prompt = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    if isinstance(system_prompt, list):
+        system_prompt = " ".join(part.get("text", "") for part in system_prompt)
+    if "compliance" in system_prompt or "合规" in system_prompt:
+        return "Pass"
+    if "plant_recommendations" in system_prompt:
+        return json.dumps({"plant_recommendations": STUB_PLANTS})
+    if "sun_exposure" in system_prompt:
+        return json.dumps({name: f"Stub {name.replace('_', ' ')}." for name in ANALYSIS_FIELDS})
+    return "Stub answer."
+
+
+class StubServices:
+    """Runs the stub HTTP server in a background thread.
+
+    Args:
+        fixtures_dir: Directory served as the "fixtures" blob container
+        profiles: Latency and error profile per service (see SERVICES)
+        image_size: Side length of the PNG returned by the image edit stub
+        host: Interface to bind
+        port: Port to bind (0 picks a free port)
+    """
+
+    def __init__(self, fixtures_dir: Path, profiles: Optional[Dict[str, ServiceProfile]] = None,
+                 image_size: int = 1024, host: str = "127.0.0.1", port: int = 0):
+        self.fixtures_dir = Path(fixtures_dir)
+        self.profiles = {**DEFAULT_PROFILES, **(profiles or {})}
+        self.generated_png = make_png(image_size)
+        self.uploaded: Dict[str, int] = {}
+        self.calls: Dict[str, List[float]] = {service: [] for service in SERVICES}
+        self.errors: Dict[str, int] = {service: 0 for service in SERVICES}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environment(self) -> Dict[str, str]:
+        """Environment variables that point the application at the stubs."""
+        return {
+            "AZURE_STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT,
+            "AZURE_STORAGE_ACCOUNT_KEY": STORAGE_ACCOUNT_KEY,
+            "AZURE_STORAGE_ACCOUNT_URL": f"{self.base_url}/{STORAGE_ACCOUNT}",
+            "AZURE_CONTENT_SAFETY_ENDPOINT": self.base_url,
+            "AZURE_CONTENT_SAFETY_KEY": "stub",
+            "AZURE_OPENAI_ENDPOINT": self.base_url,
+            "AZURE_OPENAI_API_KEY": "stub",
+            "OPENAI_API_VERSION": "2024-12-01-preview",
+            "AZURE_MODEL_NAME": "stub-model",
+            "OPENAI_BASE_URL": f"{self.base_url}/v1",
+            "OPENAI_API_KEY": "stub",
+            # The Open-Meteo archive is not emulated
+            "CLIMATE_DERIVATION_ENABLED": "false",
+            "WIND_ANALYSIS_ENABLED": "false",
+        }
+
+    def fixture_url(self, relative_path: str) -> str:
+        """URL of a fixture image. The dummy SAS query makes the loader use the URL as-is."""
+        quoted = quote(Path(relative_path).as_posix())
+        return f"{self.base_url}/{STORAGE_ACCOUNT}/{FIXTURES_CONTAINER}/{quoted}?sv=stub"
+
+    def start(self) -> "StubServices":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StubServices":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _simulate(self, service: str) -> bool:
+        """Sleep for the service latency and return False if this call should fail."""
+        profile = self.profiles[service]
+        delay = profile.latency.sample()
+        time.sleep(delay)
+        failed = random.random() < profile.error_rate
+        with self._lock:
+            self.calls[service].append(delay)
+            if failed:
+                self.errors[service] += 1
+        return not failed
+
+    def _handler_class(self):
+        stubs = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_body(self) -> bytes:
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return b"".join(chunks)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _send(self, status: int, body: bytes = b"", content_type: str = "application/json",
+                      headers: Optional[Dict[str, str]] = None) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_json(self, status: int, payload: Dict) -> None:
+                self._send(status, json.dumps(payload).encode("utf-8"))
+
+            def _fail(self) -> None:
+                self._send_json(503, {"error": {"code": "ServiceUnavailable", "message": "Injected stub error"}})
+
+            def do_GET(self):
+                path = unquote(urlparse(self.path).path)
+                prefix = f"/{STORAGE_ACCOUNT}/{FIXTURES_CONTAINER}/"
+                if not path.startswith(prefix):
+                    return self._send_json(404, {"error": {"code": "BlobNotFound", "message": path}})
+                if not stubs._simulate("blob"):
+                    return self._fail()
+                fixture = (stubs.fixtures_dir / path[len(prefix):]).resolve()
+                if stubs.fixtures_dir.resolve() not in fixture.parents or not fixture.is_file():
+                    return self._send_json(404, {"error": {"code": "BlobNotFound", "message": path}})
+                data = fixture.read_bytes()
+                headers = {
+                    "x-ms-blob-type": "BlockBlob",
+                    "ETag": f'"{hash(data) & 0xffffffff:x}"',
+                    "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+                    "Accept-Ranges": "bytes",
+                }
+                range_header = self.headers.get("x-ms-range") or self.headers.get("Range")
+                if range_header:
+                    start, _, end = range_header.split("=", 1)[1].partition("-")
+                    start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+                    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+                    return self._send(206, data[start:end + 1], "application/octet-stream", headers)
+                return self._send(200, data, "application/octet-stream", headers)
+
+            def do_PUT(self):
+                path = unquote(urlparse(self.path).path)
+                body = self._read_body()
+                if not stubs._simulate("blob"):
+                    return self._fail()
+                with stubs._lock:
+                    stubs.uploaded[path] = len(body)
+                self._send(201, headers={
+                    "ETag": '"0x1"',
+                    "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+                    "x-ms-request-server-encrypted": "true",
+                })
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                body = self._read_body()
+                if path.startswith("/contentsafety/"):
+                    if not stubs._simulate("content_safety"):
+                        return self._fail()
+                    categories = ["Hate", "SelfHarm", "Sexual", "Violence"]
+                    return self._send_json(200, {
+                        "categoriesAnalysis": [{"category": category, "severity": 0} for category in categories],
+                        "blocklistsMatch": [],
+                    })
+                if path.startswith("/openai/deployments/") and path.endswith("/chat/completions"):
+                    if not stubs._simulate("chat"):
+                        return self._fail()
+                    answer = chat_answer(json.loads(body or b"{}"))
+                    return self._send_json(200, {
+                        "id": "chatcmpl-stub",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": "stub-model",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": answer}}],
+                        "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": len(answer) // 4,
+                                  "total_tokens": (len(body) + len(answer)) // 4},
+                    })
+                if path.endswith("/images/edits"):
+                    if not stubs._simulate("image"):
+                        return self._fail()
+                    return self._send_json(200, {
+                        "created": int(time.time()),
+                        "data": [{"b64_json": base64.b64encode(stubs.generated_png).decode("utf-8")}],
+                    })
+                self._send_json(404, {"error": {"code": "NotFound", "message": path}})
+
+        return Handler
@@ -1,22 +1,84 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, HttpUrl, validator
 from typing import List, Optional, Dict, Any
 from city_garden.graph_builder import build_garden_graph
 from city_garden.garden_state import GardenState
-from city_garden.services.image_loader import AzureImageLoader
+from city_garden.services.image_loader import AzureImageLoader, drain_uploads, pending_upload, upload_failure
+from city_garden.services.image_variants import image_variants_enabled, srcset_urls, warm_up as warm_up_image_variants
 from city_garden.services.content_safety import ContentAnalyzer
+from city_garden.services.image_dedup import deduplicate_images_from_env
+from city_garden.metrics import registry as metrics_registry
+from city_garden.logging_config import configure_logging, log_payload, use_request_id
+from city_garden.prompt_registry import SUPPORTED_LANGUAGES
+from city_garden.admission import AdmissionRejected, create_admission_controller_from_env
+from city_garden.cancellation import (CancelScope, DeadlineExceeded, RunCancelled, call_timeout, check_cancelled,
+                                     remaining_budget, use_scope)
+from city_garden.checkpointing import (analysis_complete, checkpoint_ttl_seconds, create_checkpointer_from_env,
+                                       image_sources, input_conflicts, new_run_id, prune_runs, replan_run, resume_run,
+                                       run_config, stored_run)
+from city_garden.image_store import image_store
+from city_garden.tools.solar import parse_facing
+from functools import partial
 import os
+import asyncio
 import logging
+import re
+import uuid
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
+load_dotenv()
+
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-load_dotenv()
+_garden_graphs: Dict[int, Any] = {}
+
+def get_garden_graph():
+    """Return this process's compiled graph.
+
+    Built per process because the checkpointer's SQLite connection must not cross a fork;
+    the import-time build below still preloads all modules for a preloading server (run_api.py).
+    """
+    pid = os.getpid()
+    if pid not in _garden_graphs:
+        _garden_graphs.clear()
+        _garden_graphs[pid] = build_garden_graph(checkpointer=create_checkpointer_from_env())
+    return _garden_graphs[pid]
+
+get_garden_graph()
+
+# Bounds the number of concurrent graph runs, with a short wait queue in front of them
+admission = create_admission_controller_from_env()
+
+async def prune_stored_runs() -> None:
+    """Prune expired runs and their images now and then every GRAPH_CHECKPOINT_PRUNE_INTERVAL_SECONDS."""
+    interval = float(os.environ.get("GRAPH_CHECKPOINT_PRUNE_INTERVAL_SECONDS", "3600"))
+    while True:
+        try:
+            await run_in_threadpool(prune_runs, get_garden_graph().checkpointer, image_store, checkpoint_ttl_seconds())
+        except Exception as e:
+            logger.warning(f"Pruning of the stored runs failed: {e!r}")
+        await asyncio.sleep(interval)
 
-app = FastAPI(title="City Garden API", description="API for generating garden plans")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if image_variants_enabled():
+        warm_up_image_variants()
+    pruner = None
+    if get_garden_graph().checkpointer is not None and checkpoint_ttl_seconds() > 0:
+        pruner = asyncio.create_task(prune_stored_runs())
+    yield
+    if pruner is not None:
+        pruner.cancel()
+    # Let the background uploads of already answered requests finish before the worker exits
+    timeout = float(os.environ.get("UPLOAD_DRAIN_TIMEOUT_SECONDS", "30"))
+    await asyncio.get_running_loop().run_in_executor(None, drain_uploads, timeout)
+
+app = FastAPI(title="City Garden API", description="API for generating garden plans", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -27,10 +89,56 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+REQUEST_ID_HEADER = "x-request-id"
+# Client-supplied request ids are only used if they are short and plain
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+class RequestIdMiddleware:
+    """Tag each request's log records with its X-Request-ID (or a new id) and return it in the response.
+
+    A plain ASGI middleware, so the request id context reaches the endpoint and the threads it
+    starts, and http.disconnect messages still reach the endpoint.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = dict(scope["headers"]).get(REQUEST_ID_HEADER.encode(), b"").decode("latin-1")
+        if not _REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (REQUEST_ID_HEADER.encode(), request_id.encode())]
+            await send(message)
+
+        with use_request_id(request_id):
+            await self.app(scope, receive, send_with_request_id)
+
+app.add_middleware(RequestIdMiddleware)
+
 class Location(BaseModel):
     latitude: float
     longitude: float
     address: str
+    facing: Optional[str] = None  # Direction the balcony faces: compass point ("SW") or degrees from north
+    horizon_angle: Optional[float] = None  # Elevation of obstructions in front of the balcony, in degrees
+
+    @validator('facing')
+    def validate_facing(cls, v):
+        if v is not None:
+            parse_facing(v)
+        return v
+
+    @validator('horizon_angle')
+    def validate_horizon_angle(cls, v):
+        if v is not None and not 0 <= v < 90:
+            raise ValueError("horizon_angle must be between 0 and 90 degrees")
+        return v
 
 class UserPreferences(BaseModel):
     growType: str
@@ -42,6 +150,22 @@ class GardenPlanRequest(BaseModel):
     image_urls: List[str]  # Changed from HttpUrl to str to handle Azure SAS URLs
     user_preferences: UserPreferences
     location: Location
+    language: str = "en"
+    run_id: Optional[str] = None  # Resume a stored run (requires GRAPH_CHECKPOINT_ENABLED)
+    rerender: bool = False  # With run_id: generate a new garden image for the stored plan
+    deadline_seconds: Optional[float] = None  # Time budget, at most GARDEN_PLAN_DEADLINE_SECONDS
+
+    @validator('language')
+    def validate_language(cls, v):
+        if v not in SUPPORTED_LANGUAGES:
+            raise ValueError(f"Unsupported language, expected one of {', '.join(SUPPORTED_LANGUAGES)}")
+        return v
+
+    @validator('deadline_seconds')
+    def validate_deadline_seconds(cls, v):
+        if v is not None and v <= 0:
+            raise ValueError("deadline_seconds must be positive")
+        return v
 
     @validator('image_urls')
     def validate_image_urls(cls, v):
@@ -51,93 +175,365 @@ class GardenPlanRequest(BaseModel):
             raise ValueError("Maximum 3 images allowed")
         return v
 
+class ReplanRequest(BaseModel):
+    user_preferences: UserPreferences
+    generate_image: bool = True
+    language: Optional[str] = None
+    deadline_seconds: Optional[float] = None
+
+    @validator('language')
+    def validate_language(cls, v):
+        if v is not None and v not in SUPPORTED_LANGUAGES:
+            raise ValueError(f"Unsupported language, expected one of {', '.join(SUPPORTED_LANGUAGES)}")
+        return v
+
+    @validator('deadline_seconds')
+    def validate_deadline_seconds(cls, v):
+        if v is not None and v <= 0:
+            raise ValueError("deadline_seconds must be positive")
+        return v
+
 class GardenPlanResponse(BaseModel):
     garden_image_url: str
+    garden_image_variants: Dict[str, str] = {}  # Resized renditions of the garden image: a srcset per format
     plant_recommendations: List[Dict[Any, Any]]
+    run_id: Optional[str] = None
+    skipped_stages: List[str] = []  # Optional stages left out to meet the deadline
 
-@app.post("/api/garden_plan", response_model=GardenPlanResponse)
-async def create_garden_plan(request: GardenPlanRequest):
+@app.get("/api/metrics")
+async def get_metrics():
+    """Return a snapshot of the in-process metrics (LLM hedging, latencies, etc.)."""
+    return metrics_registry.snapshot()
+
+async def cancel_on_disconnect(http_request: Request, scope: CancelScope):
+    """Cancel the run of a request once its client has disconnected."""
+    poll_interval = float(os.environ.get("GARDEN_PLAN_DISCONNECT_POLL_SECONDS", "0.5"))
+    while not scope.cancelled:
+        if await http_request.is_disconnected():
+            scope.cancel("client disconnected")
+            return
+        await asyncio.sleep(poll_interval)
+
+def plan_budget(deadline_seconds: Optional[float]) -> Optional[float]:
+    """Return the time budget of a request in seconds: the requested deadline, capped at
+    GARDEN_PLAN_DEADLINE_SECONDS (0 disables the server-side deadline)."""
+    limit = float(os.environ.get("GARDEN_PLAN_DEADLINE_SECONDS", "180"))
+    if limit <= 0:
+        return deadline_seconds
+    return limit if deadline_seconds is None else min(deadline_seconds, limit)
+
+async def wait_for_garden_image_upload(graph, response: GardenPlanResponse) -> None:
+    """Wait for the background upload of the response's garden image, clearing the URL if it failed.
+
+    The wait is bounded by the remaining budget of the request; an upload that is still running
+    at the deadline continues in the background, but the response goes out without the image.
+    """
+    upload = pending_upload(response.garden_image_url) if response.garden_image_url else None
     try:
-        logger.info(f"Received request with {len(request.image_urls)} images")
-        
-        # Load images
-        image_loader = AzureImageLoader(
-            account_name=os.environ["AZURE_STORAGE_ACCOUNT_NAME"],
-            account_key=os.environ["AZURE_STORAGE_ACCOUNT_KEY"]
-        )
-        
+        if upload is not None:
+            with metrics_registry.timer("stage.upload_wait.seconds"):
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(upload)), timeout=remaining_budget())
+        elif response.garden_image_url:
+            # Finished before the wait: uploaded, unless it is recorded as failed
+            failure = upload_failure(response.garden_image_url)
+            if failure is not None:
+                raise RuntimeError(failure)
+    except asyncio.TimeoutError:
+        logger.warning("Garden image upload did not finish before the deadline")
+        metrics_registry.counter("deadline.skipped.upload_garden_image").inc()
+        response.garden_image_url = ""
+        response.garden_image_variants = {}
+        response.skipped_stages.append("upload_garden_image")
+        return
+    except Exception as e:
+        logger.error(f"Garden image upload failed: {str(e)}")
+        response.garden_image_url = ""
+        response.garden_image_variants = {}
+        if graph.checkpointer is not None and response.run_id:
+            # So that retrying the run re-renders the image instead of returning the broken URL
+            await run_in_threadpool(graph.update_state, run_config(response.run_id),
+                                    {"garden_image_url": "", "garden_image_variants": {}},
+                                    as_node="create_garden_image")
+        return
+    await wait_for_garden_image_variants(response)
+
+async def wait_for_garden_image_variants(response: GardenPlanResponse) -> None:
+    """Wait for the background rendering and upload of the garden image variants.
+
+    The wait is bounded by the remaining budget and IMAGE_VARIANT_WAIT_SECONDS. A format is only
+    returned if all of its variants were uploaded; the others are left out of the response (the
+    full-size image is still there) and finish in the background, so the cache has them next time.
+    """
+    uploads = {url: pending_upload(url)
+               for value in response.garden_image_variants.values() for url in srcset_urls(value)}
+    pending = [asyncio.wrap_future(upload) for upload in uploads.values() if upload is not None]
+    if pending:
+        timeout = call_timeout(float(os.environ.get("IMAGE_VARIANT_WAIT_SECONDS", "10")))
+        with metrics_registry.timer("stage.variants_wait.seconds"):
+            await asyncio.wait(pending, timeout=timeout)
+
+    def uploaded(url: str) -> bool:
+        upload = uploads[url]
+        if upload is None:
+            # Finished before the wait: uploaded, unless it is recorded as failed
+            return upload_failure(url) is None
+        return upload.done() and not upload.cancelled() and upload.exception() is None
+
+    variants = {name: value for name, value in response.garden_image_variants.items()
+                if all(uploaded(url) for url in srcset_urls(value))}
+    if len(variants) < len(response.garden_image_variants):
+        logger.warning("Some garden image variants were not uploaded in time, leaving them out")
+        metrics_registry.counter("image_variants.dropped").inc(len(response.garden_image_variants) - len(variants))
+    response.garden_image_variants = variants
+
+def format_style_preferences(user_preferences: UserPreferences) -> str:
+    return f"{user_preferences.growType} {user_preferences.subType} plants, {user_preferences.cycleType}, {user_preferences.winterType}"
+
+def run_inputs(request: GardenPlanRequest) -> Dict[str, Any]:
+    """The request's inputs as stored in the run's state; resuming a run requires the same inputs."""
+    return {
+        "image_urls": image_sources(request.image_urls),
+        "user_preferences": request.user_preferences.dict(),
+        "location": request.location.address,
+        "latitude": request.location.latitude,
+        "longitude": request.location.longitude,
+        "facing": request.location.facing,
+        "horizon_angle": request.location.horizon_angle,
+        "language": request.language,
+    }
+
+async def prepare_initial_state(request: GardenPlanRequest) -> GardenState:
+    """Load, de-duplicate and safety-check the request's images and build the initial graph state.
+
+    The images are moved to the image store; the caller owns a reference to each of the
+    state's image_ids and must release them when the run is done.
+
+    Raises:
+        HTTPException: 400 if the images cannot be loaded or fail the content safety check
+    """
+    # Load images
+    image_loader = AzureImageLoader(
+        account_name=os.environ["AZURE_STORAGE_ACCOUNT_NAME"],
+        account_key=os.environ["AZURE_STORAGE_ACCOUNT_KEY"]
+    )
+    
+    try:
+        logger.info("Attempting to load images from Azure Blob Storage")
+        check_cancelled("load_images")
+        with metrics_registry.timer("stage.load_images.seconds"):
+            garden_image_contents = await run_in_threadpool(image_loader.load_images, request.image_urls)
+        logger.info(f"Successfully loaded {len(garden_image_contents)} images")
+    except RunCancelled:
+        raise
+    except Exception as e:
+        # A timeout at the deadline is not a problem with the images
+        check_cancelled()
+        logger.error(f"Failed to load images: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Failed to load images: {str(e)}")
+    
+    if len(garden_image_contents) == 0:
+        logger.error("No images loaded successfully")
+        raise HTTPException(status_code=400, detail="No images loaded successfully")
+    
+    # Photos taken from almost the same angle add tokens but no information
+    with metrics_registry.timer("stage.image_dedup.seconds"):
+        garden_image_contents = await run_in_threadpool(deduplicate_images_from_env, garden_image_contents)
+    
+    # Check content safety
+    content_analyzer = ContentAnalyzer(
+        endpoint=os.environ["AZURE_CONTENT_SAFETY_ENDPOINT"],
+        key=os.environ["AZURE_CONTENT_SAFETY_KEY"]
+    )
+    
+    for image_content in garden_image_contents:
+        check_cancelled("content_safety")
         try:
-            logger.info("Attempting to load images from Azure Blob Storage")
-            garden_image_contents = image_loader.load_images(request.image_urls)
-            logger.info(f"Successfully loaded {len(garden_image_contents)} images")
+            with metrics_registry.timer("stage.content_safety.seconds"):
+                analysis_result = await run_in_threadpool(content_analyzer.analyze_image_data, image_content)
+            if (analysis_result.hate_severity > 0.5 or 
+                analysis_result.self_harm_severity > 0.5 or 
+                analysis_result.sexual_severity > 0.5 or 
+                analysis_result.violence_severity > 0.5):
+                logger.error("Image content safety check failed")
+                raise HTTPException(status_code=400, detail="Image content safety check failed")
+        except RunCancelled:
+            raise
         except Exception as e:
-            logger.error(f"Failed to load images: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Failed to load images: {str(e)}")
+            # A timeout at the deadline is not a problem with the images
+            check_cancelled()
+            logger.error(f"Content safety analysis failed: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Content safety analysis failed: {str(e)}")
+    
+    # Format user preferences for the garden state
+    style_preferences = format_style_preferences(request.user_preferences)
+    
+    # The state only references the images; the store keeps one decoded copy of each
+    image_ids = image_store.put_base64(garden_image_contents)
+    del garden_image_contents
+    
+    # Initialize the state
+    initial_state = GardenState(
+        sun_exposure="",
+        micro_climate="",
+        hardscape_elements="",
+        plant_iventory="",
+        environment_factors="",
+        wind_pattern="",
+        style_preferences=style_preferences,
+        hardiness_zone=None,
+        wind_exposure=None,
+        plant_recommendations=[],
+        garden_image_url="",
+        garden_image_variants={},
+        light_level=None,
+        image_ids=image_ids,
+        image_findings={},
+        skipped_stages=[],
+        messages=[],
+        **run_inputs(request)
+    )
+    
+    return initial_state
+
+@app.post("/api/garden_plan", response_model=GardenPlanResponse)
+async def create_garden_plan(request: GardenPlanRequest, http_request: Request):
+    # The scope carries the request's deadline into every stage, graph node and service call
+    scope = CancelScope(plan_budget(request.deadline_seconds))
+    disconnect_watcher = asyncio.create_task(cancel_on_disconnect(http_request, scope))
+    image_ids: List[str] = []
+    with use_scope(scope):
+        try:
+            logger.info(f"Received request with {len(request.image_urls)} images")
         
-        if len(garden_image_contents) == 0:
-            logger.error("No images loaded successfully")
-            raise HTTPException(status_code=400, detail="No images loaded successfully")
+            graph = get_garden_graph()
+            run_id = request.run_id or new_run_id()
+            snapshot = None
+            if request.run_id and graph.checkpointer is not None:
+                snapshot = await run_in_threadpool(stored_run, graph, run_id)
         
-        # Check content safety
-        content_analyzer = ContentAnalyzer(
-            endpoint=os.environ["AZURE_CONTENT_SAFETY_ENDPOINT"],
-            key=os.environ["AZURE_CONTENT_SAFETY_KEY"]
-        )
+            if snapshot is not None:
+                conflicts = input_conflicts(snapshot, run_inputs(request))
+                if conflicts:
+                    raise HTTPException(status_code=409,
+                                        detail=f"Run {run_id} was started with a different {', '.join(conflicts)}; "
+                                               f"send the run's inputs or leave out run_id to start a new run")
+                # The stored run already has validated images and every completed node's output
+                logger.info(f"Continuing stored run {run_id}")
+                image_ids = list(snapshot.values.get("image_ids", []))
+                image_store.acquire(image_ids)
+                run_graph = partial(resume_run, graph, run_id, snapshot, request.rerender)
+            else:
+                initial_state = await prepare_initial_state(request)
+                image_ids = initial_state["image_ids"]
+                run_graph = partial(graph.invoke, initial_state, run_config(run_id))
+                del initial_state
         
-        for image_content in garden_image_contents:
+            # Run the graph once a slot is free, off the event loop
             try:
-                analysis_result = content_analyzer.analyze_image_data(image_content)
-                if (analysis_result.hate_severity > 0.5 or 
-                    analysis_result.self_harm_severity > 0.5 or 
-                    analysis_result.sexual_severity > 0.5 or 
-                    analysis_result.violence_severity > 0.5):
-                    logger.error("Image content safety check failed")
-                    raise HTTPException(status_code=400, detail="Image content safety check failed")
-            except Exception as e:
-                logger.error(f"Content safety analysis failed: {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Content safety analysis failed: {str(e)}")
+                async with admission.slot():
+                    scope.check("graph")
+                    logger.info("Running the garden planning graph")
+                    with metrics_registry.timer("stage.graph.seconds"):
+                        final_state = await run_in_threadpool(run_graph)
+            except AdmissionRejected as e:
+                logger.warning(f"Garden plan rejected: {e.reason}")
+                raise HTTPException(status_code=503, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+            logger.info("Graph execution completed")
         
-        # Create the graph
-        graph = build_garden_graph()
+            log_payload(logger, "Plant recommendations", final_state['plant_recommendations'])
+            logger.info(f"Garden image URL: {final_state['garden_image_url']}")
         
-        # Format user preferences for the garden state
-        style_preferences = f"{request.user_preferences.growType} {request.user_preferences.subType} plants, {request.user_preferences.cycleType}, {request.user_preferences.winterType}"
+            # Build the response while the generated image is still uploading
+            response = GardenPlanResponse(
+                garden_image_url=final_state['garden_image_url'],
+                garden_image_variants=final_state.get('garden_image_variants') or {},
+                plant_recommendations=final_state['plant_recommendations'],
+                run_id=run_id,
+                skipped_stages=list(final_state.get('skipped_stages') or [])
+            )
+            # Don't keep the run's state and images while waiting for the upload
+            del final_state, run_graph
+            image_store.release(image_ids)
+            image_ids = []
         
-        # Initialize the state
-        initial_state = GardenState(
-            sun_exposure="",
-            micro_climate="",
-            hardscape_elements="",
-            plant_iventory="",
-            environment_factors="",
-            wind_pattern="",
-            style_preferences=style_preferences,
-            plant_recommendations=[],
-            garden_image_url="",
-            garden_image="",
-            location=request.location.address,
-            latitude=request.location.latitude,
-            longitude=request.location.longitude,
-            images=garden_image_contents,
-            messages=[]
-        )
+            await wait_for_garden_image_upload(graph, response)
         
-        # Run the graph
-        logger.info("Running the garden planning graph")
-        final_state = graph.invoke(initial_state)
-        logger.info("Graph execution completed")
-        
-        # print out plant recommendations
-        print(f"Plant recommendations: {final_state['plant_recommendations']}")
-        print(f"Garden image URL: {final_state['garden_image_url']}")   
+            # Return the results
+            return response
+        except HTTPException:
+            raise
+        except DeadlineExceeded as e:
+            # A required stage could not finish in time
+            logger.warning(f"Garden plan deadline exceeded: {e}")
+            metrics_registry.counter("garden_plan.deadline_exceeded").inc()
+            raise HTTPException(status_code=504, detail=f"The garden plan did not finish in time: {e}")
+        except RunCancelled as e:
+            # Nobody is waiting for the answer; 499 is the de facto "client closed request" status
+            logger.info(f"Garden plan cancelled: {e}")
+            metrics_registry.counter("garden_plan.cancelled").inc()
+            raise HTTPException(status_code=499, detail="Client closed request")
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+        finally:
+            disconnect_watcher.cancel()
+            image_store.release(image_ids)
+
+@app.post("/api/garden_plan/{run_id}/replan", response_model=GardenPlanResponse)
+async def replan_garden_plan(run_id: str, request: ReplanRequest, http_request: Request):
+    """Re-plan a stored run for new preferences, reusing its compliance check and garden analysis."""
+    graph = get_garden_graph()
+    if graph.checkpointer is None:
+        raise HTTPException(status_code=400, detail="Re-planning requires GRAPH_CHECKPOINT_ENABLED=true")
+    snapshot = await run_in_threadpool(stored_run, graph, run_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail=f"Unknown run {run_id}")
+    if not analysis_complete(snapshot):
+        raise HTTPException(status_code=409, detail="The run did not pass the compliance check or its analysis is incomplete")
+    
+    scope = CancelScope(plan_budget(request.deadline_seconds))
+    disconnect_watcher = asyncio.create_task(cancel_on_disconnect(http_request, scope))
+    # The new garden image is rendered from the run's stored input images
+    image_ids = list(snapshot.values.get("image_ids", []))
+    image_store.acquire(image_ids)
+    with use_scope(scope):
+        try:
+            run_graph = partial(replan_run, graph, run_id, format_style_preferences(request.user_preferences),
+                                request.generate_image, request.language, request.user_preferences.dict())
+            try:
+                async with admission.slot():
+                    scope.check("graph")
+                    with metrics_registry.timer("stage.replan.seconds"):
+                        final_state = await run_in_threadpool(run_graph)
+            except AdmissionRejected as e:
+                logger.warning(f"Re-plan rejected: {e.reason}")
+                raise HTTPException(status_code=503, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
         
-        # Return the results
-        return GardenPlanResponse(
-            garden_image_url=final_state['garden_image_url'],
-            plant_recommendations=final_state['plant_recommendations']
-        )
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}") 
\ No newline at end of file
+            response = GardenPlanResponse(
+                garden_image_url=final_state.get('garden_image_url', ""),
+                garden_image_variants=final_state.get('garden_image_variants') or {},
+                plant_recommendations=final_state['plant_recommendations'],
+                run_id=run_id,
+                skipped_stages=list(final_state.get('skipped_stages') or [])
+            )
+            del final_state, run_graph
+            image_store.release(image_ids)
+            image_ids = []
+            await wait_for_garden_image_upload(graph, response)
+            return response
+        except HTTPException:
+            raise
+        except DeadlineExceeded as e:
+            logger.warning(f"Re-plan deadline exceeded: {e}")
+            metrics_registry.counter("garden_plan.deadline_exceeded").inc()
+            raise HTTPException(status_code=504, detail=f"The re-plan did not finish in time: {e}")
+        except RunCancelled as e:
+            logger.info(f"Re-plan cancelled: {e}")
+            metrics_registry.counter("garden_plan.cancelled").inc()
+            raise HTTPException(status_code=499, detail="Client closed request")
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+        finally:
+            disconnect_watcher.cancel()
+            image_store.release(image_ids)
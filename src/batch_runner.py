@@ -0,0 +1,408 @@
+"""
+Run the garden graph offline over a JSONL manifest, e.g. for backfills and evaluations.
+
+Each manifest line is one garden plan, in the format of the /api/garden_plan request body,
+with an optional "id" (the line number otherwise). Images can be blob URLs or local paths
+(relative to the manifest):
+
+    {"id": "berlin-1", "image_urls": ["photos/balcony-1.jpg"],
+     "location": {"latitude": 52.52, "longitude": 13.405, "address": "Berlin, Germany", "facing": "SW"},
+     "user_preferences": {"growType": "edible", "subType": "herbs", "cycleType": "perennial", "winterType": "outdoors"},
+     "language": "en"}
+
+The plans run on a thread pool (or, with --executor process, a pool of processes that each
+build their own graph) with at most --concurrency plans in flight. Every result is appended
+to the output JSONL as soon as it is finished, with the item's timings per stage. Running the
+same manifest again skips the items already in the output, so an interrupted batch resumes
+where it stopped; --retry-failed also runs the failed items again.
+
+Usage:
+    python src/batch_runner.py manifest.jsonl --output results.jsonl --concurrency 4
+    python src/batch_runner.py manifest.jsonl --executor process --concurrency 8 --retry-failed
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from city_garden.cancellation import CancelScope, RunCancelled, use_scope
+from city_garden.checkpointing import (checkpoint_ttl_seconds, create_checkpointer_from_env, image_sources, prune_runs,
+                                       resume_run, run_config, stored_run)
+from city_garden.garden_state import GardenState
+from city_garden.image_store import image_store
+from city_garden.logging_config import configure_logging, use_request_id
+from city_garden.metrics import run_timings
+from city_garden.prompt_registry import SUPPORTED_LANGUAGES
+from city_garden.services.content_safety import ContentAnalyzer
+from city_garden.services.image_dedup import deduplicate_images_from_env
+from city_garden.services.image_loader import AzureImageLoader, drain_uploads, wait_for_upload
+from city_garden.services.image_variants import srcset_urls
+from city_garden.tools.solar import parse_facing
+
+logger = logging.getLogger(__name__)
+
+PREFERENCE_FIELDS = ("growType", "subType", "cycleType", "winterType")
+# Namespace of the checkpoint run ids derived from the manifest item ids
+RUN_ID_NAMESPACE = uuid.UUID("5b0c4a52-8f7e-4d0a-9a57-2f1de7c0b6a1")
+
+_graph = None
+
+
+class ManifestError(ValueError):
+    """A manifest line is not a valid garden plan."""
+
+
+def read_manifest(path: Path) -> Iterator[Dict[str, Any]]:
+    """Yield the items of a JSONL manifest, each with an "id" (its line number if it has none).
+
+    Raises:
+        ManifestError: If a line is not a JSON object or an id is used twice
+    """
+    seen: Set[str] = set()
+    with open(path, encoding="utf-8") as manifest:
+        for line_number, line in enumerate(manifest, start=1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ManifestError(f"{path}:{line_number}: {e}")
+            if not isinstance(item, dict):
+                raise ManifestError(f"{path}:{line_number}: expected a JSON object")
+            item["id"] = str(item.get("id", line_number))
+            if item["id"] in seen:
+                raise ManifestError(f"{path}:{line_number}: duplicate id '{item['id']}'")
+            seen.add(item["id"])
+            yield item
+
+
+def finished_items(output: Path, retry_failed: bool = False) -> Set[str]:
+    """Return the ids of the items that already have a result in the output.
+
+    A line cut off by an interrupted run is ignored, so that item runs again.
+    """
+    finished: Set[str] = set()
+    if not output.exists():
+        return finished
+    with open(output, encoding="utf-8") as results:
+        for line in results:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not retry_failed or result.get("status") == "ok":
+                finished.add(str(result.get("id")))
+    return finished
+
+
+def validate_item(item: Dict[str, Any]) -> None:
+    """Check an item like the API validates a request.
+
+    Raises:
+        ManifestError: If the item is not a valid garden plan
+    """
+    image_urls = item.get("image_urls")
+    if not isinstance(image_urls, list) or not 1 <= len(image_urls) <= 3:
+        raise ManifestError("image_urls must list 1 to 3 images")
+    location = item.get("location")
+    if not isinstance(location, dict) or not {"latitude", "longitude", "address"} <= location.keys():
+        raise ManifestError("location needs latitude, longitude and address")
+    try:
+        if location.get("facing") is not None:
+            parse_facing(location["facing"])
+    except ValueError as e:
+        raise ManifestError(str(e))
+    horizon_angle = location.get("horizon_angle")
+    if horizon_angle is not None and not 0 <= horizon_angle < 90:
+        raise ManifestError("horizon_angle must be between 0 and 90 degrees")
+    preferences = item.get("user_preferences")
+    if not isinstance(preferences, dict) or not set(PREFERENCE_FIELDS) <= preferences.keys():
+        raise ManifestError(f"user_preferences needs {', '.join(PREFERENCE_FIELDS)}")
+    if item.get("language", "en") not in SUPPORTED_LANGUAGES:
+        raise ManifestError(f"Unsupported language, expected one of {', '.join(SUPPORTED_LANGUAGES)}")
+
+
+def load_images(image_urls: List[str], base_dir: Path) -> List[str]:
+    """Load images from blob URLs or local paths (relative to base_dir), base64 encoded."""
+    contents = []
+    image_loader = None
+    for image_url in image_urls:
+        if image_url.startswith(("http://", "https://")):
+            if image_loader is None:
+                image_loader = AzureImageLoader(
+                    account_name=os.environ["AZURE_STORAGE_ACCOUNT_NAME"],
+                    account_key=os.environ["AZURE_STORAGE_ACCOUNT_KEY"]
+                )
+            contents.append(image_loader.load_image(image_url))
+        else:
+            contents.append(base64.b64encode((base_dir / image_url).read_bytes()).decode("utf-8"))
+    return contents
+
+
+def check_content_safety(image_contents: List[str]) -> None:
+    """Raises ValueError if an image fails the content safety check (same thresholds as the API)."""
+    content_analyzer = ContentAnalyzer(
+        endpoint=os.environ["AZURE_CONTENT_SAFETY_ENDPOINT"],
+        key=os.environ["AZURE_CONTENT_SAFETY_KEY"]
+    )
+    for image_content in image_contents:
+        result = content_analyzer.analyze_image_data(image_content)
+        if (result.hate_severity > 0.5 or result.self_harm_severity > 0.5 or
+                result.sexual_severity > 0.5 or result.violence_severity > 0.5):
+            raise ValueError("Image content safety check failed")
+
+
+def initial_state(item: Dict[str, Any], image_ids: List[str]) -> GardenState:
+    preferences = item["user_preferences"]
+    location = item["location"]
+    return GardenState(
+        sun_exposure="",
+        micro_climate="",
+        hardscape_elements="",
+        plant_iventory="",
+        environment_factors="",
+        wind_pattern="",
+        style_preferences=f"{preferences['growType']} {preferences['subType']} plants, "
+                          f"{preferences['cycleType']}, {preferences['winterType']}",
+        user_preferences=preferences,
+        hardiness_zone=None,
+        wind_exposure=None,
+        plant_recommendations=[],
+        garden_image_url="",
+        garden_image_variants={},
+        location=location["address"],
+        latitude=location["latitude"],
+        longitude=location["longitude"],
+        facing=location.get("facing"),
+        horizon_angle=location.get("horizon_angle"),
+        light_level=None,
+        image_urls=image_sources(item["image_urls"]),
+        image_ids=image_ids,
+        image_findings={},
+        language=item.get("language", "en"),
+        skipped_stages=[],
+        messages=[]
+    )
+
+
+def get_graph():
+    """Return this process's compiled graph (one per worker process)."""
+    global _graph
+    if _graph is None:
+        # Imported here: building the graph needs the Azure settings, reading a manifest does not
+        from city_garden.graph_builder import build_garden_graph
+        _graph = build_garden_graph(checkpointer=create_checkpointer_from_env())
+    return _graph
+
+
+def wait_for_image(result: Dict[str, Any], timeout: Optional[float]) -> None:
+    """Wait for the background uploads of the garden image and its variants, dropping the failed ones."""
+    if result["garden_image_url"]:
+        try:
+            wait_for_upload(result["garden_image_url"], timeout=timeout)
+        except Exception as e:
+            result["garden_image_url"] = ""
+            result["garden_image_variants"] = {}
+            result["error"] = f"Garden image upload failed: {e}"
+    variants = {}
+    for format_name, value in result["garden_image_variants"].items():
+        errors = []
+        for url in srcset_urls(value):
+            try:
+                wait_for_upload(url, timeout=timeout)
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            logger.warning(f"Dropping the {format_name} variants of item {result['id']}: {errors[0]}")
+        else:
+            variants[format_name] = value
+    result["garden_image_variants"] = variants
+
+
+def run_item(item: Dict[str, Any], base_dir: str, deadline_seconds: Optional[float] = None,
+             upload_timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Run one garden plan and return its result record. Never raises for a failed plan."""
+    # The item id serves as the request id of the plan's log records
+    with use_request_id(item["id"]):
+        return _run_item(item, base_dir, deadline_seconds, upload_timeout)
+
+
+def _run_item(item: Dict[str, Any], base_dir: str, deadline_seconds: Optional[float],
+              upload_timeout: Optional[float]) -> Dict[str, Any]:
+    started = time.monotonic()
+    result: Dict[str, Any] = {"id": item["id"], "status": "error"}
+    image_ids: List[str] = []
+    timings: Dict[str, float] = {}
+    try:
+        validate_item(item)
+        with use_scope(CancelScope(deadline_seconds)), run_timings() as timings:
+            prepare_started = time.monotonic()
+            image_contents = load_images(item["image_urls"], Path(base_dir))
+            image_contents = deduplicate_images_from_env(image_contents)
+            check_content_safety(image_contents)
+            image_ids = image_store.put_base64(image_contents)
+            del image_contents
+            timings["prepare"] = time.monotonic() - prepare_started
+
+            graph = get_graph()
+            graph_started = time.monotonic()
+            if graph.checkpointer is not None:
+                # Stable run id per item, so a plan interrupted mid-graph continues where it stopped
+                run_id = uuid.uuid5(RUN_ID_NAMESPACE, item["id"]).hex
+                snapshot = stored_run(graph, run_id)
+                if snapshot is not None:
+                    final_state = resume_run(graph, run_id, snapshot)
+                else:
+                    final_state = graph.invoke(initial_state(item, image_ids), run_config(run_id))
+                result["run_id"] = run_id
+            else:
+                final_state = graph.invoke(initial_state(item, image_ids))
+            timings["graph"] = time.monotonic() - graph_started
+
+        result.update(
+            status="ok",
+            compliance_check=final_state.get("compliance_check"),
+            plant_recommendations=final_state.get("plant_recommendations") or [],
+            garden_image_url=final_state.get("garden_image_url", ""),
+            garden_image_variants=final_state.get("garden_image_variants") or {},
+            skipped_stages=list(final_state.get("skipped_stages") or []),
+        )
+        del final_state
+        image_store.release(image_ids)
+        image_ids = []
+        upload_started = time.monotonic()
+        wait_for_image(result, upload_timeout)
+        timings["upload_wait"] = time.monotonic() - upload_started
+    except ManifestError as e:
+        result["error"] = f"Invalid manifest item: {e}"
+    except RunCancelled as e:
+        result["error"] = f"Did not finish in time: {e}"
+    except Exception as e:
+        logger.exception(f"Item {item['id']} failed")
+        result["error"] = str(e)
+    finally:
+        image_store.release(image_ids)
+    result["timings"] = {
+        "total": round(time.monotonic() - started, 3),
+        # stage.<node>.seconds timers are reported by node name
+        **{name.removeprefix("stage.").removesuffix(".seconds"): round(seconds, 3)
+           for name, seconds in sorted(timings.items())},
+    }
+    result["finished_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    return result
+
+
+def create_executor(kind: str, concurrency: int) -> Executor:
+    if kind == "process":
+        # Spawned workers; each builds its own graph (and checkpointer connection) on first use
+        return ProcessPoolExecutor(max_workers=concurrency, mp_context=get_context("spawn"),
+                                   initializer=configure_logging)
+    return ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+
+
+def run_batch(manifest: Path, output: Path, concurrency: int = 4, executor_kind: str = "thread",
+              retry_failed: bool = False, deadline_seconds: Optional[float] = None,
+              upload_timeout: Optional[float] = None, limit: Optional[int] = None) -> Tuple[int, int, int]:
+    """Run the items of a manifest that have no result in the output yet.
+
+    Args:
+        manifest: The JSONL manifest
+        output: The JSONL file results are appended to
+        concurrency: Maximum number of plans in flight
+        executor_kind: "thread" or "process"
+        retry_failed: Also run the items whose earlier result is an error
+        deadline_seconds: Time budget per plan (None for no deadline)
+        upload_timeout: Maximum wait for each garden image upload of a plan
+        limit: Run at most this many items
+
+    Returns:
+        The numbers of successful, failed and skipped items
+    """
+    checkpointer = create_checkpointer_from_env()
+    if checkpointer is not None:
+        if checkpoint_ttl_seconds() > 0:
+            prune_runs(checkpointer, image_store, checkpoint_ttl_seconds())
+        checkpointer.conn.close()
+    finished = finished_items(output, retry_failed)
+    base_dir = str(manifest.resolve().parent)
+    succeeded = failed = skipped = submitted = 0
+    # An interrupted run may have left a partial last line
+    needs_newline = output.exists() and output.stat().st_size > 0 and not output.read_bytes().endswith(b"\n")
+    with open(output, "a", encoding="utf-8") as results, create_executor(executor_kind, concurrency) as executor:
+        if needs_newline:
+            results.write("\n")
+        in_flight = set()
+
+        def write_done(done) -> None:
+            nonlocal succeeded, failed
+            for future in done:
+                result = future.result()
+                results.write(json.dumps(result, ensure_ascii=False) + "\n")
+                results.flush()
+                if result["status"] == "ok":
+                    succeeded += 1
+                else:
+                    failed += 1
+                logger.info(f"{result['id']}: {result['status']} in {result['timings']['total']:.1f}s"
+                            + (f" ({result['error']})" if result.get("error") else ""))
+
+        for item in read_manifest(manifest):
+            if item["id"] in finished:
+                skipped += 1
+                continue
+            if limit is not None and submitted >= limit:
+                break
+            # Only read ahead of the pool by the concurrency limit, so large manifests stream
+            if len(in_flight) >= concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                write_done(done)
+            in_flight.add(executor.submit(run_item, item, base_dir, deadline_seconds, upload_timeout))
+            submitted += 1
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            write_done(done)
+    return succeeded, failed, skipped
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the garden graph over a JSONL manifest")
+    parser.add_argument("manifest", type=Path, help="JSONL manifest, one /api/garden_plan request body per line")
+    parser.add_argument("--output", type=Path, help="JSONL results file (default: <manifest>.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("BATCH_CONCURRENCY", "4")),
+                        help="Maximum number of plans in flight")
+    parser.add_argument("--executor", choices=("thread", "process"), default="thread",
+                        help="Run the plans on threads or in worker processes")
+    parser.add_argument("--retry-failed", action="store_true", help="Run the items that failed before again")
+    parser.add_argument("--deadline-seconds", type=float, help="Time budget per plan")
+    parser.add_argument("--upload-timeout", type=float, default=120.0,
+                        help="Maximum wait for each garden image upload of a plan")
+    parser.add_argument("--limit", type=int, help="Run at most this many items")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    output = args.output or args.manifest.with_suffix(".results.jsonl")
+    started = time.monotonic()
+    try:
+        succeeded, failed, skipped = run_batch(args.manifest, output, args.concurrency, args.executor,
+                                               args.retry_failed, args.deadline_seconds, args.upload_timeout,
+                                               args.limit)
+    finally:
+        drain_uploads(args.upload_timeout)
+    print(f"{succeeded} succeeded, {failed} failed, {skipped} already done "
+          f"in {time.monotonic() - started:.1f}s; results in {output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,145 @@
+"""
+Admission control for expensive garden plan runs.
+
+At most `max_in_flight` plans run at once; up to `max_queue` more wait (for at most
+`queue_timeout` seconds, or what is left of the request's deadline if that is shorter) for a
+slot. Anything beyond that is rejected immediately, so a traffic spike turns into fast 503
+responses instead of slowing every request down and exhausting the LLM quota.
+"""
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from city_garden.cancellation import remaining_budget
+from city_garden.metrics import percentile, registry
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted (queue full or queue wait timed out).
+
+    Attributes:
+        retry_after: Suggested number of seconds before retrying
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded concurrency with a bounded, time-limited wait queue.
+
+    Must be used from a single event loop (one per API worker process).
+
+    Args:
+        max_in_flight: Maximum number of admitted requests at once
+        max_queue: Maximum number of requests waiting for a slot
+        queue_timeout: Maximum time in seconds a request waits for a slot
+        name: Prefix of the exported metrics
+    """
+
+    def __init__(self, max_in_flight: int = 8, max_queue: int = 16, queue_timeout: float = 10.0,
+                 name: str = "garden_plan"):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_flight = 0
+        self._waiting = 0
+
+        self._in_flight_gauge = registry.gauge(f"{name}.in_flight")
+        self._queue_depth_gauge = registry.gauge(f"{name}.queue_depth")
+        self._queue_wait = registry.histogram(f"{name}.queue_wait_seconds")
+        self._service_time = registry.histogram(f"{name}.service_seconds")
+        self._admitted = registry.counter(f"{name}.admitted")
+        self._rejected_queue_full = registry.counter(f"{name}.rejected_queue_full")
+        self._rejected_timeout = registry.counter(f"{name}.rejected_queue_timeout")
+
+    def retry_after(self) -> int:
+        """Estimate when a retried request could be admitted, from the recent service times."""
+        typical_service = percentile(self._service_time.samples(), 50) or self.queue_timeout
+        backlog = (self._waiting + 1) / self.max_in_flight
+        return max(1, math.ceil(typical_service * backlog))
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold an execution slot for the duration of the block.
+
+        Raises:
+            AdmissionRejected: If the queue is full or no slot freed up within queue_timeout (or
+                the remaining budget of the current run, if shorter)
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        if self._semaphore.locked() or self._waiting > 0:
+            if self._waiting >= self.max_queue:
+                self._rejected_queue_full.inc()
+                raise AdmissionRejected("Server is at capacity", self.retry_after())
+            self._waiting += 1
+            self._queue_depth_gauge.set(self._waiting)
+            start = time.monotonic()
+            timeout = self.queue_timeout
+            remaining = remaining_budget()
+            if remaining is not None and remaining < timeout:
+                # Waiting past the deadline would only turn the 503 into a 504
+                timeout = remaining
+            try:
+                if not await self._acquire(timeout):
+                    self._rejected_timeout.inc()
+                    raise AdmissionRejected("Timed out waiting for capacity", self.retry_after())
+            finally:
+                self._waiting -= 1
+                self._queue_depth_gauge.set(self._waiting)
+                self._queue_wait.observe(time.monotonic() - start)
+        else:
+            await self._semaphore.acquire()
+            self._queue_wait.observe(0.0)
+
+        self._admitted.inc()
+        self._in_flight += 1
+        self._in_flight_gauge.set(self._in_flight)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._service_time.observe(time.monotonic() - start)
+            self._in_flight -= 1
+            self._in_flight_gauge.set(self._in_flight)
+            self._semaphore.release()
+
+    async def _acquire(self, timeout: float) -> bool:
+        """Wait at most timeout seconds for the semaphore; returns whether it was acquired.
+
+        Unlike asyncio.wait_for (which on Python 3.11 can time out after the acquire succeeded),
+        a permit is never left taken when the wait gives up or the waiting request is cancelled.
+        """
+        acquire = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=timeout)
+        except BaseException:
+            if acquire.done() and not acquire.cancelled():
+                self._semaphore.release()
+            else:
+                acquire.cancel()
+            raise
+        if acquire.done():
+            return True
+        # A cancelled Semaphore.acquire() hands the permit on if it was woken in the meantime
+        acquire.cancel()
+        return False
+
+
+def create_admission_controller_from_env() -> AdmissionController:
+    """Create the garden plan admission controller from environment variables."""
+    return AdmissionController(
+        max_in_flight=int(os.environ.get("GARDEN_PLAN_MAX_IN_FLIGHT", "8")),
+        max_queue=int(os.environ.get("GARDEN_PLAN_MAX_QUEUE", "16")),
+        queue_timeout=float(os.environ.get("GARDEN_PLAN_QUEUE_TIMEOUT_SECONDS", "10")),
+    )
@@ -0,0 +1,260 @@
+"""
+Cancellation and deadlines of garden plan runs.
+
+The API creates a CancelScope per request and cancels it when the client disconnects.
+The scope is made current with a context variable, which reaches the graph nodes (they run
+in worker threads that copy the caller's context). The graph checks the scope at every
+node boundary, and the LLM and image API calls run as coroutines on a background event
+loop so a cancellation aborts the in-flight HTTP request instead of waiting for it.
+
+A scope can also carry a deadline. Every call made through run_cancellable() waits at most
+for the remaining budget, service clients size their timeouts with call_timeout(), and
+optional stages (see optional()) are skipped when too little budget is left for them.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, TypeVar
+
+from city_garden.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# A service call failing with less time than this left is taken to have run out of time
+DEADLINE_MARGIN_SECONDS = float(os.environ.get("DEADLINE_MARGIN_SECONDS", "1.0"))
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+_current_scope: contextvars.ContextVar[Optional["CancelScope"]] = contextvars.ContextVar(
+    "city_garden_cancel_scope", default=None
+)
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    """Return the background event loop used to run async calls from the sync graph nodes.
+
+    The loop is started on first use in a daemon thread, so importing this module before
+    the API workers are forked does not leave a dead thread behind.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="graph-async", daemon=True)
+            thread.start()
+        return _loop
+
+
+class RunCancelled(Exception):
+    """Raised inside a graph run whose CancelScope has been cancelled."""
+
+
+class DeadlineExceeded(RunCancelled):
+    """Raised inside a graph run whose deadline has passed."""
+
+
+class CancelScope:
+    """Cancellation flag and optional deadline for one graph run, shared between the API and
+    the worker threads.
+
+    Args:
+        budget: Time budget of the run in seconds from now, or None for no deadline
+    """
+
+    def __init__(self, budget: Optional[float] = None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._futures: List[concurrent.futures.Future] = []
+        self.reason: Optional[str] = None
+        self.deadline: Optional[float] = time.monotonic() + budget if budget is not None else None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """Cancel the run and abort the calls it has in flight. Safe to call from any thread."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            futures, self._futures = self._futures, []
+        for future in futures:
+            if future.cancel():
+                registry.counter("cancellation.aborted_calls").inc()
+        logger.info(f"Run cancelled: {reason}")
+
+    def remaining(self) -> Optional[float]:
+        """Return the remaining budget in seconds (0 once the deadline has passed), or None without a deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self, stage: Optional[str] = None) -> None:
+        """Raise RunCancelled if the scope has been cancelled, or DeadlineExceeded if its deadline has passed.
+
+        Args:
+            stage: Name of the stage that is about to start, counted in cancellation.skipped.<stage>
+                or deadline.exceeded.<stage>
+        """
+        if self._event.is_set():
+            if stage is not None:
+                registry.counter(f"cancellation.skipped.{stage}").inc()
+            raise RunCancelled(self.reason)
+        if self.remaining() == 0.0:
+            if stage is not None:
+                registry.counter(f"deadline.exceeded.{stage}").inc()
+            raise DeadlineExceeded(f"deadline exceeded before {stage or 'the next stage'}")
+
+    def _track(self, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            if not self._event.is_set():
+                self._futures.append(future)
+                return
+        future.cancel()
+
+    def _untrack(self, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            if future in self._futures:
+                self._futures.remove(future)
+
+
+def current_scope() -> Optional[CancelScope]:
+    """Return the CancelScope of the run in the current context, if any."""
+    return _current_scope.get()
+
+
+@contextmanager
+def use_scope(scope: CancelScope) -> Iterator[CancelScope]:
+    """Make a scope current for the duration of the block (and for threads started from it)."""
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+
+
+def check_cancelled(stage: Optional[str] = None) -> None:
+    """Raise RunCancelled (or DeadlineExceeded) if the current run has been cancelled or has
+    run out of time (no-op outside a scope)."""
+    scope = current_scope()
+    if scope is not None:
+        scope.check(stage)
+
+
+def remaining_budget() -> Optional[float]:
+    """Return the remaining budget of the current run in seconds, or None without a deadline."""
+    scope = current_scope()
+    return scope.remaining() if scope is not None else None
+
+
+def is_timeout(error: BaseException) -> bool:
+    """Return whether an exception is a timeout, of asyncio, httpx, openai, requests or the Azure SDK."""
+    return any("Timeout" in cls.__name__ for cls in type(error).__mro__)
+
+
+def check_out_of_time(error: BaseException, stage: str) -> None:
+    """After a failed service call, raise RunCancelled or DeadlineExceeded if that is why it failed.
+
+    call_timeout() gives the client the remaining budget, so its own timeout often fires just before
+    the deadline: a timeout, or a failure with less than DEADLINE_MARGIN_SECONDS left, counts as
+    the stage running out of time rather than as an ordinary error.
+    """
+    check_cancelled()
+    remaining = remaining_budget()
+    if is_timeout(error) or (remaining is not None and remaining < DEADLINE_MARGIN_SECONDS):
+        registry.counter(f"deadline.exceeded.{stage}").inc()
+        raise DeadlineExceeded(f"{stage} ran out of time: {error!r}") from error
+
+
+def call_timeout(default: Optional[float] = None) -> Optional[float]:
+    """Return the timeout for one service call: the default, capped at the remaining budget."""
+    remaining = remaining_budget()
+    if remaining is None:
+        return default
+    return remaining if default is None else min(default, remaining)
+
+
+def azure_timeout_kwargs() -> Dict[str, float]:
+    """Per-operation timeout keyword arguments for Azure SDK calls, sized to the remaining budget."""
+    timeout = call_timeout()
+    return {} if timeout is None else {"connection_timeout": timeout, "read_timeout": timeout}
+
+
+def run_cancellable(awaitable: Awaitable[T]) -> T:
+    """Run a coroutine on the background loop and wait for it from a sync caller.
+
+    Cancelling the current scope cancels the coroutine, which closes its HTTP request.
+    The wait is bounded by the remaining budget of the scope; a call still running at the
+    deadline is cancelled the same way.
+
+    Raises:
+        RunCancelled: If the current scope is or gets cancelled
+        DeadlineExceeded: If the deadline passes before the call completes
+    """
+    scope = current_scope()
+    future = asyncio.run_coroutine_threadsafe(awaitable, background_loop())
+    if scope is not None:
+        scope._track(future)
+    try:
+        return future.result(timeout=scope.remaining() if scope is not None else None)
+    except concurrent.futures.CancelledError:
+        raise RunCancelled(scope.reason if scope is not None else "cancelled")
+    except concurrent.futures.TimeoutError:
+        if future.done():
+            # The call itself raised a timeout
+            raise
+        future.cancel()
+        registry.counter("deadline.aborted_calls").inc()
+        raise DeadlineExceeded("deadline exceeded during a service call")
+    except BaseException:
+        # e.g. KeyboardInterrupt in the waiting thread: don't leave the call running
+        future.cancel()
+        raise
+    finally:
+        if scope is not None:
+            scope._untrack(future)
+
+
+def cancellable(name: str, node: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    """Wrap a graph node so it does not start once the current run has been cancelled."""
+    @functools.wraps(node)
+    def cancellable_node(state):
+        check_cancelled(name)
+        return node(state)
+    return cancellable_node
+
+
+def optional(name: str, node: Callable[[Any], Any], min_budget: float) -> Callable[[Any], Any]:
+    """Wrap an optional graph node so it is skipped when the run is short of time.
+
+    The node does not start when less than min_budget seconds are left, and a node that
+    runs out of time is abandoned instead of failing the run. Either way the stage name is
+    added to the state's skipped_stages and counted in deadline.skipped.<name>. A skipped node
+    only returns the skipped_stages update, so it may run in parallel with other nodes.
+    """
+    def skip(state, reason: str):
+        logger.info(f"Skipping {name}: {reason}")
+        registry.counter(f"deadline.skipped.{name}").inc()
+        return {"skipped_stages": list(state.get("skipped_stages") or []) + [name]}
+
+    @functools.wraps(node)
+    def optional_node(state):
+        remaining = remaining_budget()
+        if remaining is not None and remaining < min_budget:
+            return skip(state, f"{remaining:.1f}s left, {min_budget:.1f}s needed")
+        try:
+            return node(state)
+        except DeadlineExceeded:
+            return skip(state, "deadline exceeded")
+    return optional_node
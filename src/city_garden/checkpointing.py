@@ -0,0 +1,223 @@
+"""
+Checkpointed, resumable garden plan runs.
+
+With GRAPH_CHECKPOINT_ENABLED=true the graph is compiled with a SQLite checkpointer and
+every run is stored under a run id (the LangGraph thread id) after each completed node.
+Running the same run id again:
+- continues an unfinished run (e.g. an LLM timeout) at the node that did not complete
+- re-renders the garden image of a finished run that has no image (or when asked to),
+  reusing the stored compliance, analysis and recommendations
+- otherwise returns the stored result
+
+The stored runs also serve as re-planning sessions: replan_run() reuses a run's compliance
+check and garden analysis when only the user's preferences change.
+
+prune_runs() deletes the runs that have not been updated for GRAPH_CHECKPOINT_TTL_SECONDS,
+together with the stored input images no remaining run references.
+"""
+import logging
+import os
+import sqlite3
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+from dotenv import load_dotenv
+
+from city_garden.cancellation import optional
+from city_garden.metrics import registry
+from city_garden.services.http_replay import VOLATILE_QUERY_PARAMS
+from city_garden.services.text_screening import screen_recommendations
+
+logger = logging.getLogger(__name__)
+
+
+def create_checkpointer_from_env():
+    """Create the SQLite checkpointer from environment variables, or None if checkpointing is disabled.
+
+    The connection belongs to the calling process: create one per API worker, after the fork.
+    """
+    load_dotenv()
+    if os.environ.get("GRAPH_CHECKPOINT_ENABLED", "false").lower() != "true":
+        return None
+    # Imported here so langgraph-checkpoint-sqlite is only needed when checkpointing is used
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    path = os.environ.get("GRAPH_CHECKPOINT_PATH", "graph_checkpoints.sqlite3")
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return SqliteSaver(connection)
+
+
+def checkpoint_ttl_seconds() -> float:
+    """Age after which a run that has not been updated is pruned (0 keeps runs forever)."""
+    return float(os.environ.get("GRAPH_CHECKPOINT_TTL_SECONDS", "604800"))
+
+
+def prune_runs(checkpointer, store, ttl_seconds: float) -> Tuple[int, int]:
+    """Delete the runs whose latest checkpoint is older than ttl_seconds, and the stored input
+    images that no remaining run references.
+
+    Args:
+        checkpointer: The SqliteSaver of the graph
+        store: The ImageStore persisting the input images next to the checkpoints
+        ttl_seconds: Maximum age of a run's latest checkpoint
+
+    Returns:
+        The numbers of deleted runs and images
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=ttl_seconds)
+    with checkpointer.cursor(transaction=False) as cursor:
+        cursor.execute("SELECT DISTINCT thread_id FROM checkpoints")
+        run_ids = [row[0] for row in cursor.fetchall()]
+    deleted = 0
+    keep = set()
+    for run_id in run_ids:
+        latest = checkpointer.get_tuple(run_config(run_id))
+        if latest is None:
+            continue
+        if datetime.fromisoformat(latest.checkpoint["ts"]) < cutoff:
+            checkpointer.delete_thread(run_id)
+            deleted += 1
+        else:
+            keep.update(latest.checkpoint["channel_values"].get("image_ids") or [])
+    images = store.prune(keep, stored_before=cutoff.timestamp())
+    if deleted or images:
+        logger.info(f"Pruned {deleted} runs and {images} images older than {ttl_seconds:.0f}s")
+    registry.counter("graph_runs.pruned").inc(deleted)
+    registry.counter("image_store.pruned").inc(images)
+    return deleted, images
+
+
+def new_run_id() -> str:
+    return uuid.uuid4().hex
+
+
+def run_config(run_id: str) -> Dict[str, Any]:
+    return {"configurable": {"thread_id": run_id}}
+
+
+def stored_run(graph, run_id: str):
+    """Return the latest checkpoint (StateSnapshot) of a run, or None if the run is unknown."""
+    snapshot = graph.get_state(run_config(run_id))
+    return snapshot if snapshot.values else None
+
+
+def image_sources(image_urls: List[str]) -> List[str]:
+    """Return the image URLs without their SAS tokens, to be stored with a run.
+
+    A new SAS token for the same blob is the same input, and tokens are not kept in the checkpoints.
+    """
+    sources = []
+    for url in image_urls:
+        parsed = urlparse(url)
+        query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if k not in VOLATILE_QUERY_PARAMS]
+        sources.append(urlunparse(parsed._replace(query=urlencode(query))))
+    return sources
+
+
+def input_conflicts(snapshot, inputs: Dict[str, Any]) -> List[str]:
+    """Return the names of the inputs that differ from the ones stored with a run.
+
+    Inputs the run does not have (e.g. image_urls of runs stored before it was added) are not compared.
+    """
+    return [name for name, value in inputs.items() if name in snapshot.values and snapshot.values[name] != value]
+
+
+def resume_run(graph, run_id: str, snapshot, rerender: bool = False) -> Dict[str, Any]:
+    """Continue a stored run from its last completed node.
+
+    Args:
+        graph: The graph compiled with a checkpointer
+        run_id: The run id
+        snapshot: The run's latest checkpoint, from stored_run()
+        rerender: Generate a new garden image even if the run already has one
+
+    Returns:
+        The final state of the run
+    """
+    config = run_config(run_id)
+    if snapshot.next:
+        logger.info(f"Resuming run {run_id} at {', '.join(snapshot.next)}")
+        registry.counter("graph_runs.resumed").inc()
+        return graph.invoke(None, config)
+
+    values = snapshot.values
+    passed = values.get("compliance_check") == "Pass"
+    if passed and (rerender or not values.get("garden_image_url")):
+        # Mark generate_final_output as the last completed node, so only create_garden_image runs
+        logger.info(f"Re-rendering the garden image of run {run_id}")
+        registry.counter("graph_runs.rerendered").inc()
+        graph.update_state(config, {"garden_image_url": "", "garden_image_variants": {}, "skipped_stages": []},
+                           as_node="generate_final_output")
+        return graph.invoke(None, config)
+
+    registry.counter("graph_runs.replayed").inc()
+    return values
+
+
+# Nodes that produce the garden analysis a re-plan reuses
+ANALYSIS_NODES = ("check_compliance", "analyze_garden_conditions", "analyze_image", "merge_image_findings")
+ANALYSIS_FIELDS = ("sun_exposure", "micro_climate", "hardscape_elements", "plant_iventory", "environment_factors")
+
+
+def analysis_complete(snapshot) -> bool:
+    """Return whether a stored run passed the compliance check and finished its garden analysis.
+
+    A run interrupted before or during the analysis (including the per-image fan-out) still
+    has an analysis node to run and empty analysis fields; re-planning it would plan from nothing.
+    """
+    values = snapshot.values
+    if values.get("compliance_check") != "Pass":
+        return False
+    if any(node in ANALYSIS_NODES for node in snapshot.next):
+        return False
+    return all(values.get(field) for field in ANALYSIS_FIELDS)
+
+
+def replan_run(graph, run_id: str, style_preferences: str, generate_image: bool = True,
+               language: Optional[str] = None, user_preferences: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Re-plan a stored run for new preferences, reusing its compliance check and analysis.
+
+    The run is rewound to just after analyze_garden_conditions, so only generate_final_output
+    and, if generate_image is set, create_garden_image and screen_recommendations run again.
+    Without an image the run stops before them (the returned recommendations are still
+    screened); resuming it later renders the image.
+
+    Args:
+        graph: The graph compiled with a checkpointer
+        run_id: The id of a stored run that passed the compliance check
+        style_preferences: The new style preferences
+        generate_image: Also generate a new garden image
+        language: New prompt language, or None to keep the run's language
+        user_preferences: The new structured preferences (for the plant shortlist), or None to keep them
+
+    Returns:
+        The final state of the re-planned run
+
+    Raises:
+        ValueError: If the run did not pass the compliance check or its analysis is incomplete
+    """
+    config = run_config(run_id)
+    if not analysis_complete(graph.get_state(config)):
+        raise ValueError(f"Run {run_id} did not pass the compliance check or its analysis is incomplete")
+    update = {
+        "style_preferences": style_preferences,
+        "plant_recommendations": [],
+        "garden_image_url": "",
+        "garden_image_variants": {},
+        "skipped_stages": [],
+    }
+    if language is not None:
+        update["language"] = language
+    if user_preferences is not None:
+        update["user_preferences"] = user_preferences
+    logger.info(f"Re-planning run {run_id}")
+    registry.counter("graph_runs.replanned").inc()
+    graph.update_state(config, update, as_node="analyze_garden_conditions")
+    if generate_image:
+        return graph.invoke(None, config)
+    values = graph.invoke(None, config, interrupt_after=["generate_final_output"])
+    # The graph screens the recommendations next to the image; without an image, screen them here
+    return {**values, **optional("screen_recommendations", screen_recommendations, 0.0)(values)}
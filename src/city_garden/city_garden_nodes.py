@@ -4,14 +4,24 @@ from typing import Dict, Any, List, TypedDict, Annotated, Optional
 import sys
 import os
 import json
-from datetime import datetime
 from azure.storage.blob import BlobClient
 import base64
 from io import BytesIO
 
 from city_garden.garden_state import GardenState
 from city_garden.tools.climate import get_monthly_average_temperature, get_monthly_precipitation, get_wind_pattern
-from city_garden.services.image_loader import AzureImageLoader
+from city_garden.tools.climate_derivation import climate_derivation_enabled, submit_climate_profile
+from city_garden.tools.wind_analysis import submit_wind_profile, wind_analysis_enabled
+from city_garden.tools.solar import solar_enabled, sun_profile
+from city_garden.tools.plant_index import format_candidates, plant_shortlist_from_env
+from city_garden.services.image_loader import AzureImageLoader, content_blob_name
+from city_garden.services.image_cache import GardenImageCache, garden_image_cache
+from city_garden.services.image_variants import image_variants_enabled, submit_variants, uploaded_variants, when_all_done
+from city_garden.services import image_prescreen
+from city_garden.image_store import image_store
+from city_garden.metrics import registry as metrics_registry
+from city_garden.logging_config import log_payload
+from city_garden.services.http_replay import azure_client_kwargs, async_openai_client_kwargs
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import HumanMessage, SystemMessage
 from dotenv import load_dotenv
@@ -21,11 +31,13 @@ from langchain_core.tracers import LangChainTracer
 from langchain_core.callbacks.manager import CallbackManager
 import re
 import logging
-from city_garden.llm import llm
+from city_garden.llm import llm, graph_llm_for
+from city_garden.cancellation import RunCancelled, call_timeout, check_cancelled, check_out_of_time, run_cancellable
+from city_garden.prompt_registry import prompt_registry
 logger = logging.getLogger(__name__)
 from io import BytesIO
 from base64 import b64decode
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 load_dotenv()
 
@@ -59,97 +71,108 @@ Node 5: Generate final output. Take garden_info and plant_recommendations and cr
 # [+] finalize the code
 # [+] integrate with the website
 
+# Answers of the compliance checker prompt (in every prompt language) that mean the images passed
+COMPLIANCE_PASS_ANSWERS = ("pass", "通过")
+
+
+def normalize_compliance_result(answer: str) -> str:
+    """Map the compliance checker's answer to "Pass" or "Fail"."""
+    answer = answer.strip().strip("'\"“”.。!！").strip().lower()
+    return "Pass" if answer in COMPLIANCE_PASS_ANSWERS else "Fail"
+
+
+def _image_parts(image_ids: List[str]) -> List[Dict[str, Any]]:
+    """Return the message content parts for stored images, as base64 data URLs."""
+    return [
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_store.get_base64(image_id)}"}}
+        for image_id in image_ids
+    ]
+
+
 def check_compliance(state: GardenState) -> GardenState:
     """
     Check compliance of the generated content.
     """
-    print("Checking compliance")
+    logger.info("Checking compliance")
     
-    system_prompt = """
-    You are a photo compliance inspector. Review the uploaded images and determine if they meet the following criteria:
-
-    - The images primarily show a balcony, a small garden, or an indoor/outdoor space suitable for growing plants.
+    # Static instructions go in the system message so the prompt prefix is cacheable
+    prompt = prompt_registry.get("compliance_checker", state.get("language"))
 
-    Respond only with 'Pass' or 'Fail' — no additional explanation is needed.
-    """
-
-    garden_image_contents = state["images"]
+    image_ids = state["image_ids"]
+    
+    # Optional local pre-screen: clear cases skip the LLM, otherwise only ambiguous images are sent
+    if os.environ.get("COMPLIANCE_PRESCREEN_ENABLED", "false").lower() == "true":
+        results = image_prescreen.prescreen_images([image_store.get(image_id) for image_id in image_ids])
+        verdict = image_prescreen.combine_verdicts(results)
+        metrics_registry.counter(f"compliance_prescreen.{verdict}").inc()
+        if verdict != image_prescreen.UNCERTAIN:
+            state["compliance_check"] = "Pass" if verdict == image_prescreen.PASS else "Fail"
+            logger.info(f"Compliance check (local pre-screen): {state['compliance_check']}")
+            return state
+        ambiguous = [image_id for image_id, result in zip(image_ids, results)
+                     if result.verdict == image_prescreen.UNCERTAIN]
+        metrics_registry.counter("compliance_prescreen.images_skipped").inc(len(image_ids) - len(ambiguous))
+        image_ids = ambiguous
     
     # Create message content with all images
     message_content = [{'type': 'text', 'text': f"Analyze the images."}]
-    for image_content in garden_image_contents:
-        message_content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{image_content}"
-            }
-        })
+    message_content.extend(_image_parts(image_ids))
     
     messages = [
-        SystemMessage(content=system_prompt),
+        SystemMessage(content=prompt.static_prefix),
         HumanMessage(content=message_content)
     ]  
     
-    response = llm.invoke(messages)
-    state["compliance_check"] = response.content
+    response = run_cancellable(llm.ainvoke(messages))
+    state["compliance_check"] = normalize_compliance_result(response.content)
     
-    print(f"Compliance check: {state['compliance_check']}")
+    logger.info(f"Compliance check: {state['compliance_check']}")
     
     return state
 
-def analyze_garden_conditions(state: GardenState) -> GardenState:
-    """
-    Analyze garden conditions based on garden images, compass information, location information.
-    Sets sun_exposure, micro_climate, hardscape_elements, and plant_inventory, environment_factors, wind_pattern.
-    Environment_factors and wind_pattern are retrieved from openweathermap api and weatherbit api.
-    """
-    print("Analyzing garden conditions")
-    # Get garden information from LLM
-    system_prompt = """
-    You are a geography expert specializing in environmental analysis for horticulture.
-    Based on several uploaded images taken from different angles, a photo of a compass, your task is to:
-    
-    - Identify the latitude, longitude and altitude information from the compass image for your analysis in the next step.
-    - Extract and analyze the key geographical and environmental features relevant to growing plants.
- 
-    Return a JSON object with the following fields, and don't add any other keys:
-    {
-        "sun_exposure": "<Description of sun exposure patterns based on orientation and shadows>"
-        "micro_climate": "<Note variations caused by buildings, trees, or structures that create unique temperature or moisture conditions within the site.>"
-        "hardscape_elements": "<Presence and impact of non-plant structures like walls, pavements, fences, etc.>"
-        "plant_inventory": "<Document existing plants, trees, and shrubs, including their health, size, and location. Decide which to retain, transplant, or remove.>"
-        "environmental_factors": "<Map existing structures such as patios, paths, fences, sheds, utilities (overhead and underground), and any other built features.>"
-        "wind_pattern": "<Prevailing wind directions, obstructions, and intensity patterns>"
-    }
-    
-    Make sure your analysis is practical and tailored to optimizing plant growth at the specified location.
+
+CLIMATE_DERIVATION_TIMEOUT_SECONDS = float(os.environ.get("CLIMATE_DERIVATION_TIMEOUT_SECONDS", "20"))
+
+
+def _location_result(future, state: GardenState, name: str):
+    """Wait for a background location analysis; None if it failed, the analysis is still usable without it."""
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=call_timeout(CLIMATE_DERIVATION_TIMEOUT_SECONDS))
+    except Exception as e:
+        check_cancelled()
+        logger.warning(f"{name} failed for {state['latitude']}, {state['longitude']}: {e!r}")
+        metrics_registry.counter(f"{name}.failed").inc()
+        return None
+
+
+def _start_location_analysis(state: Dict[str, Any]):
+    """Start the background climate and wind analyses and compute the sun path of the location.
+
+    Returns:
+        The climate and wind futures and the sun profile; each is None if not available
     """
-    
-    garden_image_contents = state["images"]
-    
-    print(f"Garden image contents loaded: {len(garden_image_contents)}")
+    climate = wind = sun = None
+    if state.get("latitude") is not None and state.get("longitude") is not None:
+        if climate_derivation_enabled():
+            climate = submit_climate_profile(state["latitude"], state["longitude"])
+        if wind_analysis_enabled():
+            wind = submit_wind_profile(state["latitude"], state["longitude"])
+        if solar_enabled() and state.get("facing"):
+            sun = sun_profile(state["latitude"], state["longitude"], state["facing"], state.get("horizon_angle"))
+    return climate, wind, sun
 
-    # Create message content with all images
-    message_content = [{'type': 'text', 'text': f"Analyze the images. The latitude and longitude are {state['latitude']} and {state['longitude']}."}]
-    for image_content in garden_image_contents:
-        message_content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{image_content}"
-            }
-        })
-    
-    messages = [
-        SystemMessage(content=system_prompt),
-        HumanMessage(content=message_content)
-    ] 
-    
-    response = llm.invoke(messages)
-    
-    print(f"Response: {response.content}")
-    
-    response_content = response.content
-    
+
+def _location_text(state: Dict[str, Any], sun) -> str:
+    text = f"The latitude and longitude are {state['latitude']} and {state['longitude']}."
+    if sun is not None:
+        text += f" The balcony faces {state['facing']}; computed sun path: {sun.describe()}."
+    return text
+
+
+def _apply_analysis(state: GardenState, response_content: str) -> None:
+    """Set the six analysis fields of the state from the analysis JSON of the LLM."""
     # Parse the response (in a real implementation, this would be more robust)
     # For simplicity, we'll extract the information from the text
     if "sun_exposure" in response_content:
@@ -172,8 +195,8 @@ def analyze_garden_conditions(state: GardenState) -> GardenState:
     else:
         state["plant_iventory"] = "None currently, new garden"
     
-    if "environment_factors" in response_content:
-        state["environment_factors"] = extract_value(response_content, "environment_factors")
+    if "environmental_factors" in response_content:
+        state["environment_factors"] = extract_value(response_content, "environmental_factors")
     else:
         state["environment_factors"] = "None, no inpput information"
     
@@ -181,16 +204,139 @@ def analyze_garden_conditions(state: GardenState) -> GardenState:
         state["wind_pattern"] = extract_value(response_content, "wind_pattern")
     else:
         state["wind_pattern"] = "None, no inpput information"
+
+
+def _apply_location_analysis(state: GardenState, climate, wind, sun) -> None:
+    """Add the computed sun path and the derived climate and wind to the analysis fields."""
+    if sun is not None:
+        state["light_level"] = sun.light_level
+        state["sun_exposure"] = f"{state['sun_exposure']}\nComputed sun: {sun.describe()}"
+
+    climate_profile = _location_result(climate, state, "climate_derivation")
+    if climate_profile is not None:
+        state["hardiness_zone"] = climate_profile.hardiness_zone
+        state["environment_factors"] = f"{state['environment_factors']}\nClimate: {climate_profile.describe()}"
+
+    wind_profile = _location_result(wind, state, "wind_analysis")
+    if wind_profile is not None:
+        state["wind_exposure"] = wind_profile.exposure
+        state["wind_pattern"] = f"{state['wind_pattern']}\nMeasured wind: {wind_profile.describe()}"
+
+
+def analyze_garden_conditions(state: GardenState) -> GardenState:
+    """
+    Analyze garden conditions based on garden images, compass information, location information.
+    Sets sun_exposure, micro_climate, hardscape_elements, and plant_inventory, environment_factors, wind_pattern.
+    Environment_factors and wind_pattern are retrieved from openweathermap api and weatherbit api.
+    The hardiness zone, frost window and measured wind are derived from the Open-Meteo archive
+    while the LLM analyzes the images, and are added to environment_factors and wind_pattern.
+    When the balcony's facing is known, its direct-sun hours are computed from the sun path and
+    added to sun_exposure.
+    """
+    logger.info("Analyzing garden conditions")
+    climate, wind, sun = _start_location_analysis(state)
+    # Get garden information from LLM. The instructions are static; per-request data goes last.
+    prompt = prompt_registry.get("env_feature_extractor", state.get("language"))
+    
+    image_ids = state["image_ids"]
+    
+    logger.info(f"Garden images: {len(image_ids)}")
+
+    # Create message content with all images
+    message_content = [{'type': 'text', 'text': f"Analyze the images. {_location_text(state, sun)}"}]
+    message_content.extend(_image_parts(image_ids))
+    
+    messages = [
+        SystemMessage(content=prompt.static_prefix),
+        HumanMessage(content=message_content)
+    ] 
     
-    # Add a message about the analysis
+    response = run_cancellable(graph_llm_for("analyze_garden_conditions").ainvoke(messages))
+    
+    log_payload(logger, "Garden analysis response", response.content)
+    
+    _apply_analysis(state, response.content)
+    _apply_location_analysis(state, climate, wind, sun)
+    
+    # Add a message about the analysis; the extracted fields are already in the state
     state["messages"].append({
         "role": "assistant",
-        "content": f"I've analyzed your garden conditions based on the provided information. {response_content}"
+        "content": "I've analyzed your garden conditions based on the provided information."
     })
     
     return state
 
 
+def image_tasks(state: GardenState) -> List[Dict[str, Any]]:
+    """Return the inputs of the analyze_image fan-out: one per image, with the location it needs."""
+    image_ids = state["image_ids"]
+    return [
+        {
+            "image_id": image_id,
+            "index": index,
+            "count": len(image_ids),
+            "latitude": state.get("latitude"),
+            "longitude": state.get("longitude"),
+            "facing": state.get("facing"),
+            "horizon_angle": state.get("horizon_angle"),
+            "language": state.get("language"),
+        }
+        for index, image_id in enumerate(image_ids)
+    ]
+
+
+def analyze_image(task: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Analyze one garden image; a branch of the per-image fan-out (GARDEN_ANALYSIS_FANOUT).
+    Returns only this image's findings, which the image_findings reducer merges.
+    """
+    logger.info(f"Analyzing image {task['index'] + 1} of {task['count']}")
+    # Start the shared location fetches now, so they overlap with the image calls
+    _, _, sun = _start_location_analysis(task)
+    prompt = prompt_registry.get("image_analyzer", task.get("language"))
+
+    message_content = [{'type': 'text', 'text': f"Analyze photo {task['index'] + 1} of {task['count']}. {_location_text(task, sun)}"}]
+    message_content.extend(_image_parts([task["image_id"]]))
+    messages = [
+        SystemMessage(content=prompt.static_prefix),
+        HumanMessage(content=message_content)
+    ]
+
+    response = run_cancellable(graph_llm_for("analyze_image").ainvoke(messages))
+    return {"image_findings": {task["image_id"]: response.content}}
+
+
+def merge_image_findings(state: GardenState) -> GardenState:
+    """
+    Merge the per-image findings into the six analysis fields with a text-only LLM call, then add
+    the location analysis like analyze_garden_conditions does.
+    """
+    logger.info("Merging image findings")
+    climate, wind, sun = _start_location_analysis(state)
+    prompt = prompt_registry.get("image_findings_merger", state.get("language"))
+
+    findings = state.get("image_findings") or {}
+    findings_text = "\n\n".join(f"Photo {index + 1}:\n{findings[image_id]}"
+                                 for index, image_id in enumerate(state["image_ids"]) if image_id in findings)
+    messages = [
+        SystemMessage(content=prompt.static_prefix),
+        HumanMessage(content=prompt.render_dynamic(findings=findings_text))
+    ]
+
+    response = run_cancellable(graph_llm_for("merge_image_findings").ainvoke(messages))
+    log_payload(logger, "Merged garden analysis response", response.content)
+
+    _apply_analysis(state, response.content)
+    _apply_location_analysis(state, climate, wind, sun)
+
+    state["messages"].append({
+        "role": "assistant",
+        "content": "I've analyzed your garden conditions based on the provided information."
+    })
+
+    return state
+
+
 def generate_final_output(state: GardenState) -> GardenState:
     """
     Generate final output. Take garden_info and plant_recommendations and create a final output. 
@@ -201,7 +347,7 @@ def generate_final_output(state: GardenState) -> GardenState:
     - Design Recommendations
     - Conclusion
     """
-    print("Generating final output")
+    logger.info("Generating final output")
     # Get garden information from state
     garden_info = f"""
     Sun exposure: {state.get('sun_exposure', 'Not analyzed')}
@@ -215,103 +361,90 @@ def generate_final_output(state: GardenState) -> GardenState:
     # User's preferences
     preferences = state.get('style_preferences', 'Not analyzed')
     
-    # Create a prompt for the LLM to generate a structured report
-    system_prompt = """
-    You are a botany expert. Your task is to recommend suitable plants for someone who wants to create a small garden on their balcony. Please consider the following environmental conditions and preferences:
-
-    ### User's preferences:
-    {preferences}
-
-    ### Environment information:
-    {garden_info}
-
-    Based on this context, please generate a list of at least 3 suitable plants that would thrive in these conditions following the JSON structure below:
-    {
-      "plant_recommendations": [
-        {
-          "id": 0,
-          "name": "<plantA>",
-          "description": "<A description of plantA.>",
-          "care_tips": "<Care tips of plantA.>"
-        },
-        {
-          "id": 1,
-          "name": "<plantB>",
-          "description": "<A description of plantB.>",
-          "care_tips": "<Care tips of plantB.>"
-        },
-        {
-          "id": 2,
-          "name": "<plantC>",
-          "description": "<A description of plantC.>",
-          "care_tips": "<Care tips of plantC.>"
-        },
-        ...
-      ]
-    }
-    The JSON should start with key "plant_recommendations" and end with key "}"
-    """
+    # Shortlist plants from the local index, so the model ranks candidates instead of inventing plants
+    candidates = plant_shortlist_from_env(
+        state.get('user_preferences'),
+        sun_exposure=state.get('sun_exposure') or "",
+        wind_pattern=state.get('wind_pattern') or "",
+        hardiness_zone=state.get('hardiness_zone'),
+        wind_exposure=state.get('wind_exposure'),
+        light_level=state.get('light_level')
+    )
+    metrics_registry.histogram("plant_index.candidates").observe(len(candidates))
+    
+    # Static instructions first and per-request data last, so the prompt prefix is cacheable
+    prompt = prompt_registry.get("plant_recommender", state.get("language"))
     
     messages = [
-        SystemMessage(content=system_prompt),
-        HumanMessage(content=f"""
-        Create a comprehensive garden design report based on the following information:
-        
-        GARDEN INFORMATION:
-        {garden_info}
-        
-        USER PREFERENCES:
-        {preferences}
-        
-        Please structure the report with the sections mentioned in the system prompt.
-        """)
+        SystemMessage(content=prompt.static_prefix),
+        HumanMessage(content=prompt.render_dynamic(preferences=preferences, report=garden_info,
+                                                   candidates=format_candidates(candidates) or "-"))
     ]
     
     # Generate the final report
-    response = llm.invoke(messages)
+    response = run_cancellable(graph_llm_for("generate_final_output").ainvoke(messages))
     final_report = response.content
     
     #print(f"Final report: {final_report}")
     
     if "plant_recommendations" in final_report:
         state["plant_recommendations"] = json.loads(final_report)["plant_recommendations"]
-        print(f"Plant Recommendations: {state['plant_recommendations']}")
+        logger.info(f"Generated {len(state['plant_recommendations'])} plant recommendations")
+        log_payload(logger, "Plant recommendations", state['plant_recommendations'])
     else:
         state["plant_recommendations"] = "None, no information"
     
     # Store the final report in the state
     state["final_output"] = final_report
     
-    # Add the final report to the messages
+    # The report itself is in final_output, the messages don't keep a second copy
     state["messages"].append({
         "role": "assistant",
         "content": "I've generated a comprehensive garden design report for you."
     })
     
-    state["messages"].append({
-        "role": "assistant",
-        "content": final_report
-    })
-    
     return state
 
 
+GARDEN_IMAGE_MODEL = "gpt-image-1"
+GARDEN_IMAGE_TIMEOUT_SECONDS = float(os.environ.get("GARDEN_IMAGE_TIMEOUT_SECONDS", "180"))
+
+
+def _plant_names(plant_recommendations: Any) -> str:
+    """Return the recommended plant names as a comma-separated list for the image prompt."""
+    if not isinstance(plant_recommendations, list):
+        return str(plant_recommendations)
+    return ", ".join(str(plant.get("name", plant)) if isinstance(plant, dict) else str(plant)
+                     for plant in plant_recommendations)
+
+
 def create_garden_image(state: GardenState) -> GardenState:
     """
     Create a garden image based on the garden information and plant recommendations. The image should be in colorful hand-drawn style.
     The image is created by LLM. For debugging, the image is shown.
+    Designs with the same input images and plants are served from the garden image cache.
+    Resized WebP/AVIF variants are rendered and uploaded in the background; their srcsets are
+    returned in garden_image_variants.
+    Runs in parallel with screen_recommendations, so it only returns the garden image updates.
     """
     
     load_dotenv()
 
-    def generate_image_with_gpt(balcony_description: str, image_files: List[BytesIO]) -> Optional[str]:
-        client = OpenAI()
-        try:
-            response = client.images.edit(
-                model="gpt-image-1",
+    async def edit_image(balcony_description: str, image_files: List[BytesIO]):
+        # Each attempt gets at most the run's remaining budget
+        async with AsyncOpenAI(timeout=call_timeout(GARDEN_IMAGE_TIMEOUT_SECONDS), **async_openai_client_kwargs()) as client:
+            return await client.images.edit(
+                model=GARDEN_IMAGE_MODEL,
                 image=image_files,
                 prompt=balcony_description
             )
+
+    def generate_image_with_gpt(balcony_description: str, image_files: List[BytesIO],
+                                cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Generate and upload the garden image and its variants. Returns the state update, or None on failure."""
+        try:
+            # Run as a coroutine so a cancelled run aborts the request
+            response = run_cancellable(edit_image(balcony_description, image_files))
             
             # with open("balcony.png", "wb") as file:
             #     file.write(b64decode(response.data[0].b64_json))
@@ -323,59 +456,88 @@ def create_garden_image(state: GardenState) -> GardenState:
                 account_key=os.environ["AZURE_STORAGE_ACCOUNT_KEY"]
             )
             
-            image_content = response.data[0].b64_json
-            blob_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}-garden_image.png"
+            image_bytes = b64decode(response.data[0].b64_json)
+            del response
+            check_cancelled("upload_garden_image")
+            
+            # Content-addressed name: the URL is known before the upload finishes,
+            # and identical outputs map to the same blob
+            image_url, upload = image_loader.upload_image_async(image_bytes, "images", content_blob_name(image_bytes))
             
-            image_url = image_loader.upload_image(b64decode(image_content), "images", blob_name)
-            state["garden_image_url"] = image_url
+            variants, variant_uploads = {}, {}
+            if image_variants_enabled():
+                try:
+                    variants, variant_uploads = submit_variants(image_loader, image_bytes, "images")
+                except Exception as err:
+                    # The full-size image is still usable
+                    logger.warning(f"Could not render the garden image variants: {err}")
+            del image_bytes
             
-            print(f"Garden image URL: {state['garden_image_url']}")
+            # Only cache the URL once the blob actually exists, with the variants that were uploaded
+            if cache_key is not None and garden_image_cache is not None:
+                def cache_uploaded():
+                    if not upload.cancelled() and upload.exception() is None:
+                        garden_image_cache.set(cache_key, image_url, uploaded_variants(variants, variant_uploads))
+                when_all_done([upload, *variant_uploads.values()], cache_uploaded)
             
-            return image_content
+            logger.info(f"Garden image URL: {image_url}")
+            
+            return {"garden_image_url": image_url, "garden_image_variants": variants}
         
+        except RunCancelled:
+            raise
         except Exception as err:
-            print("Error generating image:", err)
+            # A client timeout at the deadline means the stage ran out of time (reported in skipped_stages)
+            check_out_of_time(err, "create_garden_image")
+            logger.warning(f"Error generating image: {err}")
             return None
     
     
     # Get garden information from state
-    garden_image_contents = state.get('images', 'Not analyzed')
+    image_ids = state.get('image_ids', [])
     plant_recommendations = state.get('plant_recommendations', 'Not analyzed')
+    prompt = prompt_registry.get("sketch_generator", state.get("language"))
+    
+    cache_key = None
+    if garden_image_cache is not None:
+        # Changing the prompt or the model invalidates cached images
+        prompt_version = f"{GARDEN_IMAGE_MODEL}:{prompt.version}"
+        cache_key = GardenImageCache.make_key(image_ids, plant_recommendations, prompt_version)
+        cached = garden_image_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            logger.info(f"Garden image served from cache: {cached.url}")
+            return {"garden_image_url": cached.url, "garden_image_variants": cached.variants}
     
     # Wrap loaded Azure images as file-like objects
-    print("Wrapping loaded Azure images as file-like objects")
+    logger.debug("Wrapping loaded Azure images as file-like objects")
     image_files = []
-    for idx, img_bytes in enumerate(garden_image_contents):
-        bio = BytesIO(base64.b64decode(img_bytes))
+    for idx, image_id in enumerate(image_ids):
+        bio = BytesIO(image_store.get(image_id))
         bio.name = f"image_{idx}.jpeg"  # <-- Give it a filename with proper extension!
         image_files.append(bio)
 
-    system_prompt = f"""
-    You are a professional image editor. Given multiple uploaded images taken from different angles of a balcony and a list of plants, your task is to:
-
-    - Generate an image that shows the visual effect of growing some or all of the listed plants within the provided scenes.
-    - Do not modify any other parts of the original images.
-    - Keep the image in colorful sketch style.
-    
-    ### Plants to be grown:
-    {plant_recommendations}
-    """
+    system_prompt = prompt.render(plants=_plant_names(plant_recommendations))
 
-    print("Generating image with GPT")
+    unchanged = {"garden_image_url": state.get("garden_image_url", ""),
+                 "garden_image_variants": state.get("garden_image_variants") or {}}
+    logger.info("Generating image with GPT")
     try:
-        response = generate_image_with_gpt(balcony_description=system_prompt, image_files=image_files)
-        if response is None:
-            print("Error: Failed to generate image with GPT")
-            return state
+        update = generate_image_with_gpt(balcony_description=system_prompt, image_files=image_files, cache_key=cache_key)
+        if update is None:
+            logger.error("Failed to generate image with GPT")
+            return unchanged
             
-        print("Image generated successfully with GPT")
-        state["garden_image"] = response
+        logger.info("Image generated successfully with GPT")
             
+    except RunCancelled:
+        raise
     except Exception as e:
-        print(f"Error during GPT image generation: {str(e)}")
-        return state
+        check_out_of_time(e, "create_garden_image")
+        logger.error(f"Error during GPT image generation: {str(e)}")
+        return unchanged
             
-    return state
+    return update
+
 
 def extract_value(text: str, key: str) -> Optional[str]:
     """Extract a value from text using JSON parsing.
@@ -436,7 +598,8 @@ def upload_image(image_content: str, container_name: str, blob_name: str) -> str
         account_url=f"https://{os.environ['AZURE_STORAGE_ACCOUNT_NAME']}.blob.core.windows.net",
         container_name=container_name,
         blob_name=blob_name,
-        credential=os.environ['AZURE_STORAGE_ACCOUNT_KEY']
+        credential=os.environ['AZURE_STORAGE_ACCOUNT_KEY'],
+        **azure_client_kwargs()
     )
     
     # Convert base64 to bytes and upload
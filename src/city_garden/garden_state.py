@@ -3,9 +3,27 @@ import os
 from typing import TypedDict, List, Dict, Any, Optional
 
 
+def merge_findings(existing: Optional[Dict[str, str]], new: Optional[Dict[str, str]]) -> Dict[str, str]:
+    """Reducer of image_findings: the findings of parallel analyze_image branches, by image id.
+
+    Merging by key (not appending) keeps it idempotent for nodes that return the whole state.
+    """
+    return {**(existing or {}), **(new or {})}
+
+
+def merge_stages(existing: Optional[List[str]], new: Optional[List[str]]) -> List[str]:
+    """Reducer of skipped_stages: parallel branches (the garden image and the screening) may both
+    be skipped in the same step. An empty list resets it, e.g. before a re-render.
+    """
+    if not new:
+        return []
+    return list(dict.fromkeys([*(existing or []), *new]))
+
+
 class GardenState(TypedDict):
     """State of the garden. It has "sun_exposure, "micro_climate", "hardscape_elements", "plant_iventory", 
     "environment_factors", "wind_pattern", "style_preferences". Each of these has a string value.
+    The input images are referenced by id; their bytes live in the image store (city_garden.image_store).
     """
     sun_exposure: str
     micro_climate: str
@@ -14,13 +32,23 @@ class GardenState(TypedDict):
     environment_factors: str
     wind_pattern: Optional[str]
     style_preferences: str
+    user_preferences: Dict[str, str]
+    hardiness_zone: Optional[int]
+    wind_exposure: Optional[str]
     plant_recommendations: List[Dict[Any, Any]]
     location: str
     latitude: float
     longitude: float
+    facing: Optional[str]
+    horizon_angle: Optional[float]
+    light_level: Optional[str]
     final_output: str
     compliance_check: str
-    garden_image: str
     garden_image_url: str
-    images: List[str]
+    garden_image_variants: Dict[str, str]
+    image_urls: List[str]
+    image_ids: List[str]
+    image_findings: Annotated[Dict[str, str], merge_findings]
+    language: str
+    skipped_stages: Annotated[List[str], merge_stages]
     messages: List[Dict[str, Any]]
\ No newline at end of file
@@ -1,29 +1,90 @@
+import functools
+import os
 from langgraph.graph import StateGraph, START, END
+from langgraph.types import Send
 from city_garden.garden_state import GardenState
-from city_garden.city_garden_nodes import analyze_garden_conditions, generate_final_output, check_compliance, create_garden_image
+from city_garden.city_garden_nodes import (analyze_garden_conditions, generate_final_output, check_compliance,
+                                           create_garden_image, analyze_image, image_tasks, merge_image_findings)
+from city_garden.services.text_screening import screen_recommendations
+from city_garden.metrics import registry as metrics_registry
+from city_garden.cancellation import cancellable, optional
 
-def build_garden_graph():
+
+def _timed(name, node):
+    """Wrap a node so its duration is recorded in the stage.<name>.seconds histogram."""
+    @functools.wraps(node)
+    def timed_node(state):
+        with metrics_registry.timer(f"stage.{name}.seconds"):
+            return node(state)
+    return timed_node
+
+
+def _stage(name, node):
+    """Wrap a node with timing and a cancellation check at its start."""
+    return _timed(name, cancellable(name, node))
+
+
+def _optional_stage(name, node, min_budget):
+    """Like _stage, but the node is skipped instead of failing the run when time runs out."""
+    return _timed(name, optional(name, cancellable(name, node), min_budget))
+
+
+def _route_analysis(fanout):
+    """Route a checked run to the analysis: END if it failed, one analyze_image branch per image in
+    fan-out mode (with more than one image), otherwise analyze_garden_conditions."""
+    def route(state):
+        if state["compliance_check"] != "Pass":
+            return END
+        if fanout and len(state["image_ids"]) > 1:
+            return [Send("analyze_image", task) for task in image_tasks(state)]
+        return "analyze_garden_conditions"
+    return route
+
+
+def build_garden_graph(checkpointer=None, fanout=None):
+    """Build the garden planning graph.
+
+    Args:
+        checkpointer: Optional LangGraph checkpointer; runs are then resumable by thread id
+        fanout: Analyze each image in its own branch and merge the findings; defaults to
+            GARDEN_ANALYSIS_FANOUT
+    """
+    if fanout is None:
+        fanout = os.environ.get("GARDEN_ANALYSIS_FANOUT", "false").lower() == "true"
     garden_graph = StateGraph(GardenState)
     
-    garden_graph.add_node("check_compliance", check_compliance)
+    garden_graph.add_node("check_compliance", _stage("check_compliance", check_compliance))
 
-    garden_graph.add_node("analyze_garden_conditions", analyze_garden_conditions)
+    garden_graph.add_node("analyze_garden_conditions", _stage("analyze_garden_conditions", analyze_garden_conditions))
+    # Per-image map-reduce: the wall-clock time is bounded by the slowest image, not the combined payload
+    garden_graph.add_node("analyze_image", _stage("analyze_image", analyze_image))
+    garden_graph.add_node("merge_image_findings", _stage("merge_image_findings", merge_image_findings))
 
     # Add a node to generate final output
-    garden_graph.add_node("generate_final_output", generate_final_output)
-    garden_graph.add_node("create_garden_image", create_garden_image)
+    garden_graph.add_node("generate_final_output", _stage("generate_final_output", generate_final_output))
+    # The garden image is optional: without enough time left the plan is returned without it
+    image_min_budget = float(os.environ.get("GARDEN_IMAGE_MIN_BUDGET_SECONDS", "20"))
+    garden_graph.add_node("create_garden_image", _optional_stage("create_garden_image", create_garden_image, image_min_budget))
+    # Screens the generated text while the image is generated, off the critical path. Like a failed
+    # screening, one that runs out of time keeps the recommendations instead of failing the finished plan
+    garden_graph.add_node("screen_recommendations", _optional_stage("screen_recommendations", screen_recommendations, 0.0))
     # Define the parallel flow
     garden_graph.add_edge(START, "check_compliance")
     
-    # Define the conditional flow, if check_compliance passes, analyze_garden_conditions is executed, otherwise END is executed
+    # Define the conditional flow, if check_compliance passes, the images are analyzed, otherwise END is executed
     garden_graph.add_conditional_edges(
         "check_compliance",
-        lambda state: "analyze_garden_conditions" if state["compliance_check"] == "Pass" else END
+        _route_analysis(fanout),
+        ["analyze_garden_conditions", "analyze_image", END]
     )
 
     # Connect join node to final output
     garden_graph.add_edge("analyze_garden_conditions", "generate_final_output")
+    garden_graph.add_edge("analyze_image", "merge_image_findings")
+    garden_graph.add_edge("merge_image_findings", "generate_final_output")
     garden_graph.add_edge("generate_final_output", "create_garden_image")
+    garden_graph.add_edge("generate_final_output", "screen_recommendations")
     garden_graph.add_edge("create_garden_image", END)
+    garden_graph.add_edge("screen_recommendations", END)
 
-    return garden_graph.compile()
\ No newline at end of file
+    return garden_graph.compile(checkpointer=checkpointer)
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""
+Request hedging for LLM calls.
+
+A hedged call sends the request once and, if no response has arrived after an
+adaptive delay (a high percentile of recently observed latencies), sends a
+duplicate. The first successful completion wins and the other request is cancelled.
+The number of duplicates is capped by a token budget so hedging can only add a
+bounded fraction of extra cost.
+
+Latencies are kept per call site (e.g. per graph node): a vision call with several images
+takes much longer than a text-only call, and one shared percentile would hardly ever hedge
+the fast calls. The budget is shared by all call sites.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from langchain_core.language_models import BaseChatModel
+
+from city_garden.cancellation import run_cancellable
+from city_garden.metrics import percentile, registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CALL_SITE = "default"
+
+
+class HedgedLLM:
+    """Wraps a chat model so that slow calls are hedged with a duplicate request.
+
+    Args:
+        llm: The chat model to call
+        name: Name used as the metrics prefix
+        hedge_percentile: Latency percentile used as the hedge delay
+        min_delay: Lower bound for the hedge delay in seconds
+        max_delay: Upper bound for the hedge delay in seconds
+        initial_delay: Hedge delay used until enough latency samples are collected
+        min_samples: Number of samples needed before the delay becomes adaptive
+        budget_ratio: Maximum number of extra requests per call (e.g. 0.1 = 10% extra)
+        max_burst: Maximum number of hedges that can be saved up in the budget
+        window: Number of recent latencies kept for the percentile, per call site
+    """
+
+    def __init__(
+        self,
+        llm: BaseChatModel,
+        name: str = "llm",
+        hedge_percentile: float = 95.0,
+        min_delay: float = 0.5,
+        max_delay: float = 30.0,
+        initial_delay: float = 10.0,
+        min_samples: int = 20,
+        budget_ratio: float = 0.1,
+        max_burst: float = 5.0,
+        window: int = 200,
+    ):
+        self.llm = llm
+        self.name = name
+        self.hedge_percentile = hedge_percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.max_burst = max_burst
+        self.window = window
+
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._call_sites: Dict[str, "HedgedCallSite"] = {}
+        self._budget = 1.0
+        self._lock = threading.Lock()
+
+        self._calls = registry.counter(f"{name}.calls")
+        self._hedges = registry.counter(f"{name}.hedges")
+        self._hedge_wins = registry.counter(f"{name}.hedge_wins")
+        self._primary_wins = registry.counter(f"{name}.primary_wins")
+        self._budget_denied = registry.counter(f"{name}.hedge_budget_denied")
+        self._hedge_rate = registry.gauge(f"{name}.hedge_rate")
+        self._latency = registry.histogram(f"{name}.latency_seconds")
+
+    def call_site(self, call_site: str) -> "HedgedCallSite":
+        """Return the model for one call site, which keeps its own latency window."""
+        with self._lock:
+            if call_site not in self._call_sites:
+                self._call_sites[call_site] = HedgedCallSite(self, call_site)
+            return self._call_sites[call_site]
+
+    def hedge_delay(self, call_site: str = DEFAULT_CALL_SITE) -> float:
+        """Return the current hedge delay of a call site in seconds."""
+        with self._lock:
+            samples = list(self._latencies.get(call_site, ()))
+        if len(samples) < self.min_samples:
+            return self.initial_delay
+        delay = percentile(samples, self.hedge_percentile)
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def invoke(self, messages: Any, call_site: str = DEFAULT_CALL_SITE, **kwargs: Any) -> Any:
+        """Invoke the model with hedging. Same interface as BaseChatModel.invoke.
+
+        The graph nodes are synchronous, so the hedged calls (which can be cancelled)
+        run on the shared background event loop.
+        """
+        return run_cancellable(self.ainvoke(messages, call_site, **kwargs))
+
+    async def ainvoke(self, messages: Any, call_site: str = DEFAULT_CALL_SITE, **kwargs: Any) -> Any:
+        """Async variant of invoke. Must be awaited on a running event loop."""
+        self._calls.inc()
+        self._refill_budget()
+
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self._timed(self.llm.ainvoke(messages, **kwargs), call_site))
+        pending = {primary}
+        hedge = None
+        delay = self.hedge_delay(call_site)
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                if self._take_budget():
+                    logger.info(f"{self.name}.{call_site}: no response after {delay:.2f}s, sending hedge request")
+                    self._hedges.inc()
+                    hedge = asyncio.ensure_future(self._timed(self.llm.ainvoke(messages, **kwargs), call_site))
+                    pending.add(hedge)
+                else:
+                    self._budget_denied.inc()
+
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedge:
+                        self._hedge_wins.inc()
+                        if primary in pending:
+                            # The primary that lost to its hedge took at least this long; leaving it out
+                            # would pull the percentile down to the calls that happened to be fast
+                            self._record(call_site, time.monotonic() - started)
+                    else:
+                        self._primary_wins.inc()
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            self._hedge_rate.set(self._hedges.value / max(1, self._calls.value))
+
+    async def _timed(self, coro: Any, call_site: str) -> Any:
+        # Only completed calls are recorded; a call abandoned with the request (a disconnect or
+        # the deadline) says nothing about how long the model takes
+        start = time.monotonic()
+        result = await coro
+        self._record(call_site, time.monotonic() - start)
+        return result
+
+    def _record(self, call_site: str, elapsed: float) -> None:
+        with self._lock:
+            if call_site not in self._latencies:
+                self._latencies[call_site] = deque(maxlen=self.window)
+            self._latencies[call_site].append(elapsed)
+        self._latency.observe(elapsed)
+
+    def _refill_budget(self) -> None:
+        with self._lock:
+            self._budget = min(self.max_burst, self._budget + self.budget_ratio)
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self._budget >= 1.0:
+                self._budget -= 1.0
+                return True
+            return False
+
+
+class HedgedCallSite:
+    """A HedgedLLM bound to one call site; has the invoke/ainvoke interface of a chat model."""
+
+    def __init__(self, hedged: HedgedLLM, call_site: str):
+        self.hedged = hedged
+        self.call_site = call_site
+
+    def hedge_delay(self) -> float:
+        return self.hedged.hedge_delay(self.call_site)
+
+    def invoke(self, messages: Any, **kwargs: Any) -> Any:
+        return self.hedged.invoke(messages, self.call_site, **kwargs)
+
+    async def ainvoke(self, messages: Any, **kwargs: Any) -> Any:
+        return await self.hedged.ainvoke(messages, self.call_site, **kwargs)
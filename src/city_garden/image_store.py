@@ -0,0 +1,185 @@
+"""
+Side store for the input images of garden plan runs.
+
+The graph state only carries image ids (the SHA-256 of the image bytes); the images
+themselves are held here once, as raw bytes rather than base64, and reference counted:
+each request that uses an image holds a reference and releases it when it finishes, so
+an image is freed as soon as no in-flight run needs it. Nodes decode or encode an image
+only for the call that needs it.
+
+With GRAPH_CHECKPOINT_ENABLED=true the images are also written to the checkpoint
+database, once per content, so stored runs can be resumed by any worker or after a
+restart while the checkpoints themselves stay small. They are deleted with the runs that
+reference them (see checkpointing.prune_runs).
+"""
+import base64
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from city_garden.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+def image_id(image_bytes: bytes) -> str:
+    """Return the id of an image: the hex SHA-256 of its bytes."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ImageStore:
+    """Reference-counted, in-memory store of image bytes keyed by image id.
+
+    Args:
+        persist_path: Optional SQLite database where images are also persisted; images
+            missing from memory are loaded from it
+    """
+
+    def __init__(self, persist_path: Optional[str] = None):
+        self.persist_path = persist_path
+        self._images: Dict[str, bytes] = {}
+        self._refcounts: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._connection_pid: Optional[int] = None
+        self._bytes_gauge = registry.gauge("image_store.bytes")
+        self._images_gauge = registry.gauge("image_store.images")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Called with self._lock held; one connection per process, like SqliteImageCache
+        if self._connection is None or self._connection_pid != os.getpid():
+            connection = sqlite3.connect(self.persist_path, timeout=10, check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS run_images "
+                               "(id TEXT PRIMARY KEY, data BLOB NOT NULL, stored_at REAL NOT NULL DEFAULT 0)")
+            if "stored_at" not in {row[1] for row in connection.execute("PRAGMA table_info(run_images)")}:
+                # Databases from before pruning; their images count as old, but are kept while a run references them
+                try:
+                    connection.execute("ALTER TABLE run_images ADD COLUMN stored_at REAL NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    pass  # Added by another worker in the meantime
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _update_gauges(self) -> None:
+        self._bytes_gauge.set(self._bytes)
+        self._images_gauge.set(len(self._images))
+
+    def put(self, image_bytes: bytes) -> str:
+        """Add an image and take a reference to it. Returns the image id."""
+        key = image_id(image_bytes)
+        with self._lock:
+            self._refcounts[key] = self._refcounts.get(key, 0) + 1
+            if key not in self._images:
+                self._images[key] = image_bytes
+                self._bytes += len(image_bytes)
+                if self.persist_path is not None:
+                    self._connect().execute("INSERT INTO run_images (id, data, stored_at) VALUES (?, ?, ?) "
+                                            "ON CONFLICT (id) DO UPDATE SET stored_at = excluded.stored_at",
+                                            (key, image_bytes, time.time()))
+            self._update_gauges()
+        return key
+
+    def put_base64(self, image_contents: Iterable[str]) -> List[str]:
+        """Add images given as base64 strings and take a reference to each. Returns their ids."""
+        return [self.put(base64.b64decode(image_content)) for image_content in image_contents]
+
+    def acquire(self, image_ids: Iterable[str]) -> None:
+        """Take a reference to images that are already stored, e.g. by a resumed run."""
+        with self._lock:
+            for key in image_ids:
+                self._refcounts[key] = self._refcounts.get(key, 0) + 1
+
+    def release(self, image_ids: Iterable[str]) -> None:
+        """Drop a reference to each image; images without references are freed."""
+        with self._lock:
+            for key in image_ids:
+                count = self._refcounts.get(key, 0) - 1
+                if count > 0:
+                    self._refcounts[key] = count
+                    continue
+                self._refcounts.pop(key, None)
+                image_bytes = self._images.pop(key, None)
+                if image_bytes is not None:
+                    self._bytes -= len(image_bytes)
+            self._update_gauges()
+
+    @contextmanager
+    def hold(self, image_ids: List[str]) -> Iterator[List[str]]:
+        """Hold a reference to images for the duration of the block."""
+        self.acquire(image_ids)
+        try:
+            yield image_ids
+        finally:
+            self.release(image_ids)
+
+    def get(self, key: str) -> bytes:
+        """Return the bytes of an image.
+
+        Raises:
+            KeyError: If the image is neither in memory nor in the persistent store
+        """
+        with self._lock:
+            image_bytes = self._images.get(key)
+            if image_bytes is not None:
+                return image_bytes
+            if self.persist_path is not None:
+                row = self._connect().execute("SELECT data FROM run_images WHERE id = ?", (key,)).fetchone()
+                if row is not None:
+                    image_bytes = bytes(row[0])
+                    # Keep it in memory while a run references it
+                    if self._refcounts.get(key, 0) > 0:
+                        self._images[key] = image_bytes
+                        self._bytes += len(image_bytes)
+                        self._update_gauges()
+                    return image_bytes
+        raise KeyError(f"Image {key} is not stored")
+
+    def get_base64(self, key: str) -> str:
+        """Return an image as a base64 string, e.g. for a data URL."""
+        return base64.b64encode(self.get(key)).decode("utf-8")
+
+    def prune(self, keep: Set[str], stored_before: float) -> int:
+        """Delete persisted images stored before a time, except those in keep or held in this process.
+
+        Args:
+            keep: Ids of the images referenced by stored runs
+            stored_before: time.time() cutoff; newer images may belong to runs without a checkpoint yet
+
+        Returns:
+            The number of deleted images
+        """
+        if self.persist_path is None:
+            return 0
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute("SELECT id FROM run_images WHERE stored_at < ?", (stored_before,)).fetchall()
+            expired = [(key,) for (key,) in rows if key not in keep and key not in self._refcounts]
+            connection.executemany("DELETE FROM run_images WHERE id = ?", expired)
+        return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"images": len(self._images), "bytes": self._bytes,
+                    "references": sum(self._refcounts.values()), "persist_path": self.persist_path}
+
+
+def create_image_store_from_env() -> ImageStore:
+    """Create the image store; images are persisted next to the graph checkpoints when those are enabled."""
+    load_dotenv()
+    if os.environ.get("GRAPH_CHECKPOINT_ENABLED", "false").lower() != "true":
+        return ImageStore()
+    return ImageStore(persist_path=os.environ.get("GRAPH_CHECKPOINT_PATH", "graph_checkpoints.sqlite3"))
+
+
+image_store = create_image_store_from_env()
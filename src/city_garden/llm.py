@@ -5,6 +5,8 @@ from langsmith import Client
 from langchain_core.tracers import LangChainTracer
 from langchain_core.callbacks.manager import CallbackManager
 from city_garden.tools.climate import get_monthly_average_temperature, get_monthly_precipitation, get_wind_pattern
+from city_garden.hedging import HedgedLLM
+from city_garden.services.http_replay import chat_model_kwargs
 
 load_dotenv()
 #verify env variables
@@ -16,9 +18,11 @@ llm = AzureChatOpenAI(
     api_version="2024-12-01-preview",  # or your api version
     temperature=0,
     max_tokens=None,
-    timeout=None,
+    # Per attempt; graph runs additionally bound every call by their remaining deadline
+    timeout=float(os.environ.get("LLM_TIMEOUT_SECONDS", "120")),
     max_retries=2,
     # other params...
+    **chat_model_kwargs(),
 )
 # Set up LangSmith tracing if API key is available
 tracing_enabled = os.environ.get("LANGCHAIN_API_KEY") is not None
@@ -33,3 +37,24 @@ if tracing_enabled:
 
 tools = [get_monthly_average_temperature, get_monthly_precipitation, get_wind_pattern]
 llm.bind_tools(tools, parallel_tool_calls=False)
+
+# Optional request hedging for the graph LLM calls to cut tail latency.
+# A duplicate request is sent when a call is slower than the configured latency percentile,
+# and the number of duplicates is capped by LLM_HEDGING_BUDGET_RATIO (extra requests per call).
+hedging_enabled = os.environ.get("LLM_HEDGING_ENABLED", "false").lower() == "true"
+if hedging_enabled:
+    graph_llm = HedgedLLM(
+        llm,
+        name="graph_llm",
+        hedge_percentile=float(os.environ.get("LLM_HEDGING_PERCENTILE", "95")),
+        min_delay=float(os.environ.get("LLM_HEDGING_MIN_DELAY", "0.5")),
+        max_delay=float(os.environ.get("LLM_HEDGING_MAX_DELAY", "30")),
+        budget_ratio=float(os.environ.get("LLM_HEDGING_BUDGET_RATIO", "0.1")),
+    )
+else:
+    graph_llm = llm
+
+
+def graph_llm_for(call_site: str):
+    """Return the graph LLM for a call site (a graph node); hedged calls keep a latency window per call site."""
+    return graph_llm.call_site(call_site) if hedging_enabled else graph_llm
@@ -0,0 +1,234 @@
+"""
+Structured, non-blocking logging for the city garden project.
+
+configure_logging() routes all log records through a QueueHandler: the logging call only
+formats the message and puts the record on a queue, and a QueueListener thread writes it
+to stderr (as one JSON object per line by default). A slow terminal or pipe therefore no
+longer adds latency to the requests. When the queue is full, records are dropped and counted
+(logging.dropped) rather than blocking the caller.
+
+Every record carries the request id of the current context (set by the API's middleware and
+per batch item with use_request_id()), so the lines of one garden plan can be correlated
+across graph nodes and worker threads.
+
+Large payloads (LLM responses, climate DataFrames, recommendation lists) are logged with
+log_payload(): at DEBUG level, for a sample of the calls only, and truncated. The payload is
+not even converted to a string unless the record is sampled.
+
+Configuration (environment):
+    LOG_LEVEL: Root level (default INFO)
+    LOG_LEVELS: Per-logger levels, e.g. "city_garden.tools=DEBUG,azure=WARNING"
+    LOG_FORMAT: json or text
+    LOG_QUEUE_SIZE: Maximum number of records waiting to be written
+    LOG_PAYLOAD_SAMPLE_RATE: Fraction of log_payload() calls that are logged
+    LOG_PAYLOAD_MAX_CHARS: Payloads are truncated to this many characters
+"""
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import random
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional
+
+from city_garden.metrics import registry
+
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "2000"))
+# The Azure SDK and httpx (httpx2 in the openai client) log every HTTP request at INFO,
+# urllib3 (under requests, e.g. the Open-Meteo client) every redirect
+DEFAULT_LOG_LEVELS = "azure=WARNING,httpx=WARNING,httpx2=WARNING,urllib3=WARNING"
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(request_id)s]: %(message)s"
+
+_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("city_garden_request_id", default="-")
+
+# Attributes of every LogRecord; any other attribute was passed with extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_listener_pid: Optional[int] = None
+_listener_lock = threading.Lock()
+_output_handler: Optional[logging.Handler] = None
+
+
+def current_request_id() -> str:
+    """Return the request id of the current context ("-" outside a request)."""
+    return _request_id.get()
+
+
+@contextmanager
+def use_request_id(request_id: str) -> Iterator[str]:
+    """Tag the log records of the block (and of threads started from it) with a request id."""
+    token = _request_id.set(request_id)
+    try:
+        yield request_id
+    finally:
+        _request_id.reset(token)
+
+
+class RequestIdFilter(logging.Filter):
+    """Add the current request id to each record, on the thread that logs it."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _ProcessQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that never blocks and follows its process across forks.
+
+    The listener thread does not survive a fork (e.g. of the preloaded app into the API
+    workers), so the first record of a new process starts that process's own listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments and traceback into the record here; they may not be picklable or
+        # may change before the listener gets to them. Unlike the base class, the message is not
+        # formatted with the exception, so the output formatter keeps them apart.
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if _listener_pid != os.getpid():
+            _start_listener(self)
+        elif _listener is None:
+            # Stopped at exit: write the record directly
+            _output_handler.handle(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            registry.counter("logging.dropped").inc()
+
+
+def _start_listener(handler: _ProcessQueueHandler) -> None:
+    global _listener, _listener_pid
+    with _listener_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            return
+        if _listener_pid != os.getpid():
+            # Write the remaining records at exit; a Finalize also runs in multiprocessing
+            # workers, which exit without calling the atexit handlers
+            multiprocessing.util.Finalize(None, _stop_listener, exitpriority=-10)
+        # A new queue: a forked parent's may hold records that will never be written here
+        handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(handler.queue, _output_handler, respect_handler_level=True)
+        _listener.start()
+        _listener_pid = os.getpid()
+
+
+def _stop_listener() -> None:
+    global _listener
+    with _listener_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            _listener.stop()
+            _listener = None
+
+
+def parse_levels(value: str) -> Dict[str, str]:
+    """Parse "logger=LEVEL,..." into a dict of logger names and level names."""
+    levels = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, separator, level = item.partition("=")
+        if not separator or not name.strip():
+            raise ValueError(f"Invalid log level setting '{item}', expected <logger>=<LEVEL>")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level: Optional[str] = None, log_format: Optional[str] = None) -> None:
+    """Route the root logger through the queue handler, configured from the environment.
+
+    Replaces the root logger's handlers, so it can be called again (e.g. in the initializer of
+    pool worker processes). Loggers with their own handlers, like uvicorn's, are not changed.
+
+    Args:
+        level: Root level, overriding LOG_LEVEL
+        log_format: json or text, overriding LOG_FORMAT
+    """
+    global _output_handler
+    level = (level or os.environ.get("LOG_LEVEL", "INFO")).upper()
+    log_format = (log_format or os.environ.get("LOG_FORMAT", "json")).lower()
+    if log_format not in ("json", "text"):
+        raise ValueError(f"Unsupported LOG_FORMAT '{log_format}', expected json or text")
+
+    _stop_listener()
+    _output_handler = logging.StreamHandler(sys.stderr)
+    _output_handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+
+    handler = _ProcessQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+        existing.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in parse_levels(os.environ.get("LOG_LEVELS", DEFAULT_LOG_LEVELS)).items():
+        logging.getLogger(name).setLevel(logger_level)
+    _start_listener(handler)
+
+
+def log_payload(logger: logging.Logger, message: str, payload: Any,
+                sample_rate: Optional[float] = None, max_chars: Optional[int] = None) -> None:
+    """Log a large payload at DEBUG level for a sample of the calls.
+
+    Args:
+        logger: The module's logger
+        message: What the payload is, e.g. "Garden analysis response"
+        payload: Any object; converted with str() only if the record is logged
+        sample_rate: Fraction of the calls to log, overriding LOG_PAYLOAD_SAMPLE_RATE
+        max_chars: Truncate the payload to this many characters, overriding LOG_PAYLOAD_MAX_CHARS
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    rate = LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate < 1.0 and random.random() >= rate:
+        return
+    limit = LOG_PAYLOAD_MAX_CHARS if max_chars is None else max_chars
+    text = str(payload)
+    size = len(text)
+    if size > limit:
+        text = f"{text[:limit]}... ({size - limit} more characters)"
+    logger.debug(f"{message}: {text}", extra={"payload_chars": size})
@@ -0,0 +1,171 @@
+"""
+In-process metrics for the city garden project.
+
+Counters, gauges and histograms are kept in a process-wide registry and exposed
+as a JSON snapshot by the API (GET /api/metrics). run_timings() additionally collects
+the timed blocks of a single run, e.g. for the per-item timings of the batch runner.
+"""
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+# Durations of the timed blocks of the current run, see run_timings()
+_run_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("run_timings", default=None)
+_run_timings_lock = threading.Lock()
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Return the nearest-rank percentile of a list of samples.
+
+    Args:
+        samples: The observed values (unsorted)
+        pct: The percentile to compute, between 0 and 100
+
+    Returns:
+        The percentile value, or 0.0 if there are no samples
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Counter:
+    """A monotonically increasing counter."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Gauge:
+    """A value that can go up and down."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Histogram:
+    """Tracks count and sum of observations plus a bounded window of recent samples."""
+
+    def __init__(self, window: int = 1024):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._sum += value
+
+    def samples(self) -> List[float]:
+        with self._lock:
+            return list(self._samples)
+
+    def snapshot(self) -> Dict[str, float]:
+        samples = self.samples()
+        return {
+            "count": self._count,
+            "sum": self._sum,
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+        }
+
+
+class MetricsRegistry:
+    """Process-wide registry of named metrics."""
+
+    def __init__(self):
+        self._counters: Dict[str, Counter] = {}
+        self._gauges: Dict[str, Gauge] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str) -> Counter:
+        with self._lock:
+            return self._counters.setdefault(name, Counter())
+
+    def gauge(self, name: str) -> Gauge:
+        with self._lock:
+            return self._gauges.setdefault(name, Gauge())
+
+    def histogram(self, name: str) -> Histogram:
+        with self._lock:
+            return self._histograms.setdefault(name, Histogram())
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Observe the wall-clock duration of a block in the named histogram (in seconds)."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.histogram(name).observe(elapsed)
+            timings = _run_timings.get()
+            if timings is not None:
+                with _run_timings_lock:
+                    timings[name] = timings.get(name, 0.0) + elapsed
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return all metric values as a JSON-serializable dict."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = dict(self._histograms)
+        return {
+            "counters": {name: c.value for name, c in sorted(counters.items())},
+            "gauges": {name: g.value for name, g in sorted(gauges.items())},
+            "histograms": {name: h.snapshot() for name, h in sorted(histograms.items())},
+        }
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def run_timings() -> Iterator[Dict[str, float]]:
+    """Collect the durations (in seconds) of the registry timers in this block, by timer name.
+
+    Graph nodes run with a copy of the caller's context, so their stage timers are included.
+    Timers that run more than once (e.g. analyze_image for every image) are summed.
+    """
+    timings: Dict[str, float] = {}
+    token = _run_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _run_timings.reset(token)
@@ -0,0 +1,141 @@
+"""
+Prompt registry for the city garden project.
+
+Loads the prompt templates in prompts/*.yml once at startup. Each file holds one prompt
+in several languages under the keys "<file name>_<language>" (e.g. "plant_recommender_en").
+
+Templates are split into a static part (instructions, identical for every request) and a
+dynamic part (starting at the first "### <section>" heading that contains a placeholder).
+Sending the static part first and the per-request data last keeps the message prefix
+identical between requests, so provider-side prompt-prefix caching can reuse it.
+"""
+import hashlib
+import os
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+DEFAULT_PROMPTS_DIR = Path(__file__).resolve().parents[2] / "prompts"
+DEFAULT_LANGUAGE = os.environ.get("CITY_GARDEN_PROMPT_LANGUAGE", "en")
+SUPPORTED_LANGUAGES = ("en", "zh")
+
+# Only "{identifier}" is a placeholder, so JSON examples with braces are left untouched
+PLACEHOLDER_PATTERN = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+def _compile(text: str) -> Tuple[Tuple[str, Optional[str]], ...]:
+    """Split a template into (literal text, placeholder name or None) segments."""
+    segments: List[Tuple[str, Optional[str]]] = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(text):
+        segments.append((text[position:match.start()], match.group(1)))
+        position = match.end()
+    segments.append((text[position:], None))
+    return tuple(segments)
+
+
+def _split_static(text: str) -> Tuple[str, str]:
+    """Split a template into its static instructions and the dynamic per-request sections."""
+    match = PLACEHOLDER_PATTERN.search(text)
+    if match is None:
+        return text, ""
+    # The last line is the (partial) line holding the first placeholder
+    lines = text[:match.start()].split("\n")
+    cut_line = len(lines) - 1
+    # Move the "### <section>" heading of the first placeholder to the dynamic part too
+    previous = cut_line - 1
+    while previous >= 0 and not lines[previous].strip():
+        previous -= 1
+    if previous >= 0 and lines[previous].lstrip().startswith("###"):
+        cut_line = previous
+    cut = sum(len(line) + 1 for line in lines[:cut_line])
+    return text[:cut], text[cut:]
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """A precompiled prompt template in one language."""
+    name: str
+    language: str
+    text: str
+    static_prefix: str
+    dynamic_suffix: str
+    placeholders: Tuple[str, ...]
+    version: str
+    _segments: Tuple[Tuple[str, Optional[str]], ...] = field(repr=False, compare=False)
+
+    @classmethod
+    def compile(cls, name: str, language: str, text: str) -> "PromptTemplate":
+        static_prefix, dynamic_suffix = _split_static(text)
+        placeholders = tuple(dict.fromkeys(PLACEHOLDER_PATTERN.findall(text)))
+        version = hashlib.sha256(f"{name}\n{language}\n{text}".encode("utf-8")).hexdigest()[:12]
+        return cls(name, language, text, static_prefix, dynamic_suffix, placeholders, version,
+                   _compile(dynamic_suffix))
+
+    def render_dynamic(self, **values: str) -> str:
+        """Render the per-request part of the template.
+
+        Raises:
+            KeyError: If a placeholder has no value
+        """
+        missing = [name for name in self.placeholders if name not in values]
+        if missing:
+            raise KeyError(f"Missing values for prompt '{self.name}': {', '.join(missing)}")
+        return "".join(literal + (str(values[name]) if name else "") for literal, name in self._segments)
+
+    def render(self, **values: str) -> str:
+        """Render the full template (static instructions followed by the per-request data)."""
+        return self.static_prefix + self.render_dynamic(**values)
+
+
+class PromptRegistry:
+    """Registry of the prompt templates in a prompts directory."""
+
+    def __init__(self, templates: Dict[Tuple[str, str], PromptTemplate]):
+        self._templates = templates
+        digest = hashlib.sha256()
+        for key in sorted(templates):
+            digest.update(templates[key].version.encode("utf-8"))
+        self.version = digest.hexdigest()[:12]
+
+    @classmethod
+    def load(cls, prompts_dir: Optional[Path] = None) -> "PromptRegistry":
+        """Load and compile every prompts/<name>.yml file.
+
+        Args:
+            prompts_dir: Directory of the YAML files, defaults to CITY_GARDEN_PROMPTS_DIR or the repo's prompts/
+
+        Returns:
+            PromptRegistry: The loaded registry
+        """
+        prompts_dir = Path(prompts_dir or os.environ.get("CITY_GARDEN_PROMPTS_DIR", DEFAULT_PROMPTS_DIR))
+        templates = {}
+        for path in sorted(prompts_dir.glob("*.yml")):
+            with open(path, encoding="utf-8") as file:
+                data = yaml.safe_load(file) or {}
+            for key, text in data.items():
+                name, _, language = key.rpartition("_")
+                if name == path.stem and language in SUPPORTED_LANGUAGES and isinstance(text, str):
+                    templates[(name, language)] = PromptTemplate.compile(name, language, text)
+        return cls(templates)
+
+    def get(self, name: str, language: Optional[str] = None) -> PromptTemplate:
+        """Return a template, falling back to the default language if the variant does not exist.
+
+        Raises:
+            KeyError: If the prompt does not exist
+        """
+        language = language or DEFAULT_LANGUAGE
+        template = self._templates.get((name, language)) or self._templates.get((name, DEFAULT_LANGUAGE))
+        if template is None:
+            raise KeyError(f"Unknown prompt '{name}'")
+        return template
+
+    def names(self) -> List[str]:
+        return sorted({name for name, _ in self._templates})
+
+
+prompt_registry = PromptRegistry.load()
@@ -1,3 +1,4 @@
+import logging
 import os
 import requests
 from azure.ai.contentsafety import ContentSafetyClient
@@ -14,6 +15,10 @@ from dataclasses import dataclass
 from typing import Optional
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+from city_garden.services.http_replay import azure_client_kwargs
+from city_garden.cancellation import azure_timeout_kwargs
+
+logger = logging.getLogger(__name__)
 
 @dataclass
 class ImageAnalysisResult:
@@ -42,7 +47,7 @@ class ContentAnalyzer:
             endpoint (str): Azure Content Safety endpoint URL
             key (str): Azure Content Safety API key
         """
-        self.client = ContentSafetyClient(endpoint, AzureKeyCredential(key))
+        self.client = ContentSafetyClient(endpoint, AzureKeyCredential(key), **azure_client_kwargs())
     
     def _download_image(self, image_url: str) -> bytes:
         """
@@ -94,12 +99,12 @@ class ContentAnalyzer:
 
         # Analyze image
         try:
-            response = self.client.analyze_image(request)
+            response = self.client.analyze_image(request, **azure_timeout_kwargs())
         except HttpResponseError as e:
-            print("Analyze image failed.")
             if e.error:
-                print(f"Error code: {e.error.code}")
-                print(f"Error message: {e.error.message}")
+                logger.warning(f"Analyze image failed: {e.error.code} {e.error.message}")
+            else:
+                logger.warning(f"Analyze image failed: {e}")
             raise
 
         # Extract results for each category
@@ -132,12 +137,12 @@ class ContentAnalyzer:
 
         # Analyze image
         try:
-            response = self.client.analyze_image(request)
+            response = self.client.analyze_image(request, **azure_timeout_kwargs())
         except HttpResponseError as e:
-            print("Analyze image failed.")
             if e.error:
-                print(f"Error code: {e.error.code}")
-                print(f"Error message: {e.error.message}")
+                logger.warning(f"Analyze image failed: {e.error.code} {e.error.message}")
+            else:
+                logger.warning(f"Analyze image failed: {e}")
             raise
 
         # Extract results for each category
@@ -171,12 +176,12 @@ class ContentAnalyzer:
 
         # Analyze text
         try:
-            response = self.client.analyze_text(request)
+            response = self.client.analyze_text(request, **azure_timeout_kwargs())
         except HttpResponseError as e:
-            print("Analyze text failed.")
             if e.error:
-                print(f"Error code: {e.error.code}")
-                print(f"Error message: {e.error.message}")
+                logger.warning(f"Analyze text failed: {e.error.code} {e.error.message}")
+            else:
+                logger.warning(f"Analyze text failed: {e}")
             raise
 
         # Extract results for each category
@@ -0,0 +1,317 @@
+"""
+Record/replay of the HTTP traffic of the external services.
+
+Sits beneath the SDK clients (the LLM and the OpenAI image client through httpx, BlobClient
+and ContentSafetyClient through azure-core's requests transport, the Open-Meteo client through
+a requests session), so a graph run can be
+repeated without network access:
+
+- record: requests go to the real services and each response is saved to a cassette file
+  keyed by a hash of the normalized request
+- replay: responses are served from the cassettes, with the recorded or a simulated latency
+
+Configured with environment variables:
+    CITY_GARDEN_HTTP_MODE        off (default), record or replay
+    CITY_GARDEN_CASSETTE_DIR     directory of the cassette files (default: .cassettes)
+    CITY_GARDEN_REPLAY_LATENCY   original (default), none, scale:<factor> or constant:<seconds>
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import httpx
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+MODES = ("off", "record", "replay")
+
+# Query parameters that change between otherwise identical requests (SAS tokens)
+VOLATILE_QUERY_PARAMS = {"sig", "se", "st", "sp", "sv", "sr", "spr", "ss", "srt",
+                         "skoid", "sktid", "skt", "ske", "sks", "skv"}
+# Request headers that select different responses for the same URL
+KEY_HEADERS = ("x-ms-range", "range")
+# Response headers that no longer apply once the body has been read and decoded
+DROPPED_RESPONSE_HEADERS = {"content-encoding", "transfer-encoding", "content-length", "connection"}
+
+
+class ReplayMissError(RuntimeError):
+    """Raised in replay mode when no recorded response matches a request."""
+
+
+def http_mode() -> str:
+    mode = os.environ.get("CITY_GARDEN_HTTP_MODE", "off").lower()
+    if mode not in MODES:
+        raise ValueError(f"Invalid CITY_GARDEN_HTTP_MODE '{mode}', expected one of {MODES}")
+    return mode
+
+
+def _normalize_body(body: bytes, content_type: str) -> bytes:
+    if not body:
+        return b""
+    if "json" in content_type:
+        try:
+            return json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+        except ValueError:
+            return body
+    if "multipart/form-data" in content_type and "boundary=" in content_type:
+        boundary = content_type.split("boundary=", 1)[1].split(";")[0].strip('"')
+        return body.replace(boundary.encode("utf-8"), b"BOUNDARY")
+    return body
+
+
+def request_key(method: str, url: str, headers: Mapping[str, str], body: bytes) -> str:
+    """Return the cassette key of a request.
+
+    The host is left out (so recordings work against a different endpoint), as are SAS
+    tokens and multipart boundaries. JSON bodies are compared with sorted keys.
+    """
+    parsed = urlparse(url)
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+                   if k not in VOLATILE_QUERY_PARAMS)
+    lower_headers = {k.lower(): v for k, v in headers.items()}
+    digest = hashlib.sha256()
+    digest.update(f"{method.upper()} {parsed.path}?{urlencode(query)}\n".encode("utf-8"))
+    for name in KEY_HEADERS:
+        if name in lower_headers:
+            digest.update(f"{name}: {lower_headers[name]}\n".encode("utf-8"))
+    digest.update(hashlib.sha256(_normalize_body(body, lower_headers.get("content-type", ""))).digest())
+    return digest.hexdigest()
+
+
+class Cassette:
+    """Directory of recorded interactions, one JSON file per request key.
+
+    A key can hold several interactions (e.g. the same request sent twice); replay serves
+    them in order and repeats the last one once they are used up.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._replay_positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def record(self, key: str, method: str, url: str, status: int, headers: Mapping[str, str],
+               body: bytes, latency: float) -> None:
+        interaction = {
+            "request": {"method": method, "url": url},
+            "response": {
+                "status": status,
+                "headers": {k: v for k, v in headers.items() if k.lower() not in DROPPED_RESPONSE_HEADERS},
+                "body": base64.b64encode(body).decode("utf-8"),
+            },
+            "latency": latency,
+        }
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            interactions = json.loads(path.read_text()) if path.exists() else []
+            interactions.append(interaction)
+            path.write_text(json.dumps(interactions, indent=1))
+
+    def next(self, key: str, method: str, url: str) -> Tuple[int, Dict[str, str], bytes, float]:
+        """Return (status, headers, body, latency) of the next recorded response for a key.
+
+        Raises:
+            ReplayMissError: If nothing was recorded for the request
+        """
+        path = self._path(key)
+        if not path.exists():
+            raise ReplayMissError(f"No recorded response for {method} {url} (key {key}) in {self.directory}")
+        with self._lock:
+            interactions = json.loads(path.read_text())
+            position = self._replay_positions.get(key, 0)
+            self._replay_positions[key] = position + 1
+        interaction = interactions[min(position, len(interactions) - 1)]
+        response = interaction["response"]
+        return response["status"], response["headers"], base64.b64decode(response["body"]), interaction["latency"]
+
+
+def replay_delay(recorded_latency: float) -> float:
+    """Return how long a replayed response should take, per CITY_GARDEN_REPLAY_LATENCY."""
+    setting = os.environ.get("CITY_GARDEN_REPLAY_LATENCY", "original").lower()
+    if setting == "original":
+        return recorded_latency
+    if setting == "none":
+        return 0.0
+    kind, _, value = setting.partition(":")
+    if kind == "scale":
+        return recorded_latency * float(value)
+    if kind == "constant":
+        return float(value)
+    raise ValueError(f"Invalid CITY_GARDEN_REPLAY_LATENCY '{setting}'")
+
+
+_cassettes: Dict[Path, Cassette] = {}
+_cassettes_lock = threading.Lock()
+
+
+def current_cassette() -> Cassette:
+    directory = Path(os.environ.get("CITY_GARDEN_CASSETTE_DIR", ".cassettes")).resolve()
+    with _cassettes_lock:
+        return _cassettes.setdefault(directory, Cassette(directory))
+
+
+def _response_headers(headers: Any) -> Dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() not in DROPPED_RESPONSE_HEADERS}
+
+
+class RecordReplayTransport(httpx.BaseTransport):
+    """httpx transport that records or replays responses (used by the OpenAI clients)."""
+
+    def __init__(self, mode: str, cassette: Cassette, wrapped: Optional[httpx.BaseTransport] = None):
+        self.mode = mode
+        self.cassette = cassette
+        self.wrapped = wrapped or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = request.read()
+        key = request_key(request.method, str(request.url), request.headers, body)
+        if self.mode == "replay":
+            status, headers, content, latency = self.cassette.next(key, request.method, str(request.url))
+            time.sleep(replay_delay(latency))
+            return httpx.Response(status, headers=headers, content=content, request=request)
+
+        start = time.monotonic()
+        response = self.wrapped.handle_request(request)
+        content = response.read()
+        latency = time.monotonic() - start
+        response.close()
+        self.cassette.record(key, request.method, str(request.url), response.status_code, response.headers,
+                             content, latency)
+        return httpx.Response(response.status_code, headers=_response_headers(response.headers),
+                              content=content, request=request)
+
+    def close(self) -> None:
+        self.wrapped.close()
+
+
+class AsyncRecordReplayTransport(httpx.AsyncBaseTransport):
+    """Async variant of RecordReplayTransport."""
+
+    def __init__(self, mode: str, cassette: Cassette, wrapped: Optional[httpx.AsyncBaseTransport] = None):
+        self.mode = mode
+        self.cassette = cassette
+        self.wrapped = wrapped or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = request_key(request.method, str(request.url), request.headers, body)
+        if self.mode == "replay":
+            status, headers, content, latency = self.cassette.next(key, request.method, str(request.url))
+            await asyncio.sleep(replay_delay(latency))
+            return httpx.Response(status, headers=headers, content=content, request=request)
+
+        start = time.monotonic()
+        response = await self.wrapped.handle_async_request(request)
+        content = await response.aread()
+        latency = time.monotonic() - start
+        await response.aclose()
+        self.cassette.record(key, request.method, str(request.url), response.status_code, response.headers,
+                             content, latency)
+        return httpx.Response(response.status_code, headers=_response_headers(response.headers),
+                              content=content, request=request)
+
+    async def aclose(self) -> None:
+        await self.wrapped.aclose()
+
+
+class RecordReplayAdapter(HTTPAdapter):
+    """requests adapter that records or replays responses (used by the Azure SDK clients)."""
+
+    def __init__(self, mode: str, cassette: Cassette):
+        super().__init__()
+        self.mode = mode
+        self.cassette = cassette
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        body = request.body or b""
+        if hasattr(body, "read"):
+            body = body.read()
+            request.body = body
+        elif not isinstance(body, (bytes, str)):
+            body = b"".join(body)
+            request.body = body
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        key = request_key(request.method, request.url, request.headers, body)
+
+        if self.mode == "replay":
+            status, headers, content, latency = self.cassette.next(key, request.method, request.url)
+            time.sleep(replay_delay(latency))
+        else:
+            start = time.monotonic()
+            response = super().send(request, **kwargs)
+            content = response.content
+            latency = time.monotonic() - start
+            status, headers = response.status_code, _response_headers(response.headers)
+            self.cassette.record(key, request.method, request.url, status, headers, content, latency)
+
+        headers = {**headers, "Content-Length": str(len(content))}
+        raw = HTTPResponse(body=BytesIO(content), headers=headers, status=status, preload_content=False,
+                           decode_content=False)
+        return self.build_response(request, raw)
+
+
+def _requests_session(mode: str) -> requests.Session:
+    session = requests.Session()
+    adapter = RecordReplayAdapter(mode, current_cassette())
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def chat_model_kwargs() -> Dict[str, Any]:
+    """Extra keyword arguments for the LangChain chat model (empty when record/replay is off)."""
+    mode = http_mode()
+    if mode == "off":
+        return {}
+    cassette = current_cassette()
+    return {
+        "http_client": httpx.Client(transport=RecordReplayTransport(mode, cassette)),
+        "http_async_client": httpx.AsyncClient(transport=AsyncRecordReplayTransport(mode, cassette)),
+    }
+
+
+def openai_client_kwargs() -> Dict[str, Any]:
+    """Extra keyword arguments for openai.OpenAI (empty when record/replay is off)."""
+    mode = http_mode()
+    if mode == "off":
+        return {}
+    return {"http_client": httpx.Client(transport=RecordReplayTransport(mode, current_cassette()))}
+
+
+def async_openai_client_kwargs() -> Dict[str, Any]:
+    """Extra keyword arguments for openai.AsyncOpenAI (empty when record/replay is off)."""
+    mode = http_mode()
+    if mode == "off":
+        return {}
+    return {"http_client": httpx.AsyncClient(transport=AsyncRecordReplayTransport(mode, current_cassette()))}
+
+
+def requests_session() -> Optional[requests.Session]:
+    """A requests session that records or replays its traffic (None when record/replay is off)."""
+    mode = http_mode()
+    if mode == "off":
+        return None
+    return _requests_session(mode)
+
+
+def azure_client_kwargs() -> Dict[str, Any]:
+    """Extra keyword arguments for Azure SDK clients (empty when record/replay is off)."""
+    mode = http_mode()
+    if mode == "off":
+        return {}
+    return {"transport": RequestsTransport(session=_requests_session(mode), session_owner=False)}
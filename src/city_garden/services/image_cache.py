@@ -0,0 +1,226 @@
+"""
+Cache for generated garden images.
+
+Maps (input image hashes, normalized plant names, prompt version) to the blob URL
+of a previously generated garden image and its responsive variants, so repeated designs
+skip the image API.
+The in-memory backend is per process; the SQLite backend is shared by all API workers
+on a host.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from city_garden.metrics import registry
+
+EVICTION_POLICIES = ("lru", "fifo")
+BACKENDS = ("memory", "sqlite")
+
+
+class CachedGardenImage(NamedTuple):
+    url: str
+    # srcset per format, see city_garden.services.image_variants
+    variants: Dict[str, str]
+
+
+def normalize_plant_names(plant_recommendations: Any) -> List[str]:
+    """Return the sorted, de-duplicated, lower-cased plant names of a recommendation list."""
+    if not isinstance(plant_recommendations, list):
+        return []
+    names = set()
+    for plant in plant_recommendations:
+        name = plant.get("name") if isinstance(plant, dict) else plant
+        if name:
+            names.add(" ".join(str(name).lower().split()))
+    return sorted(names)
+
+
+class GardenImageCache:
+    """In-memory cache of generated garden images with TTL expiry and bounded size.
+
+    Args:
+        ttl_seconds: Time after which an entry expires (0 or less disables expiry)
+        max_entries: Maximum number of entries before eviction
+        eviction: "lru" evicts the least recently used entry, "fifo" the oldest inserted one
+    """
+
+    def __init__(self, ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 1024, eviction: str = "lru"):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy '{eviction}', expected one of {EVICTION_POLICIES}")
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self._entries: "OrderedDict[str, Tuple[CachedGardenImage, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = registry.counter("garden_image_cache.hits")
+        self._misses = registry.counter("garden_image_cache.misses")
+        self._evictions = registry.counter("garden_image_cache.evictions")
+
+    @staticmethod
+    def make_key(image_ids: List[str], plant_recommendations: Any, prompt_version: str) -> Optional[str]:
+        """Build the cache key for a generation request.
+
+        Args:
+            image_ids: The ids (content hashes) of the input images, in request order
+            plant_recommendations: The plant recommendation list from the graph state
+            prompt_version: Version of the image prompt (changes invalidate the cache)
+
+        Returns:
+            The key, or None if the request has no plants and should not be cached
+        """
+        plant_names = normalize_plant_names(plant_recommendations)
+        if not plant_names:
+            return None
+        key = hashlib.sha256()
+        for image_id in image_ids:
+            key.update(image_id.encode("utf-8"))
+        key.update("\n".join(plant_names).encode("utf-8"))
+        key.update(prompt_version.encode("utf-8"))
+        return key.hexdigest()
+
+    def get(self, key: str) -> Optional[CachedGardenImage]:
+        """Return the cached image for a key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses.inc()
+                return None
+            if self.eviction == "lru":
+                self._entries.move_to_end(key)
+            self._hits.inc()
+            return entry[0]
+
+    def set(self, key: str, image_url: str, variants: Optional[Dict[str, str]] = None) -> None:
+        """Store the image URL and its variants for a key, evicting entries if the cache is full."""
+        with self._lock:
+            self._entries[key] = (CachedGardenImage(image_url, dict(variants or {})), time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions.inc()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "eviction": self.eviction}
+
+    def _expired(self, entry: Tuple[Any, float]) -> bool:
+        return self.ttl_seconds > 0 and time.time() - entry[1] > self.ttl_seconds
+
+
+class SqliteImageCache(GardenImageCache):
+    """Garden image cache stored in a local SQLite database, shared between processes.
+
+    Each process opens its own connection on first use (connections must not cross a fork),
+    so the cache can be created before the API workers are forked.
+
+    Args:
+        path: Path of the SQLite database file
+        ttl_seconds: Time after which an entry expires (0 or less disables expiry)
+        max_entries: Maximum number of entries before eviction
+        eviction: "lru" evicts the least recently used entry, "fifo" the oldest inserted one
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 1024,
+                 eviction: str = "lru"):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=max_entries, eviction=eviction)
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._connection_pid: Optional[int] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Called with self._lock held
+        if self._connection is None or self._connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS garden_images ("
+                "key TEXT PRIMARY KEY, image_url TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, "
+                "variants TEXT)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS garden_images_accessed ON garden_images (accessed)")
+            connection.execute("CREATE INDEX IF NOT EXISTS garden_images_created ON garden_images (created)")
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(garden_images)")}
+            if "variants" not in columns:
+                # Databases created before the image variants
+                connection.execute("ALTER TABLE garden_images ADD COLUMN variants TEXT")
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def get(self, key: str) -> Optional[CachedGardenImage]:
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT image_url, created, variants FROM garden_images WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._expired(row):
+                connection.execute("DELETE FROM garden_images WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._misses.inc()
+                return None
+            if self.eviction == "lru":
+                connection.execute("UPDATE garden_images SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._hits.inc()
+            return CachedGardenImage(row[0], json.loads(row[2] or "{}"))
+
+    def set(self, key: str, image_url: str, variants: Optional[Dict[str, str]] = None) -> None:
+        now = time.time()
+        order_column = "accessed" if self.eviction == "lru" else "created"
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO garden_images (key, image_url, created, accessed, variants) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, image_url, now, now, json.dumps(variants or {}))
+                )
+                evicted = connection.execute(
+                    f"DELETE FROM garden_images WHERE key IN (SELECT key FROM garden_images "
+                    f"ORDER BY {order_column} DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                ).rowcount
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            if evicted > 0:
+                self._evictions.inc(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._connect().execute("SELECT COUNT(*) FROM garden_images").fetchone()[0]
+        return {"entries": entries, "max_entries": self.max_entries, "eviction": self.eviction,
+                "backend": "sqlite", "path": self.path}
+
+
+def create_image_cache_from_env() -> Optional[GardenImageCache]:
+    """Create the garden image cache from environment variables, or None if it is disabled."""
+    load_dotenv()
+    if os.environ.get("GARDEN_IMAGE_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    backend = os.environ.get("GARDEN_IMAGE_CACHE_BACKEND", "memory").lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown garden image cache backend '{backend}', expected one of {BACKENDS}")
+    options = dict(
+        ttl_seconds=float(os.environ.get("GARDEN_IMAGE_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+        max_entries=int(os.environ.get("GARDEN_IMAGE_CACHE_MAX_ENTRIES", "1024")),
+        eviction=os.environ.get("GARDEN_IMAGE_CACHE_EVICTION", "lru").lower()
+    )
+    if backend == "sqlite":
+        return SqliteImageCache(os.environ.get("GARDEN_IMAGE_CACHE_PATH", "garden_image_cache.sqlite3"), **options)
+    return GardenImageCache(**options)
+
+
+garden_image_cache = create_image_cache_from_env()
@@ -0,0 +1,145 @@
+"""
+Near-duplicate detection for the uploaded balcony photos.
+
+Users often upload several photos taken from almost the same angle. Each image is
+reduced to a 64-bit perceptual hash (dHash: gradient signs of a 9x8 thumbnail; pHash:
+signs of the low-frequency DCT coefficients of a 32x32 thumbnail). Images whose hashes
+differ in at most `threshold` bits are treated as duplicates, and only the highest
+resolution image of each group is kept, so the vision calls and the image edit get
+fewer, non-redundant inputs.
+"""
+import base64
+import logging
+import os
+from dataclasses import dataclass
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from city_garden.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+HASH_METHODS = ("dhash", "phash", "both")
+
+
+def _grayscale_thumbnail(image: Image.Image, width: int, height: int) -> np.ndarray:
+    thumbnail = ImageOps.exif_transpose(image).convert("L").resize((width, height), Image.Resampling.LANCZOS)
+    return np.asarray(thumbnail, dtype=np.float64)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int("".join("1" if bit else "0" for bit in bits.flatten()), 2)
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """Return the difference hash of an image (hash_size**2 bits)."""
+    pixels = _grayscale_thumbnail(image, hash_size + 1, hash_size)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """Return the orthonormal DCT-II matrix, so that M @ x is the DCT of x."""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+def phash(image: Image.Image, hash_size: int = 8, highfreq_factor: int = 4) -> int:
+    """Return the DCT-based perceptual hash of an image (hash_size**2 bits)."""
+    size = hash_size * highfreq_factor
+    pixels = _grayscale_thumbnail(image, size, size)
+    dct = _dct_matrix(size)
+    low_frequencies = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    # The DC term only encodes the mean brightness, leave it out of the median
+    median = np.median(low_frequencies.flatten()[1:])
+    return _bits_to_int(low_frequencies > median)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+@dataclass(frozen=True)
+class ImageFingerprint:
+    """Perceptual hashes and size of one image."""
+    dhash: int
+    phash: int
+    pixels: int
+
+    @classmethod
+    def from_bytes(cls, image_bytes: bytes) -> "ImageFingerprint":
+        with Image.open(BytesIO(image_bytes)) as image:
+            width, height = image.size
+            # JPEG: decode at a reduced scale, the hashes only need a thumbnail
+            image.draft("L", (128, 128))
+            return cls(dhash=dhash(image), phash=phash(image), pixels=width * height)
+
+    def distance(self, other: "ImageFingerprint", method: str = "both") -> int:
+        """Return the Hamming distance to another fingerprint (the larger of both hashes for "both")."""
+        if method == "dhash":
+            return hamming_distance(self.dhash, other.dhash)
+        if method == "phash":
+            return hamming_distance(self.phash, other.phash)
+        return max(hamming_distance(self.dhash, other.dhash), hamming_distance(self.phash, other.phash))
+
+
+def deduplicate_images(image_contents: List[str], threshold: int = 10,
+                       method: str = "both") -> Tuple[List[str], List[int]]:
+    """Collapse near-duplicate images.
+
+    Args:
+        image_contents: Images as base64 strings, in request order
+        threshold: Maximum Hamming distance (out of 64 bits) for two images to be duplicates
+        method: Hash to compare: "dhash", "phash" or "both" (both hashes must be within the threshold)
+
+    Returns:
+        The kept images (the highest resolution image of each group, at the position of the
+        group's first image) and the indices of the dropped images
+    """
+    if method not in HASH_METHODS:
+        raise ValueError(f"Unknown hash method '{method}', expected one of {HASH_METHODS}")
+    groups: List[List[int]] = []
+    fingerprints: List[Optional[ImageFingerprint]] = []
+    for index, image_content in enumerate(image_contents):
+        try:
+            fingerprint = ImageFingerprint.from_bytes(base64.b64decode(image_content))
+        except Exception as e:
+            # Undecodable images are never merged; the graph decides what to do with them
+            logger.warning(f"Could not fingerprint image {index}: {str(e)}")
+            fingerprint = None
+        fingerprints.append(fingerprint)
+        for group in groups:
+            representative = fingerprints[group[0]]
+            if (fingerprint is not None and representative is not None
+                    and fingerprint.distance(representative, method) <= threshold):
+                group.append(index)
+                break
+        else:
+            groups.append([index])
+
+    kept, dropped = [], []
+    for group in groups:
+        best = max(group, key=lambda i: fingerprints[i].pixels if fingerprints[i] is not None else 0)
+        kept.append(image_contents[best])
+        dropped.extend(i for i in group if i != best)
+    if dropped:
+        registry.counter("image_dedup.dropped").inc(len(dropped))
+        logger.info(f"Dropped {len(dropped)} near-duplicate images of {len(image_contents)}")
+    return kept, sorted(dropped)
+
+
+def deduplicate_images_from_env(image_contents: List[str]) -> List[str]:
+    """Collapse near-duplicates with the settings from the environment (IMAGE_DEDUP_*)."""
+    if os.environ.get("IMAGE_DEDUP_ENABLED", "true").lower() != "true":
+        return image_contents
+    kept, _ = deduplicate_images(
+        image_contents,
+        threshold=int(os.environ.get("IMAGE_DEDUP_THRESHOLD", "10")),
+        method=os.environ.get("IMAGE_DEDUP_HASH", "both").lower()
+    )
+    return kept
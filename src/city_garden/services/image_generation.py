@@ -1,8 +1,13 @@
+import logging
 import os
 import requests
 from PIL import Image
 from io import BytesIO
 
+from city_garden.logging_config import log_payload
+
+logger = logging.getLogger(__name__)
+
 # Generate an image with DALL-E, return the image as Image object
 def generate_image(prompt: str) -> Image.Image:
      # create image with DALL-E
@@ -30,10 +35,9 @@ def generate_image(prompt: str) -> Image.Image:
 
     # Check response
     if response.status_code == 200:
-        print("Success!")
-        print(response.json())
+        log_payload(logger, "Image generation response", response.text)
     else:
-        print(f"Request failed with status code {response.status_code}: {response.text}")
+        logger.error(f"Request failed with status code {response.status_code}: {response.text}")
         raise Exception(f"Request failed with status code {response.status_code}: {response.text}")
     
     # Get the image URL from the response
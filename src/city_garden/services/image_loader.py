@@ -1,4 +1,4 @@
-from azure.storage.blob import BlobClient
+from azure.storage.blob import BlobClient, ContentSettings
 from io import BytesIO
 from PIL import Image
 import re
@@ -6,13 +6,104 @@ import requests
 from dotenv import load_dotenv
 import os
 import base64
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, Optional, Tuple
 from urllib.parse import urlparse, parse_qs
 
+from city_garden.services.http_replay import azure_client_kwargs
+from city_garden.cancellation import azure_timeout_kwargs
+
+logger = logging.getLogger(__name__)
+
+# Background uploads, keyed by blob URL so identical content is only uploaded once at a time
+_upload_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("IMAGE_UPLOAD_WORKERS", "4")),
+    thread_name_prefix="blob-upload"
+)
+_pending_uploads: Dict[str, Future] = {}
+_pending_lock = threading.Lock()
+# Errors of finished uploads that failed, by blob URL, oldest first. Only the message is kept:
+# the exception's traceback references the upload frame and with it the image bytes.
+UPLOAD_FAILURE_TTL_SECONDS = float(os.environ.get("UPLOAD_FAILURE_TTL_SECONDS", "600"))
+_failed_uploads: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+
+def content_blob_name(image_content: bytes, suffix: str = "garden_image.png") -> str:
+    """Return a content-addressed blob name (SHA-256 of the bytes), so identical images share one blob."""
+    return f"{hashlib.sha256(image_content).hexdigest()}-{suffix}"
+
+
+def pending_upload(blob_url: str) -> Optional[Future]:
+    """Return the background upload future for a blob URL, or None if nothing is pending."""
+    with _pending_lock:
+        return _pending_uploads.get(blob_url)
+
+
+def upload_failure(blob_url: str) -> Optional[str]:
+    """Return the error of a finished upload of a blob URL that failed in the last
+    UPLOAD_FAILURE_TTL_SECONDS, or None."""
+    with _pending_lock:
+        _prune_failed_uploads()
+        failure = _failed_uploads.get(blob_url)
+    return failure[1] if failure else None
+
+
+def wait_for_upload(blob_url: str, timeout: Optional[float] = None) -> None:
+    """Block until the background upload of a blob URL has finished.
+
+    Raises:
+        Exception: The upload error, if the upload failed
+    """
+    future = pending_upload(blob_url)
+    if future is None:
+        failure = upload_failure(blob_url)
+        if failure is not None:
+            raise RuntimeError(f"Upload of {blob_url} failed: {failure}")
+        return
+    future.result(timeout=timeout)
+
+
+def register_upload(blob_url: str, future: Future) -> None:
+    """Track an upload that was not started with upload_image_async(), e.g. one whose bytes are
+    still being rendered, so that pending_upload(), wait_for_upload() and drain_uploads() see it."""
+    with _pending_lock:
+        _pending_uploads[blob_url] = future
+    future.add_done_callback(lambda f: _forget_upload(blob_url, f))
+
+
+def drain_uploads(timeout: Optional[float] = None) -> int:
+    """Wait for all pending background uploads, e.g. before the process exits.
+
+    Args:
+        timeout: Maximum total time to wait in seconds (None waits indefinitely)
+
+    Returns:
+        int: Number of uploads still unfinished when the timeout expired
+    """
+    with _pending_lock:
+        futures = list(_pending_uploads.values())
+    if not futures:
+        return 0
+    logger.info(f"Draining {len(futures)} pending image uploads")
+    _, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        logger.warning(f"{len(not_done)} image uploads did not finish within {timeout}s")
+    return len(not_done)
+
 class AzureImageLoader:
     def __init__(self, account_name: str, account_key: str):
         load_dotenv()
         self.account_name = os.environ["AZURE_STORAGE_ACCOUNT_NAME"]
         self.account_key = os.environ["AZURE_STORAGE_ACCOUNT_KEY"]
+        # Override for local emulators and stubs, e.g. http://127.0.0.1:10000/devstoreaccount1
+        self.account_url = os.environ.get(
+            "AZURE_STORAGE_ACCOUNT_URL", f"https://{self.account_name}.blob.core.windows.net"
+        )
 
     def _parse_blob_url(self, blob_url):
         # Parse the URL to handle SAS tokens
@@ -36,42 +127,122 @@ class AzureImageLoader:
         
         # Construct the blob URL with SAS token if present
         if sas_token:
-            blob_client = BlobClient.from_blob_url(blob_url)
+            blob_client = BlobClient.from_blob_url(blob_url, **azure_client_kwargs())
         else:
             blob_client = BlobClient(
-                account_url=f"https://{self.account_name}.blob.core.windows.net",
+                account_url=self.account_url,
                 container_name=container_name,
                 blob_name=blob_name,
-                credential=self.account_key
+                credential=self.account_key,
+                **azure_client_kwargs()
             )
             
-        print(f"Loading image from: {blob_url}")
+        logger.debug(f"Loading image from: {blob_url}")
         try:
-            blob_data = blob_client.download_blob().readall()
+            blob_data = blob_client.download_blob(**azure_timeout_kwargs()).readall()
             image_content = base64.b64encode(blob_data).decode("utf-8")
             return image_content
         except Exception as e:
-            print(f"Error loading image: {str(e)}")
+            logger.warning(f"Error loading image: {str(e)}")
             raise
 
     def load_images(self, blob_urls):
-        print(f"Loading {len(blob_urls)} images from Azure Blob Storage")
+        logger.info(f"Loading {len(blob_urls)} images from Azure Blob Storage")
         image_contents = []
         for blob_url in blob_urls:
             try:
                 image_contents.append(self.load_image(blob_url))
             except Exception as e:
-                print(f"Failed to load image {blob_url}: {str(e)}")
+                logger.warning(f"Failed to load image {blob_url}: {str(e)}")
                 raise
         return image_contents
     
-    # upload image to azure blob storage
-    def upload_image(self, image_content, container_name, blob_name):
-        blob_client = BlobClient(
-            account_url=f"https://{self.account_name}.blob.core.windows.net",
+    def _blob_client(self, container_name, blob_name):
+        return BlobClient(
+            account_url=self.account_url,
             container_name=container_name,
             blob_name=blob_name,
-            credential=self.account_key
+            credential=self.account_key,
+            **azure_client_kwargs()
+        )
+
+    def blob_url(self, container_name, blob_name):
+        """Return the URL of a blob without any network call."""
+        return self._blob_client(container_name, blob_name).url
+
+    # upload image to azure blob storage
+    def upload_image(self, image_content, container_name, blob_name, overwrite=False, content_type=None):
+        blob_client = self._blob_client(container_name, blob_name)
+        content_settings = ContentSettings(content_type=content_type) if content_type else None
+        blob_client.upload_blob(
+            image_content,
+            length=len(image_content),
+            overwrite=overwrite,
+            content_settings=content_settings
         )
-        blob_client.upload_blob(image_content)
         return blob_client.url
+
+    def submit_upload(self, image_content: bytes, container_name: str, blob_name: str,
+                      content_type: str = "image/png") -> Future:
+        """Upload image bytes on the background upload threads, without tracking the upload
+        (see register_upload())."""
+        # Same name means same content, so overwriting is idempotent
+        return _upload_executor.submit(
+            self.upload_image, image_content, container_name, blob_name,
+            overwrite=True, content_type=content_type
+        )
+
+    def upload_image_async(self, image_content: bytes, container_name: str, blob_name: Optional[str] = None,
+                           content_type: str = "image/png") -> Tuple[str, Future]:
+        """
+        Upload image bytes in the background under a content-addressed blob name.
+
+        The blob URL is returned immediately; use wait_for_upload() or the returned future
+        before handing the URL to a client. Uploading the same content while an upload
+        of it is still pending reuses the pending upload.
+
+        Args:
+            image_content (bytes): Decoded image bytes
+            container_name (str): Target container
+            blob_name (str, optional): Blob name, defaults to content_blob_name(image_content)
+            content_type (str): Content type stored with the blob
+
+        Returns:
+            Tuple[str, Future]: The blob URL and the upload future
+        """
+        blob_name = blob_name or content_blob_name(image_content)
+        blob_url = self.blob_url(container_name, blob_name)
+        with _pending_lock:
+            future = _pending_uploads.get(blob_url)
+            if future is not None and not (future.done() and future.exception() is not None):
+                return blob_url, future
+            future = self.submit_upload(image_content, container_name, blob_name, content_type)
+            _pending_uploads[blob_url] = future
+        future.add_done_callback(lambda f: _forget_upload(blob_url, f))
+        return blob_url, future
+
+
+def _forget_upload(blob_url: str, future: Future) -> None:
+    # Finished uploads are no longer pending; a failure is remembered (as its message, for a
+    # while) so that upload_failure() and wait_for_upload() can still report it
+    if future.cancelled():
+        error = "cancelled"
+    else:
+        exception = future.exception()
+        error = f"{exception!r}" if exception is not None else None
+    if error is not None:
+        logger.error(f"Upload of {blob_url} failed: {error}")
+    with _pending_lock:
+        if _pending_uploads.get(blob_url) is future:
+            del _pending_uploads[blob_url]
+        _failed_uploads.pop(blob_url, None)
+        if error is not None:
+            _failed_uploads[blob_url] = (time.monotonic(), error)
+        _prune_failed_uploads()
+
+
+def _prune_failed_uploads() -> None:
+    # Called with _pending_lock held
+    expired = time.monotonic() - UPLOAD_FAILURE_TTL_SECONDS
+    while _failed_uploads and next(iter(_failed_uploads.values()))[0] < expired:
+        _failed_uploads.popitem(last=False)
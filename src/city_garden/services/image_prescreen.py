@@ -0,0 +1,194 @@
+"""
+Local pre-screen of uploaded photos before the compliance LLM call.
+
+Cheap features are computed on a small thumbnail with vectorized NumPy:
+- vegetation: fraction of pixels with a high excess-green index (2g - r - b)
+- colour statistics: entropy of a 4-bit-per-channel colour histogram, share of the
+  8 most frequent colours and of near-white pixels (documents and screenshots are flat)
+- edges: density of strong gradients and the share of them that are close to horizontal
+  or vertical (balconies, railings, walls and windows are man-made and axis aligned)
+- skin: fraction of skin-coloured pixels (selfies)
+- aspect ratio
+
+Only clear cases get a verdict: "fail" for documents, screenshots and selfies, "pass" for
+photos with plants and man-made structure. Everything else is "uncertain" and goes to the LLM.
+A set of images is decided locally when one image passes (screenshots such as a compass
+reading may accompany the balcony photos) or when all of them fail.
+
+Evaluate against the sample images with:
+    python -m city_garden.services.image_prescreen
+"""
+import argparse
+import logging
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+PASS = "pass"
+FAIL = "fail"
+UNCERTAIN = "uncertain"
+
+THUMBNAIL_SIZE = 256
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+DEFAULT_TEST_IMAGES_DIR = Path(__file__).resolve().parents[3] / "prompts" / "test_images"
+
+
+@dataclass(frozen=True)
+class ImageFeatures:
+    """Cheap global features of one image (all fractions are between 0 and 1)."""
+    aspect_ratio: float
+    vegetation: float
+    colour_entropy: float
+    top_colours: float
+    near_white: float
+    edge_density: float
+    axis_aligned_edges: float
+    skin: float
+
+
+@dataclass(frozen=True)
+class PrescreenResult:
+    verdict: str
+    reason: str
+    features: Optional[ImageFeatures]
+
+
+def _thumbnail(image_bytes: bytes) -> Tuple[np.ndarray, float]:
+    """Decode an image into a float RGB array of at most THUMBNAIL_SIZE pixels per side."""
+    with Image.open(BytesIO(image_bytes)) as image:
+        image.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        aspect_ratio = image.width / image.height
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        return np.asarray(image, dtype=np.float32) / 255.0, aspect_ratio
+
+
+def extract_features(image_bytes: bytes) -> ImageFeatures:
+    pixels, aspect_ratio = _thumbnail(image_bytes)
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    brightness = pixels.mean(axis=2)
+
+    # Excess green on chromaticity coordinates, ignoring very dark pixels
+    total = r + g + b + 1e-6
+    excess_green = (2 * g - r - b) / total
+    vegetation = float(np.mean((excess_green > 0.12) & (brightness > 0.08)))
+
+    # Colour histogram with 16 levels per channel
+    quantized = (pixels * 15.999).astype(np.int32)
+    codes = (quantized[..., 0] << 8) | (quantized[..., 1] << 4) | quantized[..., 2]
+    counts = np.bincount(codes.ravel(), minlength=4096).astype(np.float64)
+    probabilities = counts[counts > 0] / codes.size
+    colour_entropy = float(-(probabilities * np.log2(probabilities)).sum() / 12.0)
+    top_colours = float(np.sort(counts)[-8:].sum() / codes.size)
+    near_white = float(np.mean(pixels.min(axis=2) > 0.9))
+
+    # Gradients of the luminance
+    gy, gx = np.gradient(brightness)
+    magnitude = np.hypot(gx, gy)
+    strong = magnitude > 0.08
+    edge_density = float(strong.mean())
+    if strong.any():
+        angles = np.degrees(np.arctan2(gy[strong], gx[strong])) % 90.0
+        axis_aligned_edges = float(np.mean((angles < 10.0) | (angles > 80.0)))
+    else:
+        axis_aligned_edges = 0.0
+
+    # Skin tones in YCbCr
+    cb = 128 + 255 * (-0.168736 * r - 0.331264 * g + 0.5 * b)
+    cr = 128 + 255 * (0.5 * r - 0.418688 * g - 0.081312 * b)
+    skin = float(np.mean((cb > 77) & (cb < 127) & (cr > 133) & (cr < 173) & (brightness > 0.2)))
+
+    return ImageFeatures(
+        aspect_ratio=aspect_ratio,
+        vegetation=vegetation,
+        colour_entropy=colour_entropy,
+        top_colours=top_colours,
+        near_white=near_white,
+        edge_density=edge_density,
+        axis_aligned_edges=axis_aligned_edges,
+        skin=skin,
+    )
+
+
+def classify(features: ImageFeatures) -> Tuple[str, str]:
+    """Return the (verdict, reason) for the features of one image. Rules are deliberately conservative."""
+    if features.near_white > 0.55 and features.colour_entropy < 0.35:
+        return FAIL, "document: mostly white with few colours"
+    if features.top_colours > 0.6 and features.colour_entropy < 0.3:
+        return FAIL, "screenshot or graphic: dominated by a few flat colours"
+    if not 0.4 <= features.aspect_ratio <= 2.5 and features.colour_entropy < 0.45:
+        return FAIL, "screenshot: extreme aspect ratio with flat colours"
+    if features.skin > 0.35 and features.vegetation < 0.02:
+        return FAIL, "selfie or portrait: large skin area and no plants"
+    if (features.vegetation >= 0.05 and features.axis_aligned_edges >= 0.45
+            and features.colour_entropy >= 0.45 and features.skin < 0.25):
+        return PASS, "photo with plants and man-made structure"
+    return UNCERTAIN, "no clear local decision"
+
+
+def prescreen_image(image_bytes: bytes) -> PrescreenResult:
+    features = extract_features(image_bytes)
+    verdict, reason = classify(features)
+    return PrescreenResult(verdict=verdict, reason=reason, features=features)
+
+
+def prescreen_images(images: List[bytes]) -> List[PrescreenResult]:
+    """Pre-screen images given as raw bytes. Undecodable images are "uncertain"."""
+    results = []
+    for image_bytes in images:
+        try:
+            results.append(prescreen_image(image_bytes))
+        except Exception as e:
+            logger.warning(f"Pre-screen could not decode image: {str(e)}")
+            results.append(PrescreenResult(UNCERTAIN, f"undecodable: {str(e)}", None))
+    return results
+
+
+def combine_verdicts(results: List[PrescreenResult]) -> str:
+    """Return the verdict for a set of images: pass if any image passes, fail if all fail,
+    otherwise uncertain (the uncertain images need the LLM)."""
+    verdicts = [result.verdict for result in results]
+    if PASS in verdicts:
+        return PASS
+    if verdicts and all(verdict == FAIL for verdict in verdicts):
+        return FAIL
+    return UNCERTAIN
+
+
+def evaluate(test_images_dir: Path = DEFAULT_TEST_IMAGES_DIR) -> Dict[str, Dict[str, int]]:
+    """Run the pre-screen on negative/ (expected fail) and user*/ (expected pass) image sets.
+
+    Returns:
+        Set verdict counts per expected label
+    """
+    sets: List[Tuple[str, Path]] = [(FAIL, test_images_dir / "negative")]
+    sets.extend((PASS, user_dir) for user_dir in sorted(test_images_dir.glob("user*")))
+
+    summary: Dict[str, Dict[str, int]] = {FAIL: {}, PASS: {}}
+    for expected, directory in sets:
+        paths = [path for path in sorted(directory.iterdir())
+                 if path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES]
+        results = [prescreen_image(path.read_bytes()) for path in paths]
+        for path, result in zip(paths, results):
+            print(f"  {path.relative_to(test_images_dir).as_posix()[:48]:<50}{result.verdict:<10}{result.reason}")
+            print("      " + ", ".join(f"{name}={value:.3f}" for name, value in asdict(result.features).items()))
+        verdict = combine_verdicts(results)
+        summary[expected][verdict] = summary[expected].get(verdict, 0) + 1
+        marker = "WRONG" if verdict not in (expected, UNCERTAIN) else ""
+        print(f"{directory.name}: expected {expected}, got {verdict} {marker}\n")
+    for expected, verdicts in summary.items():
+        print(f"expected {expected}: {verdicts}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the compliance pre-screen on sample images")
+    parser.add_argument("--images", type=Path, default=DEFAULT_TEST_IMAGES_DIR,
+                        help="Directory with a negative/ folder and user*/ folders")
+    evaluate(parser.parse_args().images)
@@ -0,0 +1,266 @@
+"""
+Responsive renditions of the generated garden image.
+
+The image API returns a full-size PNG of a few megabytes, which mobile clients download
+only to show a thumbnail. This module renders resized WebP and AVIF variants of it
+(IMAGE_VARIANT_WIDTHS plus the full width, in IMAGE_VARIANT_FORMATS) and uploads them
+next to the PNG. Encoding is CPU-bound (AVIF takes seconds for a 1024px image), so every
+width is rendered in its own task in a process pool, and its variants are uploaded as soon
+as they are ready.
+
+The variant blob names are derived from the PNG's content hash, so their URLs are known
+before anything is rendered: create_garden_image returns them right away as one srcset
+per format, and the API waits for the uploads like for the PNG itself.
+"""
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from io import BytesIO
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from PIL import Image, features
+
+from city_garden.metrics import registry
+from city_garden.services.image_loader import AzureImageLoader, content_blob_name, register_upload
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {"webp": "image/webp", "avif": "image/avif"}
+
+# Widths below the full width; the full width is always rendered
+VARIANT_WIDTHS = tuple(int(width) for width in os.environ.get("IMAGE_VARIANT_WIDTHS", "320,768").split(",")
+                       if width.strip())
+VARIANT_FORMATS = tuple(name.strip().lower() for name in os.environ.get("IMAGE_VARIANT_FORMATS", "webp,avif").split(",")
+                        if name.strip())
+VARIANT_QUALITY = int(os.environ.get("IMAGE_VARIANT_QUALITY", "75"))
+# libavif encoder speed, 0 (slowest, smallest) to 10; 8 encodes a 1024px image about 1.5x faster than
+# Pillow's default of 6 at a similar size
+AVIF_SPEED = int(os.environ.get("IMAGE_VARIANT_AVIF_SPEED", "8"))
+VARIANT_WORKERS = int(os.environ.get("IMAGE_VARIANT_WORKERS", "2"))
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+
+def image_variants_enabled() -> bool:
+    return os.environ.get("IMAGE_VARIANTS_ENABLED", "true").lower() == "true"
+
+
+def supported_formats(formats: Sequence[str] = VARIANT_FORMATS) -> Tuple[str, ...]:
+    """Return the formats this Pillow build can encode, in the given order."""
+    supported = []
+    for name in formats:
+        if name in CONTENT_TYPES and features.check(name):
+            supported.append(name)
+        else:
+            logger.warning(f"Skipping image variant format '{name}': not supported by this Pillow build")
+    return tuple(supported)
+
+
+def variant_widths(image_width: int, widths: Iterable[int] = VARIANT_WIDTHS) -> List[int]:
+    """Return the widths to render for an image: the configured ones below its width, and its width."""
+    return sorted({width for width in widths if 0 < width < image_width} | {image_width})
+
+
+def render_variants(image_path: str, width: int, formats: Sequence[str],
+                    quality: int = VARIANT_QUALITY) -> Dict[str, bytes]:
+    """Resize an image to a width (keeping its aspect ratio) and encode it in each format.
+
+    Runs in the process pool; the image is passed as a file so the large PNG is not pickled
+    into every task.
+    """
+    with Image.open(image_path) as image:
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    if width != image.width:
+        image = image.resize((width, max(round(image.height * width / image.width), 1)), Image.LANCZOS)
+    encoded = {}
+    for format_name in formats:
+        options = {"speed": AVIF_SPEED} if format_name == "avif" else {}
+        output = BytesIO()
+        image.save(output, format_name.upper(), quality=quality, **options)
+        encoded[format_name] = output.getvalue()
+    return encoded
+
+
+def srcset(urls_by_width: Dict[int, str]) -> str:
+    return ", ".join(f"{url} {width}w" for width, url in sorted(urls_by_width.items()))
+
+
+def srcset_urls(value: str) -> List[str]:
+    """Return the URLs of a srcset; the content-addressed blob URLs contain no spaces or commas."""
+    return [candidate.split()[0] for candidate in value.split(",") if candidate.strip()]
+
+
+def uploaded_variants(variants: Dict[str, str], uploads: Dict[str, Future]) -> Dict[str, str]:
+    """Return the srcsets whose uploads all finished successfully."""
+    def uploaded(url: str) -> bool:
+        upload = uploads.get(url)
+        return upload is not None and upload.done() and not upload.cancelled() and upload.exception() is None
+
+    return {name: value for name, value in variants.items() if all(uploaded(url) for url in srcset_urls(value))}
+
+
+def when_all_done(futures: List[Future], callback: Callable[[], None]) -> None:
+    """Call callback (on the thread finishing the last future) once all futures are done."""
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_: Future) -> None:
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
+
+    if not futures:
+        callback()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def exit_with_parent(parent_pid: int) -> None:
+    """Initializer of pool worker processes: exit once the parent process is gone.
+
+    A pool's workers otherwise outlive a parent that is killed without shutting the pool
+    down (e.g. an API worker on SIGKILL), waiting for tasks forever.
+    """
+    def watch() -> None:
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, name="exit-with-parent", daemon=True).start()
+
+
+def _variant_executor() -> ProcessPoolExecutor:
+    global _executor, _executor_pid
+    with _executor_lock:
+        # One pool per API worker; the pool of a parent process is unusable after a fork
+        if _executor is None or _executor_pid != os.getpid():
+            # Spawned, because forking a process with running threads (uploads, the event loop) is unsafe
+            _executor = ProcessPoolExecutor(max_workers=VARIANT_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=exit_with_parent, initargs=(os.getpid(),))
+            _executor_pid = os.getpid()
+            # Shut the pool down before multiprocessing joins the child processes at exit; in a pool
+            # worker process (e.g. of the batch runner) the join would otherwise wait forever. The
+            # priority is above that of the call queue's own finalizer (10), which stops its feeder
+            # thread and would drop the workers' stop sentinels
+            multiprocessing.util.Finalize(None, _executor.shutdown, exitpriority=20)
+        return _executor
+
+
+def warm_up() -> None:
+    """Start the pool's worker processes ahead of the first image; spawning one takes a second or two."""
+    executor = _variant_executor()
+    for _ in range(VARIANT_WORKERS):
+        executor.submit(os.getpid)
+
+
+def _discard_executor(executor: ProcessPoolExecutor) -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _upload_when_rendered(executor: ProcessPoolExecutor, image_loader: AzureImageLoader, container_name: str,
+                          blob_names: Dict[str, str], uploads: Dict[str, Future], render: Future) -> None:
+    # Runs on the process pool's management thread, so it only submits the uploads
+    try:
+        encoded = render.result()
+    except Exception as err:
+        if isinstance(err, BrokenProcessPool):
+            # A worker died while rendering; the next image starts a new pool
+            _discard_executor(executor)
+        registry.counter("image_variants.failed").inc(len(uploads))
+        for upload in uploads.values():
+            upload.set_exception(err)
+        return
+
+    def finish(upload: Future, blob_name: str, future: Future) -> None:
+        if future.cancelled():
+            upload.set_exception(RuntimeError(f"Upload of {blob_name} was cancelled"))
+        elif future.exception() is not None:
+            registry.counter("image_variants.failed").inc()
+            upload.set_exception(future.exception())
+        else:
+            upload.set_result(future.result())
+
+    for format_name, content in encoded.items():
+        registry.histogram(f"image_variants.{format_name}.bytes").observe(len(content))
+        blob_name = blob_names[format_name]
+        future = image_loader.submit_upload(content, container_name, blob_name, CONTENT_TYPES[format_name])
+        future.add_done_callback(partial(finish, uploads[format_name], blob_name))
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError as err:
+        logger.warning(f"Could not remove {path}: {err}")
+
+
+def submit_variants(image_loader: AzureImageLoader, image_bytes: bytes,
+                    container_name: str) -> Tuple[Dict[str, str], Dict[str, Future]]:
+    """Render and upload the variants of an image in the background.
+
+    Args:
+        image_loader: The loader the variants are uploaded with
+        image_bytes: The full-size image
+        container_name: Target container
+
+    Returns:
+        A srcset per format (e.g. {"webp": "<url> 320w, <url> 768w, <url> 1024w"}), available
+        immediately, and the upload future of each variant URL. The uploads are also registered
+        as pending uploads, so wait_for_upload() and drain_uploads() cover them.
+    """
+    formats = supported_formats()
+    if not formats:
+        return {}, {}
+    with Image.open(BytesIO(image_bytes)) as image:
+        # Only reads the header
+        widths = variant_widths(image.width)
+    # The largest (slowest) variants first, so they don't end up last in the pool's queue
+    widths.reverse()
+
+    executor = _variant_executor()
+    with tempfile.NamedTemporaryFile(prefix="garden-image-", suffix=".png", delete=False) as source:
+        source.write(image_bytes)
+    urls: Dict[str, Dict[int, str]] = {format_name: {} for format_name in formats}
+    uploads: Dict[str, Future] = {}
+    renders: List[Future] = []
+    try:
+        for width in widths:
+            suffix = f"garden_image-{width}w-q{VARIANT_QUALITY}"
+            blob_names = {format_name: content_blob_name(image_bytes, f"{suffix}.{format_name}") for format_name in formats}
+            width_uploads = {format_name: Future() for format_name in formats}
+            for upload in width_uploads.values():
+                upload.set_running_or_notify_cancel()
+            render = executor.submit(render_variants, source.name, width, formats, VARIANT_QUALITY)
+            renders.append(render)
+            render.add_done_callback(
+                partial(_upload_when_rendered, executor, image_loader, container_name, blob_names, width_uploads)
+            )
+            for format_name, upload in width_uploads.items():
+                url = image_loader.blob_url(container_name, blob_names[format_name])
+                register_upload(url, upload)
+                urls[format_name][width] = url
+                uploads[url] = upload
+    except BrokenProcessPool:
+        # A worker died; the next image starts a new pool (variants already submitted fail on their own)
+        _discard_executor(executor)
+        raise
+    finally:
+        when_all_done(renders, partial(_remove_file, source.name))
+    registry.counter("image_variants.submitted").inc(len(uploads))
+    return {format_name: srcset(urls_by_width) for format_name, urls_by_width in urls.items()}, uploads
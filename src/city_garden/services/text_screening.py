@@ -0,0 +1,150 @@
+"""
+Batched safety screening of generated text.
+
+The plant recommendations are written by the LLM, so their descriptions and care tips
+are screened with Azure Content Safety before they are returned. To keep the number of
+calls small, the texts are packed into as few analyze_text requests as the service's
+size limit allows, and the requests run concurrently. Only a batch that is flagged is
+screened again text by text, to find the texts to drop.
+
+screen_recommendations() is the graph node: it runs in parallel with create_garden_image,
+so it adds no latency as long as it is faster than the image generation. It fails open: if the
+service fails, or the run's deadline passes first, the recommendations are kept.
+"""
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Sequence, Set, Tuple
+
+from city_garden.cancellation import check_cancelled
+from city_garden.metrics import registry
+from city_garden.services.content_safety import ContentAnalyzer
+
+logger = logging.getLogger(__name__)
+
+# Azure Content Safety accepts at most 10,000 characters per analyze_text request
+TEXT_SAFETY_MAX_CHARS = int(os.environ.get("TEXT_SAFETY_MAX_CHARS", "10000"))
+# Texts with a severity above this in any category are flagged (severities are 0, 2, 4 and 6)
+TEXT_SAFETY_MAX_SEVERITY = int(os.environ.get("TEXT_SAFETY_MAX_SEVERITY", "2"))
+TEXT_SAFETY_WORKERS = int(os.environ.get("TEXT_SAFETY_WORKERS", "4"))
+
+SEPARATOR = "\n\n"
+
+
+def is_flagged(result, max_severity: int = TEXT_SAFETY_MAX_SEVERITY) -> bool:
+    """Return whether a TextAnalysisResult exceeds the allowed severity in any category."""
+    severities = (result.hate_severity, result.self_harm_severity, result.sexual_severity, result.violence_severity)
+    return any((severity or 0) > max_severity for severity in severities)
+
+
+def batch_texts(texts: Sequence[str], max_chars: int = TEXT_SAFETY_MAX_CHARS) -> List[Tuple[List[int], str]]:
+    """Pack texts into batches of at most max_chars characters.
+
+    Texts longer than the limit are split into pieces, each screened in its own batch slot.
+
+    Returns:
+        (indices of the texts in the batch, batch text) pairs
+    """
+    pieces = []
+    for index, text in enumerate(texts):
+        for start in range(0, len(text), max_chars):
+            pieces.append((index, text[start:start + max_chars]))
+
+    batches: List[Tuple[List[int], List[str]]] = []
+    size = 0
+    for index, piece in pieces:
+        if not batches or size + len(SEPARATOR) + len(piece) > max_chars:
+            batches.append(([], []))
+            size = -len(SEPARATOR)
+        indices, parts = batches[-1]
+        if index not in indices:
+            indices.append(index)
+        parts.append(piece)
+        size += len(SEPARATOR) + len(piece)
+    return [(indices, SEPARATOR.join(parts)) for indices, parts in batches]
+
+
+def screen_texts(analyze_text: Callable[[str], object], texts: Sequence[str],
+                 max_chars: int = TEXT_SAFETY_MAX_CHARS, max_severity: int = TEXT_SAFETY_MAX_SEVERITY) -> Set[int]:
+    """Screen texts with batched, concurrent analyze_text calls.
+
+    Args:
+        analyze_text: ContentAnalyzer.analyze_text or an equivalent
+        texts: The texts to screen
+        max_chars: Maximum characters per call
+        max_severity: Highest allowed severity
+
+    Returns:
+        The indices of the flagged texts
+
+    Raises:
+        Exception: If a screening call fails
+    """
+    batches = batch_texts(texts, max_chars)
+    if not batches:
+        return set()
+    registry.counter("text_safety.batches").inc(len(batches))
+
+    def screen(text: str) -> bool:
+        return is_flagged(analyze_text(text), max_severity)
+
+    def run_all(items: List[str]) -> List[bool]:
+        # Copy the context so the calls keep the run's deadline
+        with ThreadPoolExecutor(max_workers=max(min(TEXT_SAFETY_WORKERS, len(items)), 1),
+                                thread_name_prefix="text-safety") as executor:
+            futures = [executor.submit(contextvars.copy_context().run, screen, item) for item in items]
+            return [future.result() for future in futures]
+
+    flagged: Set[int] = set()
+    suspects = []
+    for (indices, _), batch_flagged in zip(batches, run_all([text for _, text in batches])):
+        if not batch_flagged:
+            continue
+        if len(indices) == 1:
+            flagged.add(indices[0])
+        else:
+            suspects.extend(index for index in indices if index not in suspects)
+    if suspects:
+        # Only a flagged batch is screened again, one text at a time
+        singles = [(index, text) for index in suspects for _, text in batch_texts([texts[index]], max_chars)]
+        for (index, _), text_flagged in zip(singles, run_all([text for _, text in singles])):
+            if text_flagged:
+                flagged.add(index)
+    return flagged
+
+
+def _recommendation_text(recommendation: Any) -> str:
+    if isinstance(recommendation, dict):
+        return "\n".join(str(value) for key, value in recommendation.items() if key != "id" and value)
+    return str(recommendation)
+
+
+def screen_recommendations(state) -> Dict[str, Any]:
+    """
+    Screen the generated plant recommendations (descriptions, care tips) with Azure Content Safety
+    and drop the flagged ones. Runs in parallel with create_garden_image, so it only returns the
+    plant_recommendations update, and only if something was dropped.
+    If the screening service fails, the recommendations are kept.
+    """
+    recommendations = state.get("plant_recommendations") or []
+    if os.environ.get("TEXT_SAFETY_ENABLED", "true").lower() != "true" or not isinstance(recommendations, list):
+        return {}
+    try:
+        content_analyzer = ContentAnalyzer(
+            endpoint=os.environ["AZURE_CONTENT_SAFETY_ENDPOINT"],
+            key=os.environ["AZURE_CONTENT_SAFETY_KEY"]
+        )
+        flagged = screen_texts(content_analyzer.analyze_text,
+                               [_recommendation_text(recommendation) for recommendation in recommendations])
+    except Exception as e:
+        check_cancelled()
+        logger.warning(f"Screening of the plant recommendations failed: {e!r}")
+        registry.counter("text_safety.failed").inc()
+        return {}
+    if not flagged:
+        return {}
+    logger.warning(f"Dropping {len(flagged)} flagged plant recommendations")
+    registry.counter("text_safety.flagged").inc(len(flagged))
+    return {"plant_recommendations": [recommendation for index, recommendation in enumerate(recommendations)
+                                      if index not in flagged]}
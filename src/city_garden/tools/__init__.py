@@ -2,10 +2,20 @@
 Tools package for the city garden project.
 """
 
-from .climate import get_monthly_average_temperature, get_monthly_precipitation, get_wind_pattern
+from .climate import (
+    fetch_daily_batch,
+    fetch_hourly_batch,
+    get_monthly_average_temperature,
+    get_monthly_climate_batch,
+    get_monthly_precipitation,
+    get_wind_pattern,
+)
 
 __all__ = [
     'get_monthly_average_temperature',
     'get_monthly_precipitation',
-    'get_wind_pattern'
+    'get_wind_pattern',
+    'fetch_daily_batch',
+    'fetch_hourly_batch',
+    'get_monthly_climate_batch',
 ] 
\ No newline at end of file
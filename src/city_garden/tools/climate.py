@@ -3,17 +3,269 @@ This class is a tool class for city garden application to get the weather data f
 this is a langGraph tool class, to call the open-meteo api to get the weather data for the city. 
 It get monthly average temperature, monthly rain fall, wind pattern of the location.
 https://open-meteo.com/
+
+fetch_daily_batch(), fetch_hourly_batch() and get_monthly_climate_batch() take many coordinates at once: they are
+sent in chunks of OPEN_METEO_BATCH_SIZE locations per request (the API accepts lists of
+latitudes and longitudes) and return one result per coordinate, in order. A coordinate that
+fails does not fail the others.
 """
 
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple, TypeVar
+
 from langchain_core.tools import tool
 import requests
+import numpy as np
 import openmeteo_requests
 import requests_cache
 import pandas as pd
 from retry_requests import retry
 
+from city_garden.logging_config import log_payload
+from city_garden.metrics import registry
+from city_garden.services.http_replay import requests_session
+
+logger = logging.getLogger(__name__)
+
 API_URL = "https://archive-api.open-meteo.com/v1/archive"
 
+# Locations per multi-location request; long URLs and large responses make bigger chunks slower
+OPEN_METEO_BATCH_SIZE = int(os.environ.get("OPEN_METEO_BATCH_SIZE", "50"))
+
+MONTHLY_VARIABLES = ("temperature_2m_mean", "precipitation_sum", "wind_speed_10m_max")
+
+# Derived climate (climate_derivation, wind_analysis) is cached per grid cell of this size
+CLIMATE_CELL_DEGREES = float(os.environ.get("CLIMATE_CELL_DEGREES", "0.1"))
+
+# Background fetches next to the garden analysis LLM call, one at a time per key
+_climate_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CLIMATE_DERIVATION_WORKERS", "4")),
+    thread_name_prefix="climate"
+)
+_pending: Dict[Hashable, Future] = {}
+_pending_lock = threading.Lock()
+
+T = TypeVar("T")
+
+
+@dataclass
+class ArchiveSeries:
+    """Daily or hourly series of one coordinate of a batch; `error` is set instead of the data if it failed.
+
+    Args:
+        latitude: Requested latitude
+        longitude: Requested longitude
+        times: Local start times of the days or hours (datetime64)
+        values: Values per variable, in the order of the times
+        error: Why the coordinate has no data
+    """
+    latitude: float
+    longitude: float
+    times: Optional[np.ndarray] = None
+    values: Dict[str, np.ndarray] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class MonthlyClimate:
+    """Monthly climate of one coordinate of a batch.
+
+    Args:
+        latitude: Requested latitude
+        longitude: Requested longitude
+        monthly: Mean temperature, total precipitation and mean daily maximum wind speed per
+            month (index 1-12), or None if the coordinate failed
+        error: Why the coordinate has no data
+    """
+    latitude: float
+    longitude: float
+    monthly: Optional[pd.DataFrame] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _client(retries: int = 3) -> openmeteo_requests.Client:
+    # In record/replay mode the cassettes take the place of the response cache
+    session = requests_session() or requests_cache.CachedSession('.cache', expire_after=-1)
+    retry_session = retry(session, retries=retries, backoff_factor=0.2)
+    return openmeteo_requests.Client(session=retry_session)
+
+
+def _coordinate_error(latitude: float, longitude: float) -> Optional[str]:
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return f"Invalid coordinate {latitude}, {longitude}"
+    return None
+
+
+def _series(response, latitude: float, longitude: float, resolution: str, variables: Sequence[str]) -> ArchiveSeries:
+    data = response.Hourly() if resolution == "hourly" else response.Daily()
+    values = {name: data.Variables(index).ValuesAsNumpy() for index, name in enumerate(variables)}
+    # Local times: the timestamps are shifted by the location's UTC offset
+    start = np.datetime64(data.Time() + response.UtcOffsetSeconds(), "s")
+    count = len(next(iter(values.values()))) if values else 0
+    times = start + np.arange(count) * np.timedelta64(data.Interval(), "s")
+    return ArchiveSeries(latitude, longitude, times=times, values=values)
+
+
+def _fetch_chunk(openmeteo, coordinates: Sequence[Tuple[float, float]], resolution: str,
+                 params: Dict) -> List[ArchiveSeries]:
+    responses = openmeteo.weather_api(API_URL, params={
+        **params,
+        "latitude": [latitude for latitude, _ in coordinates],
+        "longitude": [longitude for _, longitude in coordinates],
+    })
+    registry.counter("open_meteo.requests").inc()
+    if len(responses) != len(coordinates):
+        raise ValueError(f"Expected {len(coordinates)} locations in the response, got {len(responses)}")
+    return [_series(response, latitude, longitude, resolution, params[resolution])
+            for response, (latitude, longitude) in zip(responses, coordinates)]
+
+
+def _fetch_batch(coordinates: Sequence[Tuple[float, float]], resolution: str, variables: Sequence[str],
+                 start_date: str, end_date: str, timezone: str, chunk_size: Optional[int]) -> List[ArchiveSeries]:
+    chunk_size = max(chunk_size or OPEN_METEO_BATCH_SIZE, 1)
+    params = {"start_date": start_date, "end_date": end_date, resolution: list(variables), "timezone": timezone}
+    results: List[Optional[ArchiveSeries]] = [None] * len(coordinates)
+    valid = []
+    for index, (latitude, longitude) in enumerate(coordinates):
+        error = _coordinate_error(latitude, longitude)
+        if error:
+            results[index] = ArchiveSeries(latitude, longitude, error=error)
+        else:
+            valid.append(index)
+
+    openmeteo = _client()
+    for offset in range(0, len(valid), chunk_size):
+        indices = valid[offset:offset + chunk_size]
+        chunk = [coordinates[index] for index in indices]
+        try:
+            series = _fetch_chunk(openmeteo, chunk, resolution, params)
+        except Exception as e:
+            if len(chunk) == 1:
+                series = [ArchiveSeries(*chunk[0], error=repr(e))]
+            else:
+                logger.warning(f"Open-Meteo request for {len(chunk)} locations failed ({e!r}), retrying them one by one")
+                registry.counter("open_meteo.chunk_failures").inc()
+                series = []
+                for coordinate in chunk:
+                    try:
+                        series.extend(_fetch_chunk(openmeteo, [coordinate], resolution, params))
+                    except Exception as single_error:
+                        series.append(ArchiveSeries(*coordinate, error=repr(single_error)))
+        for index, result in zip(indices, series):
+            results[index] = result
+
+    failed = sum(not result.ok for result in results)
+    if failed:
+        registry.counter("open_meteo.failed_coordinates").inc(failed)
+        logger.warning(f"No Open-Meteo data for {failed} of {len(coordinates)} coordinates")
+    return results
+
+
+def fetch_daily_batch(coordinates: Sequence[Tuple[float, float]], daily: Sequence[str], start_date: str,
+                      end_date: str, timezone: str = "auto", chunk_size: Optional[int] = None) -> List[ArchiveSeries]:
+    """Fetch daily archive series for many coordinates with multi-location requests.
+
+    A chunk that fails is retried one coordinate at a time, so a single bad coordinate
+    only fails itself.
+
+    Args:
+        coordinates: (latitude, longitude) pairs
+        daily: Daily variables, e.g. ["temperature_2m_min"]
+        start_date: First day, "YYYY-MM-DD"
+        end_date: Last day, "YYYY-MM-DD"
+        timezone: Timezone of the days; "auto" uses each location's local time
+        chunk_size: Locations per request (default OPEN_METEO_BATCH_SIZE)
+
+    Returns:
+        One ArchiveSeries per coordinate, in the order of `coordinates`
+    """
+    return _fetch_batch(coordinates, "daily", daily, start_date, end_date, timezone, chunk_size)
+
+
+def fetch_hourly_batch(coordinates: Sequence[Tuple[float, float]], hourly: Sequence[str], start_date: str,
+                       end_date: str, timezone: str = "auto", chunk_size: Optional[int] = None) -> List[ArchiveSeries]:
+    """Fetch hourly archive series for many coordinates; see fetch_daily_batch()."""
+    return _fetch_batch(coordinates, "hourly", hourly, start_date, end_date, timezone, chunk_size)
+
+
+def grid_cell(value: float) -> float:
+    """Round a latitude or longitude to the centre of its CLIMATE_CELL_DEGREES grid cell."""
+    return round(round(value / CLIMATE_CELL_DEGREES) * CLIMATE_CELL_DEGREES, 4)
+
+
+def submit_once(key: Hashable, fn: Callable[..., T], *args) -> "Future[T]":
+    """Run fn(*args) on the climate executor; calls with the key of a pending call share its future."""
+    with _pending_lock:
+        future = _pending.get(key)
+        if future is not None:
+            return future
+        future = _climate_executor.submit(fn, *args)
+        _pending[key] = future
+    # Outside the lock: the callback runs right away if the call has already finished
+    future.add_done_callback(lambda done: _forget_pending(key, done))
+    return future
+
+
+def _forget_pending(key: Hashable, future: Future) -> None:
+    with _pending_lock:
+        if _pending.get(key) is future:
+            del _pending[key]
+
+
+def monthly_climate(series: ArchiveSeries) -> pd.DataFrame:
+    """Aggregate a daily series of MONTHLY_VARIABLES by calendar month."""
+    frame = pd.DataFrame({name: series.values[name] for name in MONTHLY_VARIABLES})
+    months = frame.groupby(series.times.astype("datetime64[M]").astype(int) % 12 + 1)
+    monthly = months[["temperature_2m_mean", "wind_speed_10m_max"]].mean()
+    # Total precipitation per month, averaged over the years of the series
+    years = len(np.unique(series.times.astype("datetime64[Y]")))
+    monthly.insert(1, "precipitation_sum", months["precipitation_sum"].sum() / years)
+    monthly.index.name = "month"
+    return monthly
+
+
+def get_monthly_climate_batch(coordinates: Sequence[Tuple[float, float]], start_date: str = "2024-01-01",
+                              end_date: str = "2024-12-31", chunk_size: Optional[int] = None) -> List[MonthlyClimate]:
+    """Return the monthly climate of many coordinates, in order; failed coordinates carry an error.
+
+    Args:
+        coordinates: (latitude, longitude) pairs
+        start_date: First day of the period, "YYYY-MM-DD"
+        end_date: Last day of the period, "YYYY-MM-DD"
+        chunk_size: Locations per request (default OPEN_METEO_BATCH_SIZE)
+    """
+    results = []
+    for series in fetch_daily_batch(coordinates, MONTHLY_VARIABLES, start_date, end_date, chunk_size=chunk_size):
+        if not series.ok:
+            results.append(MonthlyClimate(series.latitude, series.longitude, error=series.error))
+            continue
+        results.append(MonthlyClimate(series.latitude, series.longitude, monthly=monthly_climate(series)))
+    return results
+
+def _monthly_mean(latitude: float, longitude: float, variable: str) -> pd.DataFrame:
+    """Monthly mean of one daily variable of 2024, in Berlin time like the tools always used."""
+    series = fetch_daily_batch([(latitude, longitude)], [variable], "2024-01-01", "2024-12-31",
+                               timezone="Europe/Berlin")[0]
+    if not series.ok:
+        raise ValueError(f"No Open-Meteo data for {latitude}, {longitude}: {series.error}")
+    daily_dataframe = pd.DataFrame({"date": pd.to_datetime(series.times), variable: series.values[variable]})
+    log_payload(logger, "Daily data", daily_dataframe)
+    # Labelled by the first day of the month; pandas 3 no longer accepts 'M'
+    return daily_dataframe.resample('MS', on='date').mean()
+
+
 @tool
 def get_monthly_average_temperature(latitude: float, longitude: float) -> str:
     """Get the monthly average temperature of 2024 for the location.
@@ -25,50 +277,9 @@ def get_monthly_average_temperature(latitude: float, longitude: float) -> str:
     Returns:
         str: The monthly average temperature of 2024 for the location.
     """
-    print(f"Getting monthly average temperature for {latitude}, {longitude}")
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-    
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "start_date": "2024-01-01",
-        "end_date": "2024-12-31",
-        "daily": "temperature_2m_mean",
-        "timezone": "Europe/Berlin"
-    }
-    responses = openmeteo.weather_api(API_URL, params=params)
-    
-    # Process first location. Add a for-loop for multiple locations or weather models
-    response = responses[0]
-    print(f"Coordinates {response.Latitude()}°N {response.Longitude()}°E")
-    print(f"Elevation {response.Elevation()} m asl")
-    print(f"Timezone {response.Timezone()}{response.TimezoneAbbreviation()}")
-    print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")
-
-    # Process daily data. The order of variables needs to be the same as requested.
-    daily = response.Daily()
-    daily_temperature_2m_mean = daily.Variables(0).ValuesAsNumpy()
-
-    daily_data = {"date": pd.date_range(
-        start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-        end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-        freq=pd.Timedelta(seconds=daily.Interval()),
-        inclusive="left"
-    )}
-
-    daily_data["temperature_2m_mean"] = daily_temperature_2m_mean
-
-    daily_dataframe = pd.DataFrame(data=daily_data)
-    print(daily_dataframe)   
-
-    # Now group by month and calculate monthly average
-    monthly_avg = daily_dataframe.resample('M', on='date').mean()
-
-    print("\nMonthly Average Temperature Data:")
-    print(monthly_avg)
-
+    logger.info(f"Getting monthly average temperature for {latitude}, {longitude}")
+    monthly_avg = _monthly_mean(latitude, longitude, "temperature_2m_mean")
+    log_payload(logger, "Monthly average temperature", monthly_avg)
     return monthly_avg
 
 @tool
@@ -81,50 +292,9 @@ def get_wind_pattern(latitude: float, longitude: float) -> str:
     Returns:
         str: The wind pattern for the location.
     """
-    print(f"Getting wind pattern for {latitude}, {longitude}")
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-    
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "start_date": "2024-01-01",
-        "end_date": "2024-12-31",
-        "daily": "wind_speed_10m_max",
-        "timezone": "Europe/Berlin"
-    }
-    responses = openmeteo.weather_api(API_URL, params=params)
-    
-    # Process first location. Add a for-loop for multiple locations or weather models
-    response = responses[0]
-    print(f"Coordinates {response.Latitude()}°N {response.Longitude()}°E")
-    print(f"Elevation {response.Elevation()} m asl")
-    print(f"Timezone {response.Timezone()}{response.TimezoneAbbreviation()}")
-    print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")
-
-    # Process daily data. The order of variables needs to be the same as requested.
-    daily = response.Daily()
-    daily_wind_speed_10m_max = daily.Variables(0).ValuesAsNumpy()
-
-    daily_data = {"date": pd.date_range(
-        start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-        end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-        freq=pd.Timedelta(seconds=daily.Interval()),
-        inclusive="left"
-    )}
-
-    daily_data["wind_speed_10m_max"] = daily_wind_speed_10m_max
-
-    daily_dataframe = pd.DataFrame(data=daily_data)
-    print(daily_dataframe)
-    
-    # Now group by month and calculate monthly average
-    monthly_avg = daily_dataframe.resample('M', on='date').mean()
-    
-    print("\nMonthly Average Wind Speed Data:")
-    print(monthly_avg)
-    
+    logger.info(f"Getting wind pattern for {latitude}, {longitude}")
+    monthly_avg = _monthly_mean(latitude, longitude, "wind_speed_10m_max")
+    log_payload(logger, "Monthly average wind speed", monthly_avg)
     return monthly_avg
 
 @tool
@@ -137,48 +307,7 @@ def get_monthly_precipitation(latitude: float, longitude: float) -> str:
     Returns:
         str: The monthly precipitation of 2024 for the location.
     """
-    print(f"Getting monthly precipitation for {latitude}, {longitude}")
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-    
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "start_date": "2024-01-01",
-        "end_date": "2024-12-31",
-        "daily": "precipitation_sum",
-        "timezone": "Europe/Berlin"
-    }
-    responses = openmeteo.weather_api(API_URL, params=params)
-    
-    # Process first location. Add a for-loop for multiple locations or weather models
-    response = responses[0]
-    print(f"Coordinates {response.Latitude()}°N {response.Longitude()}°E")
-    print(f"Elevation {response.Elevation()} m asl")
-    print(f"Timezone {response.Timezone()}{response.TimezoneAbbreviation()}")
-    print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")
-
-    # Process daily data. The order of variables needs to be the same as requested.
-    daily = response.Daily()
-    daily_precipitation_sum = daily.Variables(0).ValuesAsNumpy()
-
-    daily_data = {"date": pd.date_range(
-        start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-        end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-        freq=pd.Timedelta(seconds=daily.Interval()),
-        inclusive="left"
-    )}
-
-    daily_data["precipitation_sum"] = daily_precipitation_sum
-
-    daily_dataframe = pd.DataFrame(data=daily_data)
-    print(daily_dataframe)
-    
-    # Now group by month and calculate monthly average
-    monthly_avg = daily_dataframe.resample('M', on='date').mean()
-    
-    print("\nMonthly Average Precipitation Data:")
-    print(monthly_avg)
-    
-    return monthly_avg
\ No newline at end of file
+    logger.info(f"Getting monthly precipitation for {latitude}, {longitude}")
+    monthly_avg = _monthly_mean(latitude, longitude, "precipitation_sum")
+    log_payload(logger, "Monthly average precipitation", monthly_avg)
+    return monthly_avg
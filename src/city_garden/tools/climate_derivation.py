@@ -0,0 +1,198 @@
+"""
+Planting-relevant climate derived from the Open-Meteo daily archive.
+
+The monthly means of the climate tools are too coarse to judge winter hardiness or the
+planting window. This module fetches several years of daily minimum and mean temperatures
+for a location and derives, with NumPy over a (years x 365 days) matrix:
+- the hardiness zone from the mean of the annual extreme minimum temperatures (USDA scale,
+  which most European plant references use as well)
+- the median last spring frost and first autumn frost dates and the frost-free season
+- the growing degree days above 10 °C per year
+
+Profiles are cached per grid cell (CLIMATE_CELL_DEGREES), so nearby gardens share one
+archive request and repeated plans for a location cost nothing.
+"""
+import functools
+import logging
+import math
+import os
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional, Tuple
+
+import numpy as np
+
+from city_garden.metrics import registry
+from city_garden.tools.climate import fetch_daily_batch, grid_cell, submit_once
+
+logger = logging.getLogger(__name__)
+
+DAYS = 365
+# Day index of midsummer in a season: spring frosts fall before it, autumn frosts after it
+MIDSUMMER = 182
+FROST_C = 0.0
+GDD_BASE_C = 10.0
+DAILY_VARIABLES = ("temperature_2m_min", "temperature_2m_mean")
+
+CLIMATE_YEARS = int(os.environ.get("CLIMATE_DERIVATION_YEARS", "10"))
+
+
+@dataclass(frozen=True)
+class ClimateProfile:
+    """Derived climate of a grid cell.
+
+    Args:
+        latitude: Latitude of the cell centre
+        longitude: Longitude of the cell centre
+        years: Number of complete years the profile is based on
+        extreme_min_c: Mean of the annual extreme minimum temperatures, in °C
+        hardiness_zone: USDA hardiness zone (1-13)
+        hardiness_label: Zone with its half, e.g. "7b"
+        last_frost: Median last spring frost, e.g. "Apr 12", or None without frost
+        first_frost: Median first autumn frost, or None without frost
+        frost_free_days: Median length of the frost-free season
+        gdd: Mean growing degree days above 10 °C per year
+    """
+    latitude: float
+    longitude: float
+    years: int
+    extreme_min_c: float
+    hardiness_zone: int
+    hardiness_label: str
+    last_frost: Optional[str]
+    first_frost: Optional[str]
+    frost_free_days: int
+    gdd: float
+
+    def describe(self) -> str:
+        """Summary for the environment factors of the garden analysis."""
+        if self.last_frost and self.first_frost:
+            frost = (f"last spring frost around {self.last_frost}, first autumn frost around {self.first_frost} "
+                     f"({self.frost_free_days} frost-free days)")
+        else:
+            frost = "usually no frost"
+        return (f"USDA hardiness zone {self.hardiness_label} (mean annual minimum {self.extreme_min_c:.1f} °C), "
+                f"{frost}, {self.gdd:.0f} growing degree days above {GDD_BASE_C:.0f} °C per year "
+                f"(derived from {self.years} years of daily data)")
+
+
+def hardiness_zone(extreme_min_c: float) -> Tuple[int, str]:
+    """Return the USDA zone and its label ("7b") for a mean annual extreme minimum in °C.
+
+    Zones are 10 °F wide starting at -60 °F (zone 1); each has an "a" and a "b" half.
+    """
+    offset = extreme_min_c * 9 / 5 + 32 + 60
+    zone = min(max(math.floor(offset / 10) + 1, 1), 13)
+    half = "a" if offset - (zone - 1) * 10 < 5 else "b"
+    return zone, f"{zone}{half}"
+
+
+def season_matrix(dates: np.ndarray, values: np.ndarray, southern: bool = False) -> np.ndarray:
+    """Arrange a daily series as a (seasons x 365) matrix; February 29 is dropped.
+
+    A season is a calendar year in the northern hemisphere and runs from July 1 in the
+    southern one, so midsummer is at MIDSUMMER in both. Incomplete seasons are dropped.
+    """
+    days = dates.astype("datetime64[D]")
+    years = days.astype("datetime64[Y]")
+    day_of_year = (days - years).astype(int)
+    leap = (years.astype(int) + 1970) % 4 == 0
+    keep = ~(leap & (day_of_year == 59))
+    day_of_year = np.where(leap & (day_of_year > 59), day_of_year - 1, day_of_year)[keep]
+    year_index = (years.astype(int) - years.astype(int).min())[keep]
+    calendar = np.full((year_index.max() + 1, DAYS), np.nan)
+    calendar[year_index, day_of_year] = values[keep]
+    if southern:
+        shift = DAYS - MIDSUMMER
+        calendar = calendar.reshape(-1)[shift:shift - DAYS].reshape(-1, DAYS) if len(calendar) > 1 else calendar[:0]
+    return calendar[~np.isnan(calendar).any(axis=1)]
+
+
+def _day_label(season_day: float, southern: bool) -> str:
+    day = (int(round(season_day)) + (DAYS - MIDSUMMER if southern else 0)) % DAYS
+    return (date(2001, 1, 1) + timedelta(days=day)).strftime("%b %d")
+
+
+def derive_profile(latitude: float, longitude: float, dates: np.ndarray, temperature_min: np.ndarray,
+                   temperature_mean: np.ndarray) -> ClimateProfile:
+    """Derive the climate profile from daily minimum and mean temperatures.
+
+    Raises:
+        ValueError: If the series does not cover a complete season
+    """
+    southern = latitude < 0
+    minimum = season_matrix(dates, temperature_min, southern)
+    mean = season_matrix(dates, temperature_mean, southern)
+    if not len(minimum) or len(minimum) != len(mean):
+        raise ValueError("The daily series does not cover a complete season")
+
+    extreme_min = float(minimum.min(axis=1).mean())
+    zone, label = hardiness_zone(extreme_min)
+
+    frost = minimum <= FROST_C
+    spring, autumn = frost[:, :MIDSUMMER], frost[:, MIDSUMMER:]
+    # Seasons without a spring (autumn) frost have no last (first) frost date
+    last = np.where(spring.any(axis=1), MIDSUMMER - 1 - spring[:, ::-1].argmax(axis=1), np.nan)
+    first = np.where(autumn.any(axis=1), MIDSUMMER + autumn.argmax(axis=1), np.nan)
+    frost_free = np.nan_to_num(first, nan=DAYS) - np.nan_to_num(last, nan=-1) - 1
+    has_frost = not np.isnan(last).all() and not np.isnan(first).all()
+
+    gdd = float(np.clip(mean - GDD_BASE_C, 0, None).sum(axis=1).mean())
+    return ClimateProfile(
+        latitude=latitude,
+        longitude=longitude,
+        years=len(minimum),
+        extreme_min_c=round(extreme_min, 1),
+        hardiness_zone=zone,
+        hardiness_label=label,
+        last_frost=_day_label(np.nanmedian(last), southern) if has_frost else None,
+        first_frost=_day_label(np.nanmedian(first), southern) if has_frost else None,
+        frost_free_days=int(np.median(frost_free)),
+        gdd=round(gdd, 1),
+    )
+
+
+def fetch_daily_temperatures(latitude: float, longitude: float, years: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fetch the daily minimum and mean temperatures of the last `years` complete years.
+
+    Returns:
+        The local dates (datetime64), the daily minimums and the daily means
+
+    Raises:
+        RuntimeError: If the archive has no data for the location
+    """
+    end_year = date.today().year - 1
+    series = fetch_daily_batch([(latitude, longitude)], DAILY_VARIABLES,
+                               f"{end_year - years + 1}-01-01", f"{end_year}-12-31")[0]
+    if not series.ok:
+        raise RuntimeError(series.error)
+    return series.times, series.values["temperature_2m_min"], series.values["temperature_2m_mean"]
+
+
+@functools.lru_cache(maxsize=int(os.environ.get("CLIMATE_CACHE_SIZE", "1024")))
+def _cell_profile(latitude: float, longitude: float, years: int) -> ClimateProfile:
+    logger.info(f"Deriving the climate of cell {latitude}, {longitude} from {years} years of daily data")
+    registry.counter("climate_derivation.fetches").inc()
+    with registry.timer("climate_derivation.fetch.seconds"):
+        dates, temperature_min, temperature_mean = fetch_daily_temperatures(latitude, longitude, years)
+    return derive_profile(latitude, longitude, dates, temperature_min, temperature_mean)
+
+
+def climate_profile(latitude: float, longitude: float, years: int = CLIMATE_YEARS) -> ClimateProfile:
+    """Return the derived climate of the grid cell containing the location; cached per cell.
+
+    Raises:
+        Exception: If the archive cannot be fetched (failures are not cached)
+    """
+    return _cell_profile(grid_cell(latitude), grid_cell(longitude), years)
+
+
+def climate_derivation_enabled() -> bool:
+    return os.environ.get("CLIMATE_DERIVATION_ENABLED", "true").lower() == "true"
+
+
+def submit_climate_profile(latitude: float, longitude: float, years: int = CLIMATE_YEARS) -> Future:
+    """Derive the climate profile in the background; concurrent requests for a cell share one fetch."""
+    key = (grid_cell(latitude), grid_cell(longitude), years)
+    return submit_once(("climate_profile", *key), _cell_profile, *key)
@@ -0,0 +1,326 @@
+"""
+Local plant knowledge index for the plant recommender.
+
+The plants in data/plants.csv are indexed with one integer bitset per attribute value
+(bit i stands for plant i), so a multi-attribute query is a handful of AND operations.
+Hardiness is indexed per USDA zone: a plant is in a zone's bitset if it survives the
+winter there (annuals are grown for one season and are in every zone).
+
+shortlist() returns the plants that match all constraints first and then relaxes the
+softest constraints (wind, cycle, light, edibility, plant category, in this order) until
+there are enough candidates. The shortlist goes into the recommender prompt, so the model ranks
+known candidates instead of generating plants freely.
+
+Light and wind levels are read from the free-text analysis by whole phrases, skipping negated
+ones ("no strong winds"); a description that mentions contradicting levels gives no constraint.
+"""
+import csv
+import logging
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLANTS_PATH = Path(__file__).resolve().parents[1] / "data" / "plants.csv"
+
+ZONES = range(1, 14)
+LIGHT_LEVELS = ("full_sun", "partial_shade", "shade")
+WIND_LEVELS = ("low", "medium", "high")
+CYCLES = ("annual", "biennial", "perennial")
+
+# Growing in a container is roughly one zone colder than growing in the ground
+CONTAINER_ZONE_PENALTY = 1
+
+# User preference values (stems) mapped to plant categories
+SUBTYPE_CATEGORIES = {
+    "herb": {"herb"},
+    "vegetable": {"vegetable"},
+    "veggie": {"vegetable"},
+    "fruit": {"fruit"},
+    "berr": {"fruit"},
+    "flower": {"flower"},
+    "bloom": {"flower"},
+    "foliage": {"foliage"},
+    "leaf": {"foliage"},
+    "succulent": {"succulent"},
+    "cact": {"succulent"},
+    "climb": {"climber"},
+    "vine": {"climber"},
+    "grass": {"grass"},
+    "shrub": {"shrub"},
+}
+
+
+@dataclass(frozen=True)
+class Plant:
+    name: str
+    latin_name: str
+    category: str
+    cycle: str
+    edible: bool
+    min_zone: int
+    max_zone: int
+    light: Tuple[str, ...]
+    wind_tolerance: str
+    container: bool
+
+    def describe(self) -> str:
+        """One-line summary for the recommender prompt."""
+        traits = [self.cycle, self.category, "edible" if self.edible else "ornamental",
+                  "/".join(level.replace("_", " ") for level in self.light),
+                  f"{self.wind_tolerance} wind tolerance"]
+        if self.cycle != "annual":
+            traits.append(f"hardy in zones {self.min_zone}-{self.max_zone}")
+        return f"{self.name} ({self.latin_name}): {', '.join(traits)}"
+
+
+@dataclass(frozen=True)
+class PlantQuery:
+    """Constraints of a shortlist query; None means "any".
+
+    Args:
+        zone: USDA hardiness zone the plants must overwinter in
+        light: Light level of the garden ("full_sun", "partial_shade" or "shade")
+        wind: Minimum wind tolerance ("low", "medium" or "high")
+        cycle: "annual", "biennial" or "perennial"
+        edible: Only edible (True) or only ornamental (False) plants
+        categories: Plant categories, e.g. {"herb", "vegetable"}
+        container: Only plants suitable for containers
+    """
+    zone: Optional[int] = None
+    light: Optional[str] = None
+    wind: Optional[str] = None
+    cycle: Optional[str] = None
+    edible: Optional[bool] = None
+    categories: Optional[FrozenSet[str]] = None
+    container: bool = True
+
+
+def _bits(indices: Iterable[int]) -> int:
+    bits = 0
+    for index in indices:
+        bits |= 1 << index
+    return bits
+
+
+def _bits_or(bitsets: Iterable[int]) -> int:
+    bits = 0
+    for bitset in bitsets:
+        bits |= bitset
+    return bits
+
+
+class PlantIndex:
+    """Bitset index over a list of plants."""
+
+    def __init__(self, plants: List[Plant]):
+        self.plants = list(plants)
+        self.all = (1 << len(self.plants)) - 1
+        indexed = list(enumerate(self.plants))
+        self._zones = {zone: _bits(i for i, p in indexed if p.cycle == "annual" or p.min_zone <= zone <= p.max_zone)
+                       for zone in ZONES}
+        self._light = {level: _bits(i for i, p in indexed if level in p.light) for level in LIGHT_LEVELS}
+        # Plants tolerating at least the given wind level
+        self._wind = {level: _bits(i for i, p in indexed
+                                   if WIND_LEVELS.index(p.wind_tolerance) >= WIND_LEVELS.index(level))
+                      for level in WIND_LEVELS}
+        self._cycle = {cycle: _bits(i for i, p in indexed if p.cycle == cycle) for cycle in CYCLES}
+        self._categories: Dict[str, int] = {}
+        for i, plant in indexed:
+            self._categories[plant.category] = self._categories.get(plant.category, 0) | (1 << i)
+        self._edible = _bits(i for i, p in indexed if p.edible)
+        self._container = _bits(i for i, p in indexed if p.container)
+
+    @classmethod
+    def from_csv(cls, path: Path = DEFAULT_PLANTS_PATH) -> "PlantIndex":
+        with open(path, newline="", encoding="utf-8") as file:
+            plants = [
+                Plant(
+                    name=row["name"],
+                    latin_name=row["latin_name"],
+                    category=row["category"],
+                    cycle=row["cycle"],
+                    edible=row["edible"] == "yes",
+                    min_zone=int(row["min_zone"]),
+                    max_zone=int(row["max_zone"]),
+                    light=tuple(row["light"].split("|")),
+                    wind_tolerance=row["wind_tolerance"],
+                    container=row["container"] == "yes",
+                )
+                for row in csv.DictReader(file)
+            ]
+        return cls(plants)
+
+    def _constraints(self, query: PlantQuery) -> List[int]:
+        """Return the bitsets of the query's constraints, softest first."""
+        constraints = []
+        # Wind and light are read from the free-text analysis, so they give way before the user's preferences
+        if query.wind in self._wind:
+            constraints.append(self._wind[query.wind])
+        if query.cycle in self._cycle:
+            constraints.append(self._cycle[query.cycle])
+        if query.light in self._light:
+            constraints.append(self._light[query.light])
+        if query.edible is not None:
+            constraints.append(self._edible if query.edible else self.all & ~self._edible)
+        if query.categories:
+            constraints.append(_bits_or(self._categories.get(category, 0) for category in query.categories))
+        if query.zone is not None:
+            zone = min(max(query.zone, ZONES[0]), ZONES[-1])
+            constraints.append(self._zones[zone])
+        if query.container:
+            constraints.append(self._container)
+        return constraints
+
+    def matching(self, query: PlantQuery) -> int:
+        """Return the bitset of the plants matching every constraint of the query."""
+        bits = self.all
+        for constraint in self._constraints(query):
+            bits &= constraint
+        return bits
+
+    def plants_of(self, bits: int) -> List[Plant]:
+        """Return the plants of a bitset, in index order."""
+        plants = []
+        while bits:
+            lowest = bits & -bits
+            plants.append(self.plants[lowest.bit_length() - 1])
+            bits ^= lowest
+        return plants
+
+    def shortlist(self, query: PlantQuery, limit: int = 12) -> List[Plant]:
+        """Return up to `limit` candidates: exact matches first, then matches of relaxed queries.
+
+        Constraints are dropped softest first; the zone and container constraints are never dropped.
+        """
+        constraints = self._constraints(query)
+        hard = (query.zone is not None) + bool(query.container)
+        candidates: List[Plant] = []
+        selected = 0
+        for dropped in range(len(constraints) - hard + 1):
+            bits = self.all
+            for constraint in constraints[dropped:]:
+                bits &= constraint
+            candidates.extend(self.plants_of(bits & ~selected))
+            selected |= bits
+            if len(candidates) >= limit:
+                break
+        return candidates[:limit]
+
+
+def _phrases(*phrases: str) -> "re.Pattern[str]":
+    """Compile phrases into one pattern that matches whole words only ("high" not in "high-rise")."""
+    return re.compile("|".join(rf"(?<![\w-])(?:{phrase})(?![\w-])" for phrase in phrases))
+
+
+LIGHT_PHRASES = {
+    "partial_shade": _phrases(r"partial(?:ly)?(?: sun(?:ny)?| shade[ds]?| shady)?", r"part[- ](?:sun|shade)",
+                              r"semi[- ]?(?:shade[ds]?|shady|sunny)", r"dappled(?: light| shade| sun(?:light)?)?",
+                              r"(?:morning|afternoon|evening)(?: sun(?:light)?| shade)?",
+                              r"(?:a )?few hours of (?:direct )?sun(?:light)?"),
+    "shade": _phrases(r"(?:full |deep |heavy )?shade[ds]?", r"shady", r"north(?:ern)?(?:[- ]facing)?",
+                      r"indirect(?: light| sun(?:light)?)?", r"little (?:direct )?sun(?:light)?",
+                      r"no direct (?:sun(?:light)?|light)", r"low light"),
+    "full_sun": _phrases(r"full sun(?:light)?", r"direct sun(?:light)?", r"south(?:ern)?(?:[- ]facing)?",
+                         r"sunny", r"sun all day", r"all[- ]day sun(?:light)?"),
+}
+WIND_PHRASES = {
+    "high": _phrases(r"strong(?: winds?| gusts?)?", r"high winds?", r"high(?: wind)? exposure", r"(?:very )?windy",
+                     r"exposed", r"gust(?:s|y)?", r"wind[- ]?swept", r"wind tunnel"),
+    "medium": _phrases(r"moderate(?:ly windy| winds?| breezes?)?", r"medium(?: winds?)?", r"breez(?:e|es|y)"),
+    "low": _phrases(r"sheltered", r"protected", r"shielded", r"calm", r"still air", r"enclosed",
+                    r"(?:low|little|no) winds?"),
+}
+# A phrase after one of these words in the same clause is negated ("no strong winds")
+_NEGATION = re.compile(r"(?<![\w-])(?:no|not|never|without|hardly|barely|free of|(?:sheltered|protected|shielded) from)"
+                       r"(?![\w-])|n't\b")
+_CLAUSE_BOUNDARY = re.compile(r"[,;.:!?()]|\b(?:but|although|though|while|whereas|except)\b")
+
+
+def _mentioned_levels(text: str, phrases: Dict[str, "re.Pattern[str]"]) -> Set[str]:
+    """Return the levels whose phrases occur in the text, leaving out negated phrases.
+
+    A phrase that is part of a longer phrase (e.g. "shade" in "partial shade" or "direct sun"
+    in "no direct sun") counts only as the longer one.
+    """
+    levels = set()
+    for clause in _CLAUSE_BOUNDARY.split(text.lower()):
+        matches = [(match.start(), match.end(), level)
+                   for level, pattern in phrases.items() for match in pattern.finditer(clause)]
+        for start, end, level in matches:
+            if any(other_start <= start and end <= other_end and other_end - other_start > end - start
+                   for other_start, other_end, _ in matches):
+                continue
+            if _NEGATION.search(clause, 0, start):
+                continue
+            levels.add(level)
+    return levels
+
+
+def _light_level(sun_exposure: str) -> Optional[str]:
+    levels = _mentioned_levels(sun_exposure, LIGHT_PHRASES)
+    # Sun for part of the day and shade for the rest is partial shade
+    if "partial_shade" in levels or {"full_sun", "shade"} <= levels:
+        return "partial_shade"
+    return levels.pop() if len(levels) == 1 else None
+
+
+def _wind_level(wind_pattern: str) -> Optional[str]:
+    levels = _mentioned_levels(wind_pattern, WIND_PHRASES)
+    # Contradicting descriptions ("sheltered, but exposed to gusts") are no constraint
+    return levels.pop() if len(levels) == 1 else None
+
+
+def build_query(user_preferences: Optional[Dict[str, str]], sun_exposure: str = "", wind_pattern: str = "",
+                hardiness_zone: Optional[int] = None, wind_exposure: Optional[str] = None,
+                light_level: Optional[str] = None) -> PlantQuery:
+    """Build a shortlist query from the user's preferences and the garden analysis.
+
+    Args:
+        user_preferences: growType, subType, cycleType and winterType as sent by the client
+        sun_exposure: Sun exposure from the garden analysis (free text)
+        wind_pattern: Wind pattern from the garden analysis (free text)
+        hardiness_zone: USDA hardiness zone of the location, if known
+        wind_exposure: Measured wind exposure ("low", "medium" or "high"); takes precedence over wind_pattern
+        light_level: Computed light level (see LIGHT_LEVELS); takes precedence over sun_exposure
+    """
+    preferences = {key: str(value).lower() for key, value in (user_preferences or {}).items()}
+    grow_type = preferences.get("growType", "")
+    sub_type = preferences.get("subType", "")
+    cycle = preferences.get("cycleType", "")
+    categories = {category for stem, mapped in SUBTYPE_CATEGORIES.items() if stem in sub_type for category in mapped}
+    # Plants that spend the winter indoors do not need to be hardy
+    zone = None
+    if hardiness_zone is not None and "indoor" not in preferences.get("winterType", ""):
+        zone = hardiness_zone - CONTAINER_ZONE_PENALTY
+    return PlantQuery(
+        zone=zone,
+        light=light_level if light_level in LIGHT_LEVELS else _light_level(sun_exposure or ""),
+        wind=wind_exposure if wind_exposure in WIND_LEVELS else _wind_level(wind_pattern or ""),
+        cycle=next((name for name in CYCLES if name in cycle), None),
+        # Ornamental gardens may still have edible flowers or herbs
+        edible=True if "edible" in grow_type else None,
+        categories=frozenset(categories) or None,
+    )
+
+
+def format_candidates(plants: List[Plant]) -> str:
+    return "\n".join(f"- {plant.describe()}" for plant in plants)
+
+
+def plant_shortlist_from_env(user_preferences: Optional[Dict[str, str]], sun_exposure: str = "",
+                             wind_pattern: str = "", hardiness_zone: Optional[int] = None,
+                             wind_exposure: Optional[str] = None, light_level: Optional[str] = None) -> List[Plant]:
+    """Shortlist candidates with the settings from the environment (PLANT_INDEX_*); empty if disabled."""
+    if os.environ.get("PLANT_INDEX_ENABLED", "true").lower() != "true":
+        return []
+    query = build_query(user_preferences, sun_exposure, wind_pattern, hardiness_zone, wind_exposure, light_level)
+    candidates = plant_index.shortlist(query, limit=int(os.environ.get("PLANT_INDEX_SHORTLIST_SIZE", "12")))
+    logger.info(f"Plant shortlist for {query}: {len(candidates)} candidates")
+    return candidates
+
+
+plant_index = PlantIndex.from_csv(Path(os.environ.get("PLANT_INDEX_PATH", DEFAULT_PLANTS_PATH)))
@@ -0,0 +1,198 @@
+"""
+Sun path and direct-sun hours of a balcony.
+
+Instead of having the vision model infer sun exposure from shadows, the sun position is
+computed with the NOAA solar equations for every SOLAR_STEP_MINUTES of a reference year,
+as one NumPy array per quantity. A balcony gets direct sun while the sun is:
+- in front of its facade (within 90° of the direction the balcony faces) and
+- above the obstruction horizon (e.g. the buildings across the street, in degrees)
+
+The result is the mean number of direct-sun hours per day for each month and a light
+level for the plant shortlist. Profiles are memoized per (grid cell, facing, horizon).
+"""
+import functools
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from city_garden.tools.climate import grid_cell
+
+logger = logging.getLogger(__name__)
+
+COMPASS_POINTS = ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+                  "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW")
+COMPASS_WORDS = {"NORTH": "N", "EAST": "E", "SOUTH": "S", "WEST": "W"}
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+# Sun positions are computed for a non-leap reference year; they barely change between years
+REFERENCE_YEAR = 2025
+SOLAR_STEP_MINUTES = int(os.environ.get("SOLAR_STEP_MINUTES", "10"))
+
+# Mean direct-sun hours per day in the growing season for each light level
+FULL_SUN_HOURS = 6.0
+PARTIAL_SHADE_HOURS = 3.0
+
+
+def parse_facing(facing: Union[str, float]) -> float:
+    """Return the direction a balcony faces in degrees from north (clockwise).
+
+    Accepts degrees ("200", 200.0), compass points ("SW", "SSE") and words ("south-west").
+
+    Raises:
+        ValueError: If the direction is not understood
+    """
+    try:
+        return float(facing) % 360
+    except (TypeError, ValueError):
+        pass
+    text = str(facing).upper().replace("-", "").replace(" ", "")
+    for word, point in COMPASS_WORDS.items():
+        text = text.replace(word, point)
+    if text not in COMPASS_POINTS:
+        raise ValueError(f"Unknown facing direction '{facing}'")
+    return COMPASS_POINTS.index(text) * 360 / len(COMPASS_POINTS)
+
+
+def compass_point(degrees: float) -> str:
+    return COMPASS_POINTS[int((degrees % 360) / (360 / len(COMPASS_POINTS)) + 0.5) % len(COMPASS_POINTS)]
+
+
+def time_grid(step_minutes: int = SOLAR_STEP_MINUTES) -> np.ndarray:
+    """Return the UTC times of the reference year, every `step_minutes` (datetime64[m])."""
+    start = np.datetime64(f"{REFERENCE_YEAR}-01-01T00:00", "m")
+    end = np.datetime64(f"{REFERENCE_YEAR + 1}-01-01T00:00", "m")
+    return np.arange(start, end, np.timedelta64(step_minutes, "m"))
+
+
+def sun_position(latitude: float, longitude: float, times: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the sun's elevation and azimuth (degrees from north, clockwise) at UTC times.
+
+    NOAA solar calculator equations, without atmospheric refraction.
+    """
+    minutes = times.astype("datetime64[m]").astype(np.int64)
+    julian_day = minutes / 1440.0 + 2440587.5
+    t = (julian_day - 2451545.0) / 36525.0
+
+    mean_longitude = np.radians((280.46646 + t * (36000.76983 + t * 0.0003032)) % 360)
+    mean_anomaly = np.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    eccentricity = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+    center = (np.sin(mean_anomaly) * (1.914602 - t * (0.004817 + 0.000014 * t))
+              + np.sin(2 * mean_anomaly) * (0.019993 - 0.000101 * t)
+              + np.sin(3 * mean_anomaly) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * t)
+    apparent_longitude = np.radians(np.degrees(mean_longitude) + center - 0.00569 - 0.00478 * np.sin(omega))
+    mean_obliquity = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60
+    obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+    declination = np.arcsin(np.sin(obliquity) * np.sin(apparent_longitude))
+
+    y = np.tan(obliquity / 2) ** 2
+    equation_of_time = 4 * np.degrees(
+        y * np.sin(2 * mean_longitude)
+        - 2 * eccentricity * np.sin(mean_anomaly)
+        + 4 * eccentricity * y * np.sin(mean_anomaly) * np.cos(2 * mean_longitude)
+        - 0.5 * y * y * np.sin(4 * mean_longitude)
+        - 1.25 * eccentricity * eccentricity * np.sin(2 * mean_anomaly)
+    )
+    true_solar_time = (minutes % 1440 + equation_of_time + 4 * longitude) % 1440
+    hour_angle = np.radians(true_solar_time / 4 - 180)
+
+    phi = np.radians(latitude)
+    cos_zenith = np.clip(np.sin(phi) * np.sin(declination)
+                         + np.cos(phi) * np.cos(declination) * np.cos(hour_angle), -1, 1)
+    zenith = np.arccos(cos_zenith)
+    elevation = 90 - np.degrees(zenith)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cos_azimuth = (np.sin(phi) * cos_zenith - np.sin(declination)) / (np.cos(phi) * np.sin(zenith))
+    azimuth = np.degrees(np.arccos(np.clip(np.nan_to_num(cos_azimuth), -1, 1)))
+    azimuth = np.where(hour_angle > 0, (azimuth + 180) % 360, (540 - azimuth) % 360)
+    return elevation, azimuth
+
+
+@dataclass(frozen=True)
+class SunProfile:
+    """Direct sun on a balcony.
+
+    Args:
+        latitude: Latitude of the cell centre
+        longitude: Longitude of the cell centre
+        facing: Direction the balcony faces, degrees from north
+        horizon_angle: Elevation of the obstruction horizon in front of the balcony, degrees
+        monthly_hours: Mean direct-sun hours per day, January to December
+        season_hours: Mean direct-sun hours per day in the growing season
+        light_level: "full_sun", "partial_shade" or "shade" (the light levels of the plant index)
+    """
+    latitude: float
+    longitude: float
+    facing: float
+    horizon_angle: float
+    monthly_hours: Tuple[float, ...]
+    season_hours: float
+    light_level: str
+
+    def describe(self) -> str:
+        """Summary for the sun exposure of the garden analysis."""
+        obstruction = f", obstructions up to {self.horizon_angle:.0f}°" if self.horizon_angle else ""
+        months = ", ".join(f"{month} {hours:.1f}" for month, hours in zip(MONTHS, self.monthly_hours))
+        return (f"{compass_point(self.facing)}-facing{obstruction}: {self.season_hours:.1f} h of direct sun per day "
+                f"in the growing season ({self.light_level.replace('_', ' ')}); hours per day by month: {months}")
+
+
+def light_level(season_hours: float) -> str:
+    if season_hours >= FULL_SUN_HOURS:
+        return "full_sun"
+    if season_hours >= PARTIAL_SHADE_HOURS:
+        return "partial_shade"
+    return "shade"
+
+
+def compute_sun_profile(latitude: float, longitude: float, facing: float, horizon_angle: float = 0.0,
+                        step_minutes: int = SOLAR_STEP_MINUTES) -> SunProfile:
+    """Compute the direct-sun hours of a balcony over the reference year."""
+    times = time_grid(step_minutes)
+    elevation, azimuth = sun_position(latitude, longitude, times)
+    in_front = np.abs((azimuth - facing + 180) % 360 - 180) < 90
+    lit = in_front & (elevation > max(horizon_angle, 0.0))
+
+    # Months in UTC; the few hours shifted across a month boundary do not change the means
+    month = times.astype("datetime64[M]").astype(np.int64) % 12
+    steps_per_month = np.bincount(month, minlength=12)
+    hours_per_day = np.bincount(month, weights=lit, minlength=12) / steps_per_month * 24
+    # April to September in the northern hemisphere, October to March in the southern one
+    season = slice(3, 9)
+    season_hours = float(hours_per_day[season].mean() if latitude >= 0 else np.delete(hours_per_day, season).mean())
+    return SunProfile(
+        latitude=latitude,
+        longitude=longitude,
+        facing=facing,
+        horizon_angle=horizon_angle,
+        monthly_hours=tuple(round(float(hours), 1) for hours in hours_per_day),
+        season_hours=round(season_hours, 1),
+        light_level=light_level(season_hours),
+    )
+
+
+@functools.lru_cache(maxsize=int(os.environ.get("SOLAR_CACHE_SIZE", "4096")))
+def _cached_sun_profile(latitude: float, longitude: float, facing: float, horizon_angle: float) -> SunProfile:
+    return compute_sun_profile(latitude, longitude, facing, horizon_angle)
+
+
+def sun_profile(latitude: float, longitude: float, facing: Union[str, float],
+                horizon_angle: Optional[float] = None) -> SunProfile:
+    """Return the sun profile of a balcony, memoized per grid cell, whole degree of facing and horizon.
+
+    Args:
+        latitude: Latitude of the balcony
+        longitude: Longitude of the balcony
+        facing: Direction the balcony faces; see parse_facing()
+        horizon_angle: Elevation of the obstruction horizon in degrees (0 for an open view)
+    """
+    return _cached_sun_profile(grid_cell(latitude), grid_cell(longitude),
+                               float(round(parse_facing(facing))) % 360, float(round(horizon_angle or 0)))
+
+
+def solar_enabled() -> bool:
+    return os.environ.get("SOLAR_ENABLED", "true").lower() == "true"
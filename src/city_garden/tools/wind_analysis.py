@@ -0,0 +1,185 @@
+"""
+Wind rose and exposure of a location from the hourly Open-Meteo archive.
+
+get_wind_pattern() only has monthly means of the daily maximum speed, which says nothing
+about direction. This module fetches a year of hourly wind speed, direction and gusts
+(about 8,760 points per year) and reduces them with NumPy binning to:
+- a 16-sector wind rose (share of the non-calm hours per direction) and the direction
+  most strong winds come from
+- gust percentiles
+- the prevailing direction, mean speed and gusts per season
+- an exposure level ("low", "medium" or "high") for the plant shortlist
+
+Profiles are cached per grid cell (CLIMATE_CELL_DEGREES), like the climate derivation.
+"""
+import functools
+import logging
+import os
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional, Tuple
+
+import numpy as np
+
+from city_garden.metrics import registry
+from city_garden.tools.climate import fetch_hourly_batch, grid_cell, submit_once
+
+logger = logging.getLogger(__name__)
+
+SECTORS = ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW")
+SECTOR_DEGREES = 360 / len(SECTORS)
+# Meteorological seasons; month % 12 // 3 is the index
+SEASONS = ("Dec-Feb", "Mar-May", "Jun-Aug", "Sep-Nov")
+HOURLY_VARIABLES = ("wind_speed_10m", "wind_direction_10m", "wind_gusts_10m")
+
+# Speeds in km/h at 10 m
+CALM_KMH = 2.0
+# Beaufort 6 ("strong breeze") and up
+STRONG_KMH = 39.0
+GUST_PERCENTILES = (50, 90, 99)
+
+WIND_YEARS = int(os.environ.get("WIND_ANALYSIS_YEARS", "1"))
+
+
+@dataclass(frozen=True)
+class SeasonWind:
+    season: str
+    prevailing: Optional[str]
+    mean_speed_kmh: float
+    gust_p90_kmh: float
+
+
+@dataclass(frozen=True)
+class WindProfile:
+    """Wind of a grid cell.
+
+    Args:
+        latitude: Latitude of the cell centre
+        longitude: Longitude of the cell centre
+        hours: Number of hours with data
+        rose: Share of the non-calm hours per sector (SECTORS order), in percent
+        calm_share: Share of calm hours, in percent
+        prevailing: Sector most non-calm winds come from
+        strong_from: Sector most strong winds come from, or None without strong winds
+        mean_speed_kmh: Mean wind speed
+        gusts_kmh: Gust speed per percentile in GUST_PERCENTILES, then the maximum
+        seasons: Wind per season (SEASONS order)
+        exposure: "low", "medium" or "high"
+    """
+    latitude: float
+    longitude: float
+    hours: int
+    rose: Tuple[float, ...]
+    calm_share: float
+    prevailing: Optional[str]
+    strong_from: Optional[str]
+    mean_speed_kmh: float
+    gusts_kmh: Tuple[float, ...]
+    seasons: Tuple[SeasonWind, ...]
+    exposure: str
+
+    def describe(self) -> str:
+        """Compact summary for the wind pattern of the garden analysis."""
+        parts = []
+        if self.prevailing:
+            share = self.rose[SECTORS.index(self.prevailing)]
+            parts.append(f"prevailing wind from {self.prevailing} ({share:.0f}% of windy hours)")
+        if self.strong_from:
+            parts.append(f"strong winds mostly from {self.strong_from}")
+        p50, p90, p99, maximum = self.gusts_kmh
+        parts.append(f"mean speed {self.mean_speed_kmh:.0f} km/h, gusts {p50:.0f}/{p90:.0f}/{p99:.0f} km/h "
+                     f"(median/90th/99th percentile), max {maximum:.0f} km/h")
+        seasons = "; ".join(f"{season.season} from {season.prevailing or 'variable'} {season.mean_speed_kmh:.0f} km/h"
+                            for season in self.seasons if not np.isnan(season.mean_speed_kmh))
+        parts.append(f"by season: {seasons}")
+        return f"{self.exposure} exposure; " + ", ".join(parts)
+
+
+def exposure_level(mean_speed_kmh: float, gust_p90_kmh: float) -> str:
+    """Map wind statistics to the wind levels of the plant index."""
+    if mean_speed_kmh >= 20 or gust_p90_kmh >= 55:
+        return "high"
+    if mean_speed_kmh >= 12 or gust_p90_kmh >= 40:
+        return "medium"
+    return "low"
+
+
+def analyze_wind(latitude: float, longitude: float, times: np.ndarray, speed: np.ndarray, direction: np.ndarray,
+                 gusts: np.ndarray) -> WindProfile:
+    """Compute the wind profile from hourly speed (km/h), direction (degrees) and gusts (km/h).
+
+    Raises:
+        ValueError: If there are no hours with data
+    """
+    valid = ~(np.isnan(speed) | np.isnan(direction) | np.isnan(gusts))
+    times, speed, direction, gusts = times[valid], speed[valid], direction[valid], gusts[valid]
+    if not len(speed):
+        raise ValueError("No hourly wind data")
+
+    sector = (((direction + SECTOR_DEGREES / 2) // SECTOR_DEGREES) % len(SECTORS)).astype(int)
+    windy = speed >= CALM_KMH
+    rose_counts = np.bincount(sector[windy], minlength=len(SECTORS))
+    strong_counts = np.bincount(sector[speed >= STRONG_KMH], minlength=len(SECTORS))
+    rose = rose_counts / max(rose_counts.sum(), 1) * 100
+
+    month = times.astype("datetime64[M]").astype(int) % 12 + 1
+    season = month % 12 // 3
+    hours_per_season = np.bincount(season, minlength=len(SEASONS))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        season_speed = np.bincount(season, weights=speed, minlength=len(SEASONS)) / hours_per_season
+    season_rose = np.bincount(season[windy] * len(SECTORS) + sector[windy],
+                              minlength=len(SEASONS) * len(SECTORS)).reshape(len(SEASONS), len(SECTORS))
+    seasons = tuple(
+        SeasonWind(
+            season=name,
+            prevailing=SECTORS[season_rose[index].argmax()] if season_rose[index].any() else None,
+            mean_speed_kmh=round(float(season_speed[index]), 1),
+            gust_p90_kmh=round(float(np.percentile(gusts[season == index], 90)), 1) if hours_per_season[index] else float("nan"),
+        )
+        for index, name in enumerate(SEASONS)
+    )
+
+    gust_percentiles = np.percentile(gusts, GUST_PERCENTILES)
+    mean_speed = float(speed.mean())
+    return WindProfile(
+        latitude=latitude,
+        longitude=longitude,
+        hours=len(speed),
+        rose=tuple(round(float(share), 1) for share in rose),
+        calm_share=round(float((~windy).mean() * 100), 1),
+        prevailing=SECTORS[rose_counts.argmax()] if rose_counts.any() else None,
+        strong_from=SECTORS[strong_counts.argmax()] if strong_counts.any() else None,
+        mean_speed_kmh=round(mean_speed, 1),
+        gusts_kmh=tuple(round(float(value), 1) for value in (*gust_percentiles, gusts.max())),
+        seasons=seasons,
+        exposure=exposure_level(mean_speed, float(gust_percentiles[GUST_PERCENTILES.index(90)])),
+    )
+
+
+@functools.lru_cache(maxsize=int(os.environ.get("CLIMATE_CACHE_SIZE", "1024")))
+def _cell_wind(latitude: float, longitude: float, years: int) -> WindProfile:
+    logger.info(f"Analyzing the wind of cell {latitude}, {longitude} from {years} years of hourly data")
+    registry.counter("wind_analysis.fetches").inc()
+    end_year = date.today().year - 1
+    with registry.timer("wind_analysis.fetch.seconds"):
+        series = fetch_hourly_batch([(latitude, longitude)], HOURLY_VARIABLES,
+                                    f"{end_year - years + 1}-01-01", f"{end_year}-12-31")[0]
+    if not series.ok:
+        raise RuntimeError(series.error)
+    return analyze_wind(latitude, longitude, series.times, *(series.values[name] for name in HOURLY_VARIABLES))
+
+
+def wind_profile(latitude: float, longitude: float, years: int = WIND_YEARS) -> WindProfile:
+    """Return the wind profile of the grid cell containing the location; cached per cell."""
+    return _cell_wind(grid_cell(latitude), grid_cell(longitude), years)
+
+
+def wind_analysis_enabled() -> bool:
+    return os.environ.get("WIND_ANALYSIS_ENABLED", "true").lower() == "true"
+
+
+def submit_wind_profile(latitude: float, longitude: float, years: int = WIND_YEARS) -> Future:
+    """Analyze the wind in the background; concurrent requests for a cell share one fetch."""
+    key = (grid_cell(latitude), grid_cell(longitude), years)
+    return submit_once(("wind_profile", *key), _cell_wind, *key)
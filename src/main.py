@@ -5,8 +5,12 @@ import os
 from city_garden.garden_state import GardenState
 from city_garden.services.image_loader import AzureImageLoader
 from city_garden.services.content_safety import ContentAnalyzer
+from city_garden.services.image_dedup import deduplicate_images_from_env
+from city_garden.image_store import image_store
+from city_garden.logging_config import configure_logging
 from city_garden.services.image_generation import generate_image
 def main():
+    configure_logging()
     
     #[TODO] create API to be called by frontend
     #[TODO] API should take in the user's input (location, langtitude, altitude, user preferences, balcony image URLs) and return the garden design image and plant recommendations
@@ -29,6 +33,9 @@ def main():
     if len(garden_image_contents) == 0:
         raise ValueError("No images loaded")
     
+    # Collapse photos taken from almost the same angle
+    garden_image_contents = deduplicate_images_from_env(garden_image_contents)
+    
     # Check content safety
     content_analyzer = ContentAnalyzer(
         endpoint=os.environ["AZURE_CONTENT_SAFETY_ENDPOINT"],
@@ -50,6 +57,9 @@ def main():
     # Create the graph
     graph = build_garden_graph()
     
+    # The state references the images by id
+    image_ids = image_store.put_base64(garden_image_contents)
+    
     # Initialize the state
     initial_state = GardenState(
         sun_exposure="",
@@ -59,29 +69,22 @@ def main():
         environment_factors="",
         wind_pattern="",
         style_preferences="Ornamental plants",
+        user_preferences={"growType": "ornamental"},
         plant_recommendations=[],
         location="Berlin, Germany",
         latitude=52.52,
         longitude=13.405,
-        images=garden_image_contents,
+        image_ids=image_ids,
         messages=[]
     )
     
     # Run the graph
-    final_state = graph.invoke(initial_state)
+    try:
+        final_state = graph.invoke(initial_state)
+    finally:
+        image_store.release(image_ids)
     
-    # Check content safety of the final output
-    """final_output = final_state["final_output"]
-    analysis_result = content_analyzer.analyze_image_data(final_output)
-    if analysis_result.hate_severity > 0.5 or analysis_result.self_harm_severity > 0.5 or analysis_result.sexual_severity > 0.5 or analysis_result.violence_severity > 0.5:
-        raise ValueError("Final output content safety check failed")"""
-    # else:
-    #     #print all the analysis results
-    #     print(f"Hate severity: {analysis_result.hate_severity}")
-    #     print(f"Self harm severity: {analysis_result.self_harm_severity}")
-    #     print(f"Sexual severity: {analysis_result.sexual_severity}")
-    #     print(f"Violence severity: {analysis_result.violence_severity}")
-
+    # The generated recommendations were screened by the graph (screen_recommendations)
     
     # Print the final output
     # print("\n=== FINAL GARDEN DESIGN REPORT ===\n")
@@ -99,12 +102,9 @@ def main():
         
         
     # Print the garden image
-    from PIL import Image
     print("\n=== GARDEN IMAGE ===\n")
-    if final_state.get("garden_image"):
-        garden_image = final_state["garden_image"]
-        img = Image.open("balcony.png")
-        img.show()
+    if final_state.get("garden_image_url"):
+        print(final_state["garden_image_url"])
     else:
         print("No garden image available. The compliance check may have failed.")
 
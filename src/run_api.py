@@ -1,5 +1,67 @@
+"""
+Run the City Garden API.
+
+With one worker (the default) the app is served by uvicorn in this process. With more
+workers it is served by gunicorn with uvicorn workers: the app, the compiled graph and
+the prompt registry are loaded once in the master and shared with the forked workers,
+and on SIGTERM each worker stops accepting requests and finishes in-flight plans and
+image uploads within the graceful timeout.
+
+Usage:
+    python src/run_api.py
+    python src/run_api.py --workers 4 --port 8000
+"""
+import argparse
+import os
+
 import uvicorn
-from api import app
+
+
+def run_multiprocess(host: str, port: int, workers: int, graceful_timeout: int, timeout: int) -> None:
+    """Serve the app with gunicorn, preloading it before the workers are forked."""
+    from gunicorn.app.base import BaseApplication
+
+    class GardenApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from api import app
+            return app
+
+    GardenApplication({
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        "graceful_timeout": graceful_timeout,
+        "timeout": timeout,
+    }).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the City Garden API")
+    parser.add_argument("--host", default=os.environ.get("API_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("API_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", "1")),
+                        help="Number of worker processes (more than 1 requires gunicorn)")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.environ.get("API_GRACEFUL_TIMEOUT", "60")),
+                        help="Seconds a worker may take to finish in-flight requests on shutdown")
+    parser.add_argument("--timeout", type=int, default=int(os.environ.get("API_WORKER_TIMEOUT", "300")),
+                        help="Seconds after which an unresponsive worker is restarted")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_multiprocess(args.host, args.port, args.workers, args.graceful_timeout, args.timeout)
+    else:
+        from api import app
+        uvicorn.run(app, host=args.host, port=args.port, timeout_graceful_shutdown=args.graceful_timeout)
+
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    main()
@@ -0,0 +1,7 @@
+"""
+Shared test setup: the city_garden package lives in src/.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,112 @@
+"""
+Tests for admission control: the wait queue, its timeouts, and that every slot's permit is returned.
+"""
+import asyncio
+import time
+
+import pytest
+
+from city_garden.admission import AdmissionController, AdmissionRejected
+from city_garden.cancellation import CancelScope, use_scope
+
+
+def controller(name, queue_timeout=0.05):
+    return AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=queue_timeout, name=name)
+
+
+async def hold(admission, entered, release):
+    async with admission.slot():
+        entered.set()
+        await release.wait()
+
+
+def test_a_full_queue_is_rejected():
+    async def main():
+        admission = controller("test_admission_full", queue_timeout=10)
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(admission, entered, release))
+        await entered.wait()
+        waiter = asyncio.create_task(hold(admission, asyncio.Event(), release))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected, match="capacity"):
+            async with admission.slot():
+                pass
+        release.set()
+        await asyncio.gather(holder, waiter)
+
+    asyncio.run(main())
+
+
+def test_a_timed_out_wait_is_rejected_and_returns_no_permit():
+    async def main():
+        admission = controller("test_admission_timeout")
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(admission, entered, release))
+        await entered.wait()
+        with pytest.raises(AdmissionRejected, match="Timed out"):
+            async with admission.slot():
+                pass
+        release.set()
+        await holder
+        await asyncio.sleep(0)
+        assert admission._semaphore._value == 1
+        assert admission._waiting == 0
+        async with admission.slot():
+            assert admission._semaphore._value == 0
+        assert admission._semaphore._value == 1
+
+    asyncio.run(main())
+
+
+def test_the_wait_is_capped_by_the_request_deadline():
+    async def main():
+        admission = controller("test_admission_deadline", queue_timeout=10)
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(admission, entered, release))
+        await entered.wait()
+        started = time.monotonic()
+        with use_scope(CancelScope(budget=0.05)):
+            with pytest.raises(AdmissionRejected):
+                async with admission.slot():
+                    pass
+        assert time.monotonic() - started < 1
+        release.set()
+        await holder
+        assert admission._semaphore._value == 1
+
+    asyncio.run(main())
+
+
+def test_a_cancelled_waiter_returns_no_permit():
+    async def main():
+        admission = controller("test_admission_cancelled", queue_timeout=10)
+        entered, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(admission, entered, release))
+        await entered.wait()
+        waiter = asyncio.create_task(hold(admission, asyncio.Event(), asyncio.Event()))
+        await asyncio.sleep(0)
+        # The slot frees up in the same loop iteration that the waiter is cancelled
+        release.set()
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await holder
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0)
+        assert admission._semaphore._value == 1
+        assert admission._waiting == 0
+
+    asyncio.run(main())
+
+
+def test_the_slot_is_released_when_the_plan_fails():
+    async def main():
+        admission = controller("test_admission_error")
+        with pytest.raises(RuntimeError):
+            async with admission.slot():
+                raise RuntimeError("graph failed")
+        assert admission._semaphore._value == 1
+        async with admission.slot():
+            pass
+
+    asyncio.run(main())
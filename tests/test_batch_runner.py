@@ -0,0 +1,81 @@
+"""
+Tests for the batch runner's manifest: reading it, resuming from the output and validating items.
+"""
+import json
+
+import pytest
+
+from batch_runner import ManifestError, finished_items, read_manifest, validate_item
+
+ITEM = {
+    "image_urls": ["balcony.jpg"],
+    "location": {"latitude": 52.52, "longitude": 13.405, "address": "Berlin", "facing": "SW"},
+    "user_preferences": {"growType": "Edible", "subType": "Herbs", "cycleType": "Perennial",
+                         "winterType": "Outdoor"},
+}
+
+
+def write_lines(path, *lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return path
+
+
+def test_read_manifest_numbers_items_without_an_id(tmp_path):
+    manifest = write_lines(tmp_path / "manifest.jsonl", '{"id": "a"}', "", '{"location": {}}')
+    assert [item["id"] for item in read_manifest(manifest)] == ["a", "3"]
+
+
+@pytest.mark.parametrize("lines", [
+    ('{"id": "a"}', '{"id": "a"}'),
+    # An explicit id may collide with the line number of an item without one
+    ('{}', '{"id": 1}'),
+])
+def test_read_manifest_rejects_duplicate_ids(tmp_path, lines):
+    manifest = write_lines(tmp_path / "manifest.jsonl", *lines)
+    with pytest.raises(ManifestError, match="duplicate id"):
+        list(read_manifest(manifest))
+
+
+@pytest.mark.parametrize("line", ["[1, 2]", "{not json"])
+def test_read_manifest_rejects_lines_that_are_not_objects(tmp_path, line):
+    manifest = write_lines(tmp_path / "manifest.jsonl", '{"id": "a"}', line)
+    with pytest.raises(ManifestError, match="manifest.jsonl:2"):
+        list(read_manifest(manifest))
+
+
+def results_file(tmp_path):
+    results = [{"id": "a", "status": "ok"}, {"id": "b", "status": "error"}, {"id": 3, "status": "ok"}]
+    # The last result was cut off by an interrupted run
+    return write_lines(tmp_path / "results.jsonl", *map(json.dumps, results), '{"id": "d", "sta')
+
+
+def test_finished_items_skip_a_truncated_last_line(tmp_path):
+    assert finished_items(results_file(tmp_path)) == {"a", "b", "3"}
+
+
+def test_finished_items_with_retry_failed(tmp_path):
+    assert finished_items(results_file(tmp_path), retry_failed=True) == {"a", "3"}
+
+
+def test_finished_items_without_output(tmp_path):
+    assert finished_items(tmp_path / "missing.jsonl") == set()
+
+
+def test_validate_item_accepts_a_garden_plan():
+    validate_item(ITEM)
+    validate_item({**ITEM, "language": "zh", "location": {**ITEM["location"], "horizon_angle": 30}})
+
+
+@pytest.mark.parametrize("changes, message", [
+    ({"image_urls": []}, "image_urls"),
+    ({"image_urls": ["1.jpg", "2.jpg", "3.jpg", "4.jpg"]}, "image_urls"),
+    ({"image_urls": "balcony.jpg"}, "image_urls"),
+    ({"location": {"latitude": 52.52, "longitude": 13.405}}, "location"),
+    ({"location": {**ITEM["location"], "facing": "up"}}, "facing"),
+    ({"location": {**ITEM["location"], "horizon_angle": 90}}, "horizon_angle"),
+    ({"user_preferences": {"growType": "Edible"}}, "user_preferences"),
+    ({"language": "fr"}, "language"),
+])
+def test_validate_item_rejects(changes, message):
+    with pytest.raises(ManifestError, match=message):
+        validate_item({**ITEM, **changes})
@@ -0,0 +1,114 @@
+"""
+Tests for run cancellation and deadlines.
+"""
+import asyncio
+import time
+
+import pytest
+
+from city_garden.cancellation import (CancelScope, DeadlineExceeded, RunCancelled, check_out_of_time, optional,
+                                      use_scope)
+from city_garden.metrics import registry
+
+
+class ReadTimeout(Exception):
+    """Named like the httpx/openai timeouts."""
+
+
+def test_a_client_timeout_is_the_stage_running_out_of_time():
+    with use_scope(CancelScope(budget=60)):
+        with pytest.raises(DeadlineExceeded):
+            check_out_of_time(ReadTimeout("read timed out"), "create_garden_image")
+        with pytest.raises(DeadlineExceeded):
+            check_out_of_time(asyncio.TimeoutError(), "create_garden_image")
+
+
+def test_a_failure_just_before_the_deadline_is_the_stage_running_out_of_time():
+    with use_scope(CancelScope(budget=0.5)):
+        with pytest.raises(DeadlineExceeded):
+            check_out_of_time(ConnectionError("connection reset"), "create_garden_image")
+
+
+def test_other_failures_with_time_left_are_ordinary_errors():
+    with use_scope(CancelScope(budget=60)):
+        check_out_of_time(ConnectionError("connection reset"), "create_garden_image")
+    # Without a deadline, only timeouts count
+    check_out_of_time(ValueError("bad image"), "create_garden_image")
+
+
+def test_a_cancelled_run_stays_cancelled():
+    scope = CancelScope(budget=60)
+    scope.cancel("client disconnected")
+    with use_scope(scope):
+        with pytest.raises(RunCancelled) as raised:
+            check_out_of_time(ReadTimeout(), "create_garden_image")
+    assert not isinstance(raised.value, DeadlineExceeded)
+
+
+def test_check_passes_while_there_is_time_left():
+    CancelScope().check("analyze")
+    CancelScope(budget=60).check("analyze")
+
+
+def test_check_after_the_deadline():
+    scope = CancelScope(budget=0.01)
+    time.sleep(0.02)
+    exceeded = registry.counter("deadline.exceeded.test_check_deadline")
+    before = exceeded.value
+    with pytest.raises(DeadlineExceeded):
+        scope.check("test_check_deadline")
+    assert exceeded.value == before + 1
+    assert scope.remaining() == 0.0
+
+
+def test_cancellation_wins_over_the_deadline():
+    scope = CancelScope(budget=0)
+    scope.cancel("client disconnected")
+    skipped = registry.counter("cancellation.skipped.test_check_cancelled")
+    before = skipped.value
+    with pytest.raises(RunCancelled, match="client disconnected") as raised:
+        scope.check("test_check_cancelled")
+    assert not isinstance(raised.value, DeadlineExceeded)
+    assert skipped.value == before + 1
+
+
+def image_node(state):
+    return {"garden_image_url": "https://blob/garden.png"}
+
+
+def test_optional_stage_runs_with_enough_time():
+    node = optional("test_optional_runs", image_node, min_budget=10)
+    assert node({"skipped_stages": []}) == {"garden_image_url": "https://blob/garden.png"}
+    with use_scope(CancelScope(budget=60)):
+        assert node({"skipped_stages": []}) == {"garden_image_url": "https://blob/garden.png"}
+
+
+def test_optional_stage_is_skipped_without_its_minimum_budget():
+    calls = []
+    node = optional("test_optional_budget", lambda state: calls.append(state), min_budget=10)
+    skipped = registry.counter("deadline.skipped.test_optional_budget")
+    before = skipped.value
+    with use_scope(CancelScope(budget=5)):
+        assert node({"skipped_stages": ["screen"]}) == {"skipped_stages": ["screen", "test_optional_budget"]}
+    assert calls == []
+    assert skipped.value == before + 1
+
+
+def test_optional_stage_that_runs_out_of_time_does_not_fail_the_run():
+    def slow_node(state):
+        raise DeadlineExceeded("image generation ran out of time")
+
+    node = optional("test_optional_deadline", slow_node, min_budget=0)
+    with use_scope(CancelScope(budget=60)):
+        assert node({}) == {"skipped_stages": ["test_optional_deadline"]}
+
+
+@pytest.mark.parametrize("error", [RunCancelled("client disconnected"), ValueError("bad image")])
+def test_optional_stage_passes_on_other_failures(error):
+    def failing_node(state):
+        raise error
+
+    node = optional("test_optional_failure", failing_node, min_budget=0)
+    with use_scope(CancelScope(budget=60)):
+        with pytest.raises(type(error)):
+            node({})
@@ -0,0 +1,135 @@
+"""
+Tests for stored runs: the inputs a run is resumed with, re-planning, and pruning of expired runs and images.
+"""
+import sqlite3
+import time
+from types import SimpleNamespace
+from typing import List, TypedDict
+
+import pytest
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph import END, START, StateGraph
+
+from city_garden.checkpointing import (ANALYSIS_FIELDS, analysis_complete, image_sources, input_conflicts, prune_runs,
+                                       replan_run, run_config, stored_run)
+from city_garden.image_store import ImageStore
+
+
+class RunState(TypedDict):
+    image_ids: List[str]
+
+
+def build_graph(checkpointer):
+    graph = StateGraph(RunState)
+    graph.add_node("plan", lambda state: {})
+    graph.add_edge(START, "plan")
+    graph.add_edge("plan", END)
+    return graph.compile(checkpointer=checkpointer)
+
+
+def test_prune_runs_deletes_expired_runs_and_their_images(tmp_path):
+    path = str(tmp_path / "checkpoints.sqlite3")
+    checkpointer = SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+    store = ImageStore(persist_path=path)
+    graph = build_graph(checkpointer)
+
+    old_image, shared_image, unused_image = store.put(b"old"), store.put(b"shared"), store.put(b"unused")
+    graph.invoke({"image_ids": [old_image, shared_image]}, run_config("old"))
+    store.release([old_image, shared_image, unused_image])
+    held_image = store.put(b"held")
+    time.sleep(0.2)
+    started = time.time()
+    graph.invoke({"image_ids": [shared_image]}, run_config("new"))
+
+    assert prune_runs(checkpointer, store, ttl_seconds=time.time() - started + 0.1) == (1, 2)
+    assert stored_run(graph, "old") is None
+    assert stored_run(graph, "new") is not None
+    assert store.get(shared_image) == b"shared"
+    assert store.get(held_image) == b"held"
+    for image in (old_image, unused_image):
+        try:
+            store.get(image)
+        except KeyError:
+            continue
+        raise AssertionError(f"{image} was not pruned")
+
+
+def test_image_sources_drop_sas_tokens():
+    assert image_sources(["https://a.blob.core.windows.net/c/x.jpg?sv=2022&sig=abc&se=2026",
+                          "https://example.com/x.jpg?v=2"]) == [
+        "https://a.blob.core.windows.net/c/x.jpg", "https://example.com/x.jpg?v=2"]
+
+
+def test_input_conflicts_compare_stored_inputs_only():
+    snapshot = SimpleNamespace(values={"location": "Berlin", "language": "en"})
+    inputs = {"location": "Paris", "language": "en", "image_urls": ["https://example.com/x.jpg"]}
+    assert input_conflicts(snapshot, inputs) == ["location"]
+
+
+class PlanState(TypedDict, total=False):
+    compliance_check: str
+    sun_exposure: str
+    micro_climate: str
+    hardscape_elements: str
+    plant_iventory: str
+    environment_factors: str
+    style_preferences: str
+    plant_recommendations: List[str]
+    garden_image_url: str
+    skipped_stages: List[str]
+
+
+def build_plan_graph(checkpointer, fail_analysis: bool):
+    """The planning graph's analysis and planning nodes; the analysis fails like an LLM timeout."""
+    def analyze_garden_conditions(state):
+        if fail_analysis:
+            raise TimeoutError("LLM timeout")
+        return {field: "analyzed" for field in ANALYSIS_FIELDS}
+
+    def generate_final_output(state):
+        return {"plant_recommendations": [f"{state['style_preferences']} for {state['sun_exposure']}"]}
+
+    graph = StateGraph(PlanState)
+    graph.add_node("check_compliance", lambda state: {"compliance_check": "Pass"})
+    graph.add_node("analyze_garden_conditions", analyze_garden_conditions)
+    graph.add_node("generate_final_output", generate_final_output)
+    graph.add_edge(START, "check_compliance")
+    graph.add_edge("check_compliance", "analyze_garden_conditions")
+    graph.add_edge("analyze_garden_conditions", "generate_final_output")
+    graph.add_edge("generate_final_output", END)
+    return graph.compile(checkpointer=checkpointer)
+
+
+def initial_plan(style: str):
+    return {"style_preferences": style, "skipped_stages": [], **{field: "" for field in ANALYSIS_FIELDS}}
+
+
+def test_replan_rejects_a_run_interrupted_before_its_analysis(tmp_path):
+    checkpointer = SqliteSaver(sqlite3.connect(str(tmp_path / "checkpoints.sqlite3"), check_same_thread=False))
+    graph = build_plan_graph(checkpointer, fail_analysis=True)
+    with pytest.raises(TimeoutError):
+        graph.invoke(initial_plan("herbs"), run_config("interrupted"))
+
+    snapshot = stored_run(graph, "interrupted")
+    assert snapshot.values["compliance_check"] == "Pass"
+    assert not analysis_complete(snapshot)
+    with pytest.raises(ValueError):
+        replan_run(graph, "interrupted", "flowers")
+    assert stored_run(graph, "interrupted").next == ("analyze_garden_conditions",)
+
+
+def test_replan_reuses_a_finished_analysis(tmp_path):
+    checkpointer = SqliteSaver(sqlite3.connect(str(tmp_path / "checkpoints.sqlite3"), check_same_thread=False))
+    graph = build_plan_graph(checkpointer, fail_analysis=False)
+    graph.invoke(initial_plan("herbs"), run_config("finished"))
+
+    assert analysis_complete(stored_run(graph, "finished"))
+    assert replan_run(graph, "finished", "flowers")["plant_recommendations"] == ["flowers for analyzed"]
+
+
+@pytest.mark.parametrize("next_nodes", [("analyze_image", "analyze_image"), ("merge_image_findings",)])
+def test_analysis_is_incomplete_while_the_fanout_runs(next_nodes):
+    values = {"compliance_check": "Pass", **{field: "analyzed" for field in ANALYSIS_FIELDS}}
+    assert not analysis_complete(SimpleNamespace(values=values, next=next_nodes))
+    assert analysis_complete(SimpleNamespace(values=values, next=()))
@@ -0,0 +1,95 @@
+"""
+Tests for the multi-location Open-Meteo fetches: chunking, failed chunks and the order of the results.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from city_garden.tools import climate
+
+DAYS = 3
+
+
+def fake_response(latitude):
+    """A daily series whose values are the latitude, so every result can be traced to its coordinate."""
+    daily = SimpleNamespace(
+        Variables=lambda index: SimpleNamespace(ValuesAsNumpy=lambda: np.full(DAYS, latitude)),
+        Time=lambda: 1704067200,  # 2024-01-01 UTC
+        Interval=lambda: 86400,
+    )
+    return SimpleNamespace(Daily=lambda: daily, UtcOffsetSeconds=lambda: 3600)
+
+
+class FakeOpenMeteo:
+    """Answers multi-location requests; a request with a `failing` latitude raises."""
+
+    def __init__(self, failing=(), short=False):
+        self.failing = set(failing)
+        self.short = short
+        self.requests = []
+
+    def weather_api(self, url, params):
+        latitudes = params["latitude"]
+        self.requests.append(latitudes)
+        if self.failing & set(latitudes):
+            raise ConnectionError("bad coordinate")
+        responses = [fake_response(latitude) for latitude in latitudes]
+        # Only multi-location requests come back short
+        return responses[:-1] if self.short and len(latitudes) > 1 else responses
+
+
+@pytest.fixture
+def openmeteo(monkeypatch):
+    def install(**kwargs):
+        client = FakeOpenMeteo(**kwargs)
+        monkeypatch.setattr(climate, "_client", lambda retries=3: client)
+        return client
+    return install
+
+
+def fetch(coordinates, chunk_size=2):
+    return climate.fetch_daily_batch(coordinates, ["temperature_2m_min"], "2024-01-01", "2024-01-03",
+                                     chunk_size=chunk_size)
+
+
+def test_coordinates_are_sent_in_chunks(openmeteo):
+    client = openmeteo()
+    results = fetch([(float(latitude), 0.0) for latitude in range(5)])
+    assert client.requests == [[0.0, 1.0], [2.0, 3.0], [4.0]]
+    assert [result.values["temperature_2m_min"][0] for result in results] == [0, 1, 2, 3, 4]
+    # Local times: the UTC start shifted by the UTC offset
+    assert results[0].times[0] == np.datetime64("2024-01-01T01:00:00")
+    assert len(results[0].times) == DAYS
+
+
+def test_a_short_response_is_retried_one_by_one(openmeteo):
+    client = openmeteo(short=True)
+    results = fetch([(1.0, 0.0), (2.0, 0.0)])
+    assert client.requests == [[1.0, 2.0], [1.0], [2.0]]
+    assert all(result.ok for result in results)
+
+
+def test_a_failing_coordinate_only_fails_itself(openmeteo):
+    client = openmeteo(failing={2.0})
+    results = fetch([(1.0, 0.0), (2.0, 0.0), (3.0, 0.0)])
+    assert client.requests == [[1.0, 2.0], [1.0], [2.0], [3.0]]
+    assert [result.ok for result in results] == [True, False, True]
+    assert "bad coordinate" in results[1].error
+    assert (results[1].latitude, results[1].longitude) == (2.0, 0.0)
+
+
+def test_invalid_coordinates_are_never_sent(openmeteo):
+    client = openmeteo()
+    results = fetch([(1.0, 0.0), (91.0, 0.0), (2.0, 200.0), (3.0, 0.0)])
+    assert client.requests == [[1.0, 3.0]]
+    assert [result.ok for result in results] == [True, False, False, True]
+    assert [result.latitude for result in results] == [1.0, 91.0, 2.0, 3.0]
+    assert results[2].error.startswith("Invalid coordinate")
+
+
+def test_monthly_tools_use_the_batch_fetch(openmeteo):
+    client = openmeteo()
+    monthly = climate.get_monthly_average_temperature.invoke({"latitude": 52.5, "longitude": 13.4})
+    assert client.requests == [[52.5]]
+    assert monthly["temperature_2m_mean"].tolist() == [52.5]
@@ -0,0 +1,173 @@
+"""
+Tests for the climate derivation (hardiness zone, frost window, GDD) and its background fetches.
+"""
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from city_garden.tools import climate, climate_derivation
+from city_garden.tools.climate_derivation import derive_profile, hardiness_zone, season_matrix
+
+
+def daily_dates(start: str, end: str) -> np.ndarray:
+    return np.arange(np.datetime64(start), np.datetime64(end), dtype="datetime64[D]").astype("datetime64[s]")
+
+
+def synthetic_year(days: int = 365):
+    """Daily minimums from -4 °C (January 1) to 20 °C (midsummer); means are 5 °C higher."""
+    day = np.arange(days)
+    minimum = 8 - 12 * np.cos(2 * np.pi * day / 365)
+    return minimum, minimum + 5
+
+
+@pytest.mark.parametrize("extreme_min_c, zone, label", [
+    (-17.7, 7, "7a"),
+    (-17.8, 6, "6b"),
+    (-15.0, 7, "7b"),
+    (-4.0, 9, "9a"),
+    (-60.0, 1, "1a"),
+    (40.0, 13, "13b"),
+])
+def test_hardiness_zone(extreme_min_c, zone, label):
+    assert hardiness_zone(extreme_min_c) == (zone, label)
+
+
+def test_season_matrix_drops_february_29_and_incomplete_years():
+    dates = daily_dates("2020-01-01", "2021-07-01")
+    values = np.arange(len(dates), dtype=float)
+    matrix = season_matrix(dates, values)
+    # 2020 is complete (without February 29), the first half of 2021 is dropped
+    assert matrix.shape == (1, 365)
+    assert matrix[0, 58] == 58  # February 28
+    assert matrix[0, 59] == 60  # March 1
+
+
+def test_season_matrix_southern_seasons_span_the_new_year():
+    dates = daily_dates("2013-01-01", "2016-01-01")
+    values = np.arange(len(dates), dtype=float)
+    matrix = season_matrix(dates, values, southern=True)
+    # Three calendar years hold two complete southern seasons
+    assert matrix.shape == (2, 365)
+    shift = 365 - climate_derivation.MIDSUMMER
+    assert matrix[0, 0] == shift
+    assert np.array_equal(np.diff(matrix[0]), np.ones(364))
+
+
+def test_derive_profile():
+    dates = daily_dates("2013-01-01", "2016-01-01")
+    minimum, mean = synthetic_year()
+    profile = derive_profile(52.5, 13.4, dates, np.tile(minimum, 3), np.tile(mean, 3))
+    assert profile.years == 3
+    assert profile.extreme_min_c == -4.0
+    assert profile.hardiness_label == "9a"
+    assert profile.last_frost == "Feb 18"
+    assert profile.first_frost == "Nov 14"
+    assert profile.frost_free_days == 268
+    assert profile.gdd == pytest.approx(np.clip(mean - 10, 0, None).sum(), abs=0.1)
+
+
+def test_derive_profile_without_frost():
+    dates = daily_dates("2013-01-01", "2014-01-01")
+    minimum, mean = synthetic_year()
+    profile = derive_profile(10.0, 10.0, dates, minimum + 10, mean + 10)
+    assert profile.last_frost is None and profile.first_frost is None
+    assert profile.frost_free_days == 365
+
+
+def test_derive_profile_requires_a_complete_season():
+    dates = daily_dates("2013-01-01", "2013-07-01")
+    values = np.zeros(len(dates))
+    with pytest.raises(ValueError):
+        derive_profile(52.5, 13.4, dates, values, values)
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    """Replace the archive fetch with three synthetic years and count the calls."""
+    calls = []
+
+    def fetch(latitude, longitude, years):
+        calls.append((latitude, longitude, years))
+        minimum, mean = synthetic_year()
+        return daily_dates("2013-01-01", "2016-01-01"), np.tile(minimum, 3), np.tile(mean, 3)
+
+    monkeypatch.setattr(climate_derivation, "fetch_daily_temperatures", fetch)
+    climate_derivation._cell_profile.cache_clear()
+    yield calls
+    climate_derivation._cell_profile.cache_clear()
+
+
+class ImmediateExecutor:
+    """Runs each call on submit, like a pool whose fetch finishes before submit() returns."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+@pytest.fixture
+def immediate_executor(monkeypatch):
+    monkeypatch.setattr(climate, "_climate_executor", ImmediateExecutor())
+
+
+def submit_in_thread(latitude, longitude):
+    """Submit from another thread, so a deadlock fails the test instead of hanging it."""
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(future=climate_derivation.submit_climate_profile(latitude, longitude)),
+        daemon=True
+    )
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "submit_climate_profile did not return"
+    return result["future"]
+
+
+def test_submit_climate_profile_for_a_cached_cell(fetches, immediate_executor):
+    first = submit_in_thread(52.5, 13.4).result(5)
+    # The second request finds the profile cached, so its future is done before the callback is added
+    # (with a real pool, whenever the lookup wins the race against submit() returning)
+    second = submit_in_thread(52.51, 13.41).result(5)
+    assert first == second
+    assert len(fetches) == 1
+
+
+def test_submit_climate_profile_shares_a_pending_fetch(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def fetch(latitude, longitude, years):
+        calls.append(latitude)
+        release.wait(5)
+        minimum, mean = synthetic_year()
+        return daily_dates("2013-01-01", "2014-01-01"), minimum, mean
+
+    monkeypatch.setattr(climate_derivation, "fetch_daily_temperatures", fetch)
+    climate_derivation._cell_profile.cache_clear()
+    try:
+        first = climate_derivation.submit_climate_profile(48.1, 11.6)
+        second = climate_derivation.submit_climate_profile(48.1, 11.6)
+        assert first is second
+        release.set()
+        assert first.result(5).hardiness_label == "9a"
+        assert calls == [48.1]
+    finally:
+        release.set()
+        climate_derivation._cell_profile.cache_clear()
+
+
+def test_submit_climate_profile_fails_fast_offline(monkeypatch, immediate_executor):
+    def fetch(latitude, longitude, years):
+        raise RuntimeError("offline")
+
+    monkeypatch.setattr(climate_derivation, "fetch_daily_temperatures", fetch)
+    climate_derivation._cell_profile.cache_clear()
+    future = submit_in_thread(40.4, -3.7)
+    with pytest.raises(RuntimeError):
+        future.result(5)
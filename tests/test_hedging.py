@@ -0,0 +1,62 @@
+"""
+Tests for hedged LLM calls: latency windows per call site and cancelled calls.
+"""
+import asyncio
+
+from city_garden.hedging import HedgedLLM
+
+
+class SleepyLLM:
+    """Answers after the next delay of a list (the last one repeats)."""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+
+    async def ainvoke(self, messages, **kwargs):
+        delay = self.delays.pop(0) if len(self.delays) > 1 else self.delays[0]
+        await asyncio.sleep(delay)
+        return delay
+
+
+def test_latency_windows_are_kept_per_call_site():
+    hedged = HedgedLLM(SleepyLLM([0.05]), name="test_hedging_sites", min_samples=3, min_delay=0.0,
+                       initial_delay=1.0)
+    slow = hedged.call_site("vision")
+    fast = hedged.call_site("text")
+    for _ in range(3):
+        asyncio.run(slow.ainvoke([]))
+    hedged.llm.delays = [0.001]
+    for _ in range(3):
+        asyncio.run(fast.ainvoke([]))
+    assert slow.hedge_delay() >= 0.05
+    assert fast.hedge_delay() < 0.05
+    assert hedged.call_site("vision") is slow
+
+
+def test_primary_that_lost_to_its_hedge_is_recorded():
+    # The primary takes 1s, the hedge sent after 0.05s answers after 0.01s
+    hedged = HedgedLLM(SleepyLLM([1.0, 0.01]), name="test_hedging_lost", initial_delay=0.05,
+                       budget_ratio=1.0)
+    assert asyncio.run(hedged.ainvoke([], "node")) == 0.01
+    samples = sorted(hedged._latencies["node"])
+    # The hedge's latency and the primary's time until the hedge answered
+    assert len(samples) == 2
+    assert samples[1] >= 0.05
+
+
+def test_externally_cancelled_call_records_nothing():
+    hedged = HedgedLLM(SleepyLLM([1.0]), name="test_hedging_abandoned", initial_delay=0.05, budget_ratio=1.0)
+
+    async def abandon(after):
+        call = asyncio.ensure_future(hedged.ainvoke([], "node"))
+        await asyncio.sleep(after)
+        call.cancel()
+        try:
+            await call
+        except asyncio.CancelledError:
+            pass
+
+    # Before the hedge is sent, and with the primary and the hedge both in flight
+    asyncio.run(abandon(0.02))
+    asyncio.run(abandon(0.1))
+    assert not hedged._latencies.get("node")
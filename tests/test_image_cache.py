@@ -0,0 +1,108 @@
+"""
+Tests for the garden image cache: keys, expiry and eviction of both backends, and old SQLite databases.
+"""
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from city_garden.services import image_cache
+from city_garden.services.image_cache import CachedGardenImage, GardenImageCache, SqliteImageCache
+
+IMAGES = ["a" * 64, "b" * 64]
+PLANTS = [{"name": "Lavender"}, {"name": "Thyme"}]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(image_cache, "time", SimpleNamespace(time=clock))
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def make(**options):
+        if request.param == "sqlite":
+            return SqliteImageCache(str(tmp_path / "cache.sqlite3"), **options)
+        return GardenImageCache(**options)
+    return make
+
+
+def test_key_ignores_the_spelling_and_order_of_the_plants():
+    key = GardenImageCache.make_key(IMAGES, PLANTS, "v1")
+    assert GardenImageCache.make_key(IMAGES, ["thyme", {"name": " LAVENDER "}, "Thyme"], "v1") == key
+    assert GardenImageCache.make_key(IMAGES[::-1], PLANTS, "v1") != key
+    assert GardenImageCache.make_key(IMAGES, PLANTS, "v2") != key
+    assert GardenImageCache.make_key(IMAGES, PLANTS + ["Sage"], "v1") != key
+
+
+@pytest.mark.parametrize("plants", [[], None, "Lavender", [{"name": ""}]])
+def test_requests_without_plants_are_not_cached(plants):
+    assert GardenImageCache.make_key(IMAGES, plants, "v1") is None
+
+
+def test_entries_expire_after_the_ttl(make_cache, clock):
+    cache = make_cache(ttl_seconds=60)
+    cache.set("key", "https://blob/garden.png", {"webp": "garden-640.webp 640w"})
+    clock.now += 60
+    assert cache.get("key") == CachedGardenImage("https://blob/garden.png", {"webp": "garden-640.webp 640w"})
+    clock.now += 1
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_a_ttl_of_zero_never_expires(make_cache, clock):
+    cache = make_cache(ttl_seconds=0)
+    cache.set("key", "https://blob/garden.png")
+    clock.now += 10 * 365 * 24 * 3600
+    assert cache.get("key").url == "https://blob/garden.png"
+
+
+@pytest.mark.parametrize("eviction, kept", [("lru", {"first", "third"}), ("fifo", {"second", "third"})])
+def test_eviction_policy(make_cache, clock, eviction, kept):
+    cache = make_cache(max_entries=2, eviction=eviction)
+    for key in ("first", "second"):
+        cache.set(key, f"https://blob/{key}.png")
+        clock.now += 1
+    # Reading "first" makes it the most recently used, but not the most recently inserted
+    assert cache.get("first") is not None
+    clock.now += 1
+    cache.set("third", "https://blob/third.png")
+    assert {key for key in ("first", "second", "third") if cache.get(key)} == kept
+    assert cache.stats()["entries"] == 2
+
+
+def test_unknown_eviction_policy():
+    with pytest.raises(ValueError):
+        GardenImageCache(eviction="random")
+
+
+def test_sqlite_databases_from_before_the_variants_are_migrated(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE garden_images (key TEXT PRIMARY KEY, image_url TEXT NOT NULL, "
+                       "created REAL NOT NULL, accessed REAL NOT NULL)")
+    connection.execute("INSERT INTO garden_images VALUES ('old', 'https://blob/old.png', ?, ?)",
+                       (clock.now, clock.now))
+    connection.commit()
+    connection.close()
+
+    cache = SqliteImageCache(path)
+    assert cache.get("old") == CachedGardenImage("https://blob/old.png", {})
+    cache.set("new", "https://blob/new.png", {"avif": "new-640.avif 640w"})
+    assert cache.get("new").variants == {"avif": "new-640.avif 640w"}
+
+
+def test_sqlite_entries_are_shared_between_caches(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    SqliteImageCache(path).set("key", "https://blob/garden.png")
+    assert SqliteImageCache(path).get("key").url == "https://blob/garden.png"
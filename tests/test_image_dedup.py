@@ -0,0 +1,77 @@
+"""
+Tests for near-duplicate detection of the uploaded photos.
+"""
+import base64
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from city_garden.services.image_dedup import ImageFingerprint, deduplicate_images
+
+
+def scene(seed: int, size=(160, 120), noise: float = 0.0) -> Image.Image:
+    """A smooth random scene; the same seed at another size or with a little noise is a near-duplicate."""
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8))
+    pixels = np.asarray(coarse.resize(size, Image.Resampling.BICUBIC), dtype=np.float64)
+    if noise:
+        pixels = pixels + np.random.default_rng(seed + 1000).normal(0, noise, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def encode(image: Image.Image) -> str:
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def distance(a: str, b: str, method: str) -> int:
+    return ImageFingerprint.from_bytes(base64.b64decode(a)).distance(
+        ImageFingerprint.from_bytes(base64.b64decode(b)), method)
+
+
+def test_the_highest_resolution_copy_is_kept_at_the_first_position():
+    small, other, large = encode(scene(1)), encode(scene(2)), encode(scene(1, size=(640, 480)))
+    kept, dropped = deduplicate_images([small, other, large])
+    assert kept == [large, other]
+    assert dropped == [0]
+
+
+@pytest.mark.parametrize("method", ["dhash", "phash", "both"])
+def test_the_threshold_is_inclusive(method):
+    original, edited = encode(scene(5)), encode(scene(5, noise=60))
+    bits = distance(original, edited, method)
+    assert 0 < bits < 32
+    assert deduplicate_images([original, edited], threshold=bits, method=method)[1] == [1]
+    assert deduplicate_images([original, edited], threshold=bits - 1, method=method)[1] == []
+
+
+def test_both_hashes_must_be_within_the_threshold():
+    original, edited = encode(scene(5)), encode(scene(5, noise=60))
+    bits = distance(original, edited, "dhash")
+    assert distance(original, edited, "phash") > bits
+    assert deduplicate_images([original, edited], threshold=bits, method="dhash")[1] == [1]
+    assert deduplicate_images([original, edited], threshold=bits, method="both")[1] == []
+
+
+def test_a_threshold_of_zero_only_merges_identical_images():
+    image = encode(scene(4))
+    assert deduplicate_images([image, image, encode(scene(4, noise=40))], threshold=0)[1] == [1]
+
+
+def test_different_scenes_are_kept():
+    images = [encode(scene(seed)) for seed in range(5)]
+    assert deduplicate_images(images) == (images, [])
+
+
+def test_undecodable_images_are_never_merged():
+    image = encode(scene(5))
+    broken = base64.b64encode(b"not an image").decode("ascii")
+    assert deduplicate_images([broken, image, broken]) == ([broken, image, broken], [])
+
+
+def test_unknown_hash_method():
+    with pytest.raises(ValueError):
+        deduplicate_images([], method="ahash")
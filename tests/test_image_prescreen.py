@@ -0,0 +1,55 @@
+"""
+Tests for the local compliance pre-screen: the rules per image and the verdict for a set of images.
+"""
+from dataclasses import replace
+
+import pytest
+
+from city_garden.services.image_prescreen import (FAIL, PASS, UNCERTAIN, ImageFeatures, PrescreenResult, classify,
+                                                  combine_verdicts, prescreen_images)
+
+BALCONY = ImageFeatures(aspect_ratio=4 / 3, vegetation=0.2, colour_entropy=0.6, top_colours=0.1, near_white=0.05,
+                        edge_density=0.2, axis_aligned_edges=0.6, skin=0.05)
+
+
+@pytest.mark.parametrize("changes, verdict, reason", [
+    ({}, PASS, "photo with plants"),
+    ({"near_white": 0.7, "colour_entropy": 0.2}, FAIL, "document"),
+    ({"top_colours": 0.8, "colour_entropy": 0.25}, FAIL, "screenshot or graphic"),
+    ({"aspect_ratio": 0.3, "colour_entropy": 0.4}, FAIL, "screenshot"),
+    ({"skin": 0.5, "vegetation": 0.01}, FAIL, "selfie"),
+    # Close calls go to the LLM
+    ({"vegetation": 0.04}, UNCERTAIN, "no clear"),
+    ({"axis_aligned_edges": 0.4}, UNCERTAIN, "no clear"),
+    ({"skin": 0.3}, UNCERTAIN, "no clear"),
+    ({"aspect_ratio": 0.3}, PASS, "photo with plants"),
+    ({"skin": 0.5, "vegetation": 0.03}, UNCERTAIN, "no clear"),
+])
+def test_classify(changes, verdict, reason):
+    result = classify(replace(BALCONY, **changes))
+    assert result[0] == verdict
+    assert result[1].startswith(reason)
+
+
+def results(*verdicts):
+    return [PrescreenResult(verdict, "", None) for verdict in verdicts]
+
+
+@pytest.mark.parametrize("verdicts, combined", [
+    ((PASS,), PASS),
+    # A compass screenshot next to the balcony photos does not fail the set
+    ((FAIL, PASS), PASS),
+    ((UNCERTAIN, FAIL, PASS), PASS),
+    ((FAIL, FAIL), FAIL),
+    ((FAIL, UNCERTAIN), UNCERTAIN),
+    ((UNCERTAIN,), UNCERTAIN),
+    ((), UNCERTAIN),
+])
+def test_combine_verdicts_passes_when_any_image_passes(verdicts, combined):
+    assert combine_verdicts(results(*verdicts)) == combined
+
+
+def test_undecodable_images_are_uncertain():
+    [result] = prescreen_images([b"not an image"])
+    assert result.verdict == UNCERTAIN
+    assert result.features is None
@@ -0,0 +1,95 @@
+"""
+Tests for the plant index: queries built from the preferences and the analysis, and the shortlist.
+"""
+import pytest
+
+from city_garden.tools.plant_index import Plant, PlantIndex, PlantQuery, build_query
+
+
+def plant(name, category="herb", cycle="perennial", edible=True, zones=(1, 13), light=("full_sun",),
+          wind="high", container=True):
+    return Plant(name=name, latin_name=name, category=category, cycle=cycle, edible=edible, min_zone=zones[0],
+                 max_zone=zones[1], light=light, wind_tolerance=wind, container=container)
+
+
+@pytest.fixture
+def index():
+    # Each plant after "exact" fails one more constraint, in the order they are relaxed
+    return PlantIndex([
+        plant("category", category="flower", cycle="annual", edible=False, light=("shade",), wind="low"),
+        plant("exact"),
+        plant("edible", cycle="annual", edible=False, light=("shade",), wind="low"),
+        plant("wind", wind="low"),
+        plant("light", cycle="annual", light=("shade",), wind="low"),
+        plant("cycle", cycle="annual", wind="low"),
+        plant("zone", zones=(9, 11)),
+        plant("container", container=False),
+    ])
+
+
+QUERY = PlantQuery(zone=6, light="full_sun", wind="high", cycle="perennial", edible=True,
+                   categories=frozenset({"herb"}))
+
+
+def test_shortlist_relaxes_softest_constraints_first(index):
+    names = [p.name for p in index.shortlist(QUERY, limit=10)]
+    assert names == ["exact", "wind", "cycle", "light", "edible", "category"]
+
+
+def test_shortlist_stops_at_the_limit(index):
+    assert [p.name for p in index.shortlist(QUERY, limit=2)] == ["exact", "wind"]
+
+
+def test_shortlist_never_drops_zone_or_container(index):
+    query = PlantQuery(zone=6, categories=frozenset({"fruit"}))
+    assert index.shortlist(query) == [p for p in index.plants if p.name not in ("zone", "container")]
+
+
+def test_annuals_are_in_every_zone(index):
+    names = {p.name for p in index.plants_of(index.matching(PlantQuery(zone=1, container=False)))}
+    assert names == {"category", "exact", "edible", "wind", "light", "cycle", "container"}
+
+
+def test_build_query_from_preferences():
+    query = build_query({"growType": "Edible", "subType": "Herbs and berries", "cycleType": "Perennial",
+                         "winterType": "outdoor"}, hardiness_zone=7)
+    assert query == PlantQuery(zone=6, edible=True, categories=frozenset({"herb", "fruit"}), cycle="perennial")
+
+
+def test_build_query_ignores_the_zone_for_plants_wintering_indoors():
+    assert build_query({"winterType": "Indoors"}, hardiness_zone=7).zone is None
+
+
+def test_measured_levels_take_precedence_over_the_analysis_text():
+    query = build_query(None, sun_exposure="full sun", wind_pattern="strong winds", wind_exposure="low",
+                        light_level="shade")
+    assert (query.light, query.wind) == ("shade", "low")
+
+
+@pytest.mark.parametrize("wind_pattern, wind", [
+    ("Strong gusts between the buildings", "high"),
+    ("no strong winds, sheltered", "low"),
+    ("sheltered from strong winds", "low"),
+    ("next to a high-rise, highly sheltered", "low"),
+    ("view of a high-rise", None),
+    ("moderately windy", "medium"),
+    ("not windy", None),
+    ("sheltered, but exposed to gusts", None),
+    ("", None),
+])
+def test_wind_from_the_analysis(wind_pattern, wind):
+    assert build_query(None, wind_pattern=wind_pattern).wind == wind
+
+
+@pytest.mark.parametrize("sun_exposure, light", [
+    ("Full sun all day", "full_sun"),
+    ("partial shade", "partial_shade"),
+    ("morning sun, afternoon shade", "partial_shade"),
+    ("no direct sun", "shade"),
+    ("north-facing balcony", "shade"),
+    ("north-east facing", None),
+    ("not sunny", None),
+    ("", None),
+])
+def test_light_from_the_analysis(sun_exposure, light):
+    assert build_query(None, sun_exposure=sun_exposure).light == light